@@ -1,7 +1,26 @@
 import db
+import numpy as np
 import pandas as pd
 from functools import reduce
 from sqlalchemy.sql import text
+from terms import RATES_TERMS, TermMatcher
+
+ARTICLE_COLUMNS = ['ID', 'Handle', 'Title', 'Year', 'Authors', 'Venue', 'URL', 'Abstract', 'Keywords']
+
+# Columns a LazyArticleCollection fetches only when they are used
+HEAVY_COLUMNS = ['Authors', 'Abstract', 'Keywords']
+LIGHT_COLUMNS = [column for column in ARTICLE_COLUMNS if column not in HEAVY_COLUMNS]
+
+# SQL expression for each column of an ArticleCollection, used when querying descendants
+COLUMN_SQL = {'ID': "articles.id",
+              'Handle': "articles.handle",
+              'Title': "articles.title",
+              'Year': "articles.year",
+              'Authors': "string_agg(distinct authors.name, \'; \')",
+              'Venue': "venues.name",
+              'URL': "articles.url",
+              'Abstract': "articles.abstract",
+              'Keywords': "string_agg(distinct keywords.keyword, \'; \')"}
 
 '''
 Class that holds a DataFrame of Articles
@@ -9,15 +28,80 @@ Class that holds a DataFrame of Articles
 class ArticleCollection:
     def __init__(self, df):
         """
-        :param df: A DataFrame object of correct dimension and column names
+        :param df: A DataFrame object with the columns in ARTICLE_COLUMNS, or a subset of them (in the
+        same order) that includes ID and Handle
         """
-        correct_columns = df.columns.to_list() == ['ID', 'Handle', 'Title', 'Year', 'Authors', 'Venue', 'URL', 'Abstract', 'Keywords']
+        columns = df.columns.to_list()
+        correct_columns = columns == [column for column in ARTICLE_COLUMNS if column in columns] and \
+            'ID' in columns and 'Handle' in columns
         if not correct_columns:
             raise TypeError("Incorrect format for input DataFrame")
-        self.articles_df = df
+        self._df = df
+        self._parts = None
+        self._ids = None
+
+    @classmethod
+    def from_rows(cls, parts):
+        """
+        Create a collection from rows of other collections, without building its DataFrame until it is needed
+        :param parts: A list of (ArticleCollection, array of row positions) tuples
+        :return: An ArticleCollection object
+        """
+        collection = cls.__new__(cls)
+        collection._df = None
+        collection._parts = parts
+        collection._ids = None
+        return collection
+
+    @property
+    def articles_df(self):
+        if self._df is None:
+            dfs = [collection.take(rows) for (collection, rows) in self._parts]
+            df = pd.concat(dfs).reset_index(drop=True) if dfs else pd.DataFrame(columns=ARTICLE_COLUMNS)
+            self._df = df[[column for column in ARTICLE_COLUMNS if column in df.columns]]
+            self._parts = None
+        return self._df
+
+    @property
+    def ids(self):
+        """
+        Sorted array of the unique article ids in the collection
+        """
+        if self._ids is None:
+            if self._df is None:
+                self._ids = np.unique(np.concatenate([np.zeros(0, dtype=np.int64)] +
+                                                     [collection.id_column()[rows] for (collection, rows) in self._parts]))
+            else:
+                self._ids = np.unique(self.id_column())
+        return self._ids
+
+    def column(self, name):
+        """
+        :param name: A column name, e.g. 'Handle'
+        :return: The column as a Series
+        """
+        return self.articles_df[name]
+
+    def take(self, rows):
+        """
+        :param rows: An array of row positions
+        :return: A DataFrame of those rows
+        """
+        return self.articles_df.iloc[rows]
+
+    def id_column(self):
+        """
+        :return: The ID of every row, as an int64 array
+        """
+        if self._df is None:
+            return np.concatenate([np.zeros(0, dtype=np.int64)] +
+                                  [collection.id_column()[rows] for (collection, rows) in self._parts])
+        return self._df['ID'].to_numpy(dtype=np.int64)
 
     def __len__(self):
-        return len(self.articles_df)
+        if self._df is None:
+            return sum(len(rows) for (_, rows) in self._parts)
+        return len(self._df)
 
     def __eq__(self, other):
         return self.__class__ == other.__class__ and self.articles_df == other.articles_df
@@ -37,6 +121,51 @@ class ArticleCollection:
         self.articles_df.to_csv(file_name)
 
 
+class LazyArticleCollection(ArticleCollection):
+    """
+    ArticleCollection that holds only the light columns (LIGHT_COLUMNS). The heavy columns (abstracts and the
+    aggregated author/keyword strings) are fetched from the database the first time they are needed, in batched
+    IN (...) queries, and cached. Counting, set operations and the light columns never touch the database.
+    """
+    def __init__(self, df, session_object, batch_size=5000):
+        """
+        :param df: A DataFrame object with some or all of the columns in LIGHT_COLUMNS, including ID and Handle
+        :param session_object: A SQLAlchemy session object used to fetch the heavy columns
+        :param batch_size: Number of articles per query when fetching heavy columns
+        """
+        super().__init__(df)
+        self.session_object = session_object
+        self.batch_size = batch_size
+        self._heavy = pd.DataFrame(columns=HEAVY_COLUMNS, index=pd.Index([], name='ID'))
+        self._complete_df = None
+
+    def _fetch_heavy(self, ids):
+        missing = [int(id) for id in pd.unique(ids) if id not in self._heavy.index]
+        for start in range(0, len(missing), self.batch_size):
+            sql_statement = text(descendants_select("unnest(cast(:ids as bigint[])) as descendants(id_of_citing)",
+                                                    columns=['ID'] + HEAVY_COLUMNS))
+            rows = self.session_object.execute(sql_statement, {"ids": missing[start:start + self.batch_size]})
+            batch = pd.DataFrame(rows, columns=['ID'] + HEAVY_COLUMNS).set_index('ID')
+            self._heavy = pd.concat([self._heavy, batch]) if len(self._heavy) > 0 else batch
+
+    def take(self, rows):
+        light = self._df.iloc[rows]
+        self._fetch_heavy(light['ID'])
+        df = light.join(self._heavy, on='ID')
+        return df[[column for column in ARTICLE_COLUMNS if column in df.columns]]
+
+    def column(self, name):
+        if name in self._df.columns:
+            return self._df[name]
+        return self.articles_df[name]
+
+    @property
+    def articles_df(self):
+        if self._complete_df is None:
+            self._complete_df = self.take(np.arange(len(self._df)))
+        return self._complete_df
+
+
 def article_info(article):
     """
     Extract attributes of an Article object
@@ -70,18 +199,61 @@ def extract_handles(article_collection):
     :param article_collection: An instance of ArticleCollection
     :return: A set of RePEC handles
     """
-    return set(article_collection.articles_df["Handle"].to_list())
+    return set(article_collection.column("Handle").to_list())
+
+
+def reduce_on_ids(f, article_collections):
+    """
+    Helper function to run set operations on the sorted id arrays of ArticleCollection objects
+    :param f: A binary function f(x,y) -> z where x, y, and z are sorted arrays of unique ids
+    :param article_collections: A list of ArticleCollection objects
+    :return: A sorted array of ids
+    """
+    id_arrays = [collection.ids for collection in article_collections]
+    return reduce(f, id_arrays[1:], id_arrays[0])
+
+
+def intersect_ids(article_collections):
+    """
+    Find set intersection of article ids within a list of ArticleCollection objects
+    :param article_collections: list of ArticleCollection objects
+    :return: A sorted array of ids
+    """
+    return reduce_on_ids(lambda x, y: np.intersect1d(x, y, assume_unique=True), article_collections)
 
 
-def reduce_on_handles(f, article_collections):
+def union_ids(article_collections):
     """
-    Helper function to run set operations on ArticleCollection objects
-    :param f: A binary function f(x,y) -> z where x, y, and z are sets objects
+    Find the set union of article ids within a list of ArticleCollection objects.
+    :param article_collections: A list of ArticleCollection objects
+    :return: A sorted array of ids
+    """
+    return reduce_on_ids(np.union1d, article_collections)
+
+
+def difference_ids(article_collections):
+    """
+    Find the set difference (i.e. complement) of the article ids in a list of ArticleCollection objects
+    Note: A-B-C = A-(BUC) -> Returns all elements of A not in B or C.
     :param article_collections: A list of ArticleCollection objects
-    :return: A set object
+    :return: A sorted array of ids
     """
-    article_sets = list(map(extract_handles, article_collections))
-    return set(reduce(f, article_sets[1:], article_sets[0]))
+    return reduce_on_ids(lambda x, y: np.setdiff1d(x, y, assume_unique=True), article_collections)
+
+
+def handles_for_ids(ids, article_collections):
+    """
+    Look up the handles of article ids that occur in a list of ArticleCollection objects
+    :return: A set of handles
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    handles = set()
+    for collection in article_collections:
+        found = np.isin(collection.id_column(), ids)
+        handles.update(collection.column('Handle').to_numpy()[found])
+        if len(handles) == len(ids):
+            break
+    return handles
 
 
 def intersect_handles(article_collections):
@@ -90,7 +262,7 @@ def intersect_handles(article_collections):
     :param article_collections: list of ArticleCollection objects
     :return: A set of handles
     """
-    return reduce_on_handles(lambda x, y: x.intersection(y), article_collections)
+    return handles_for_ids(intersect_ids(article_collections), article_collections)
 
 
 def union_handles(article_collections):
@@ -99,7 +271,7 @@ def union_handles(article_collections):
     :param article_collections: A list of ArticleCollection objects
     :return: set of handles
     """
-    return reduce_on_handles(lambda x, y: x.union(y), article_collections)
+    return handles_for_ids(union_ids(article_collections), article_collections)
 
 
 def difference_handles(article_collections):
@@ -109,23 +281,34 @@ def difference_handles(article_collections):
     :param article_collections: A list of ArticleCollection objects
     :return: set of handles
     """
-    return reduce_on_handles(lambda x, y: x.difference(y), article_collections)
+    return handles_for_ids(difference_ids(article_collections), article_collections[:1])
 
 
-def combine(article_collections, handles_set=None):
+def combine(article_collections, handles_set=None, ids=None):
     """
     Combine (i.e. combine) one or more ArticleCollection objects while dropping duplicates.
-    If handles_set is specified, the resulting ArticleCollection object will only contain articles
-    with the specified RePEC handles.
+    If handles_set (or ids) is specified, the resulting ArticleCollection object will only contain articles
+    with the specified RePEC handles (or article ids). The combined DataFrame is only built when it is used.
     :param article_collections: A list of ArticleCollection objects
     :param handles_set: An optional set of RePEC handles
+    :param ids: An optional array of article ids, e.g. from intersect_ids
     :return: An ArticleCollection object
     """
-    dfs = map(lambda x: x.articles_df, article_collections)
-    new = pd.concat(dfs).drop_duplicates(subset=["Handle"]).reset_index(drop=True)
-    if handles_set is not None:
-        new = new[new['Handle'].isin(list(handles_set))]
-    return ArticleCollection(new)
+    seen = np.zeros(0, dtype=np.int64)
+    parts = []
+    for collection in article_collections:
+        id_column = collection.id_column()
+        keep = ~np.isin(id_column, seen)
+        if ids is not None:
+            keep &= np.isin(id_column, np.asarray(ids, dtype=np.int64))
+        if handles_set is not None:
+            keep &= collection.column('Handle').isin(list(handles_set)).to_numpy()
+        # Keep the first row of each id, as drop_duplicates would
+        _, first_rows = np.unique(id_column, return_index=True)
+        rows = np.intersect1d(np.flatnonzero(keep), first_rows, assume_unique=True)
+        parts.append((collection, rows))
+        seen = np.union1d(seen, id_column[rows])
+    return ArticleCollection.from_rows(parts)
 
 
 def shared_handles_percent(article_collections):
@@ -134,53 +317,219 @@ def shared_handles_percent(article_collections):
     :param article_collections: A list of ArticleCollection objects
     :return: A float
     """
-    numerator = len(intersect_handles(article_collections))
-    denominator = len(union_handles(article_collections))
+    # One pass: an id is shared if it occurs in every collection
+    _, counts = np.unique(np.concatenate([collection.ids for collection in article_collections]), return_counts=True)
+    numerator = np.count_nonzero(counts == len(article_collections))
+    denominator = len(counts)
     return numerator/denominator
 
 
-def get_descendants(article, session_object, degree=(1,1)):
+def shared_percent_matrix(article_collections, labels=None):
     """
-    Create an ArticleCollection of the citation descendants of an article
-    :param article: An Article object (returned by a lookup function)
-    :param session_object: A SQLAlchemy session object
-    :param degree: Number of generations to query. If left unspecified, all descendants are returned.
-    :return: ArticleCollection
+    Calculate shared_handles_percent for every pair of ArticleCollection objects
+    :param article_collections: A list of ArticleCollection objects
+    :param labels: Optional labels for the rows and columns (e.g. seed names)
+    :return: A square DataFrame
+    """
+    id_arrays = [collection.ids for collection in article_collections]
+    matrix = np.ones((len(id_arrays), len(id_arrays)))
+    for i in range(len(id_arrays)):
+        for j in range(i + 1, len(id_arrays)):
+            shared = len(np.intersect1d(id_arrays[i], id_arrays[j], assume_unique=True))
+            total = len(id_arrays[i]) + len(id_arrays[j]) - shared
+            matrix[i, j] = matrix[j, i] = shared / total if total > 0 else 0.0
+    return pd.DataFrame(matrix, index=labels, columns=labels)
+
+
+def descendants_select(from_clause, where_clause="", columns=ARTICLE_COLUMNS):
     """
+    Build the aggregate query that returns one row per descendant article
+    :param from_clause: SQL for a relation named descendants, with the descendants' ids in id_of_citing
+    :param where_clause: Optional SQL condition restricting descendants
+    :param columns: ArticleCollection columns to select; tables are only joined when a column needs them
+    :return: A string of SQL
+    """
+    columns = [column for column in ARTICLE_COLUMNS if column in columns]
+    joins = "left join articles on descendants.id_of_citing = articles.id "
+    group_by = "articles.id"
+    if 'Venue' in columns:
+        joins += "left join venues on articles.venue_id = venues.id "
+        group_by += ", venues.name"
+    if 'Authors' in columns:
+        joins += ("left join author_article_association on articles.id = author_article_association.article_id "
+                  "left join authors on author_article_association.author_id = authors.id ")
+    if 'Keywords' in columns:
+        joins += ("left join keyword_article_association on articles.id = keyword_article_association.article_id "
+                  "left join keywords on keyword_article_association.keyword_id = keywords.id ")
+    return ("select " + ", ".join(COLUMN_SQL[column] for column in columns) + " "
+            "from " + from_clause + " " + joins +
+            ("where " + where_clause + " " if where_clause else "") +
+            "group by " + group_by + ";")
+
+
+def ltree_descendants_statement(article_id, degree, columns=ARTICLE_COLUMNS):
     if degree is None:
         end_part = ".*"
-    if degree[0] == degree[1]:
+    elif degree[0] == degree[1]:
         end_part = ".*{" + str(degree[0]) + "}"
     else:
         end_part = ".*{" + str(degree[0]) + "," + str(degree[1]) + "}"
-    id = article.id
-    citation_chain_query = "*." + str(id) + end_part
-    sql_statement = text("select articles.id, articles.handle, articles.title, articles.year, "
-                         "string_agg(distinct authors.name, \'; \'), venues.name, articles.url, articles.abstract, "
-                         "string_agg(distinct keywords.keyword, \'; \') "
-                         "from citations "
-                         "left join articles on citations.id_of_citing = articles.id "
-                         "left join venues on articles.venue_id = venues.id "
-                         "left join author_article_association on articles.id = author_article_association.article_id "
-                         "left join authors on author_article_association.author_id = authors.id "
-                         "left join keyword_article_association on articles.id = keyword_article_association.article_id "
-                         "left join keywords on keyword_article_association.keyword_id = keywords.id "
-                         "where citation_chain ~ :q group by articles.id, venues.name;").params(q=citation_chain_query)
-    sql_output = session_object.execute(sql_statement)
-    df = pd.DataFrame(sql_output, columns = ['ID', 'Handle', 'Title', 'Year', 'Authors', 'Venue', 'URL', 'Abstract', 'Keywords'])
+    citation_chain_query = "*." + str(article_id) + end_part
+    return text(descendants_select("citations as descendants", "citation_chain ~ :q", columns)).params(q=citation_chain_query)
+
+
+def edge_descendants_statement(article_id, degree, columns=ARTICLE_COLUMNS):
+    if degree is None:
+        # Without a depth bound, UNION on the ids alone stops the recursion at cycles
+        cte = ("with recursive reachable(id) as ("
+               "select cast(:id as bigint) "
+               "union "
+               "select citation_edges.citing_id from citation_edges "
+               "join reachable on citation_edges.cited_id = reachable.id) "
+               "select id as id_of_citing from reachable")
+        params = {"id": article_id}
+    else:
+        cte = ("with recursive reachable(id, depth) as ("
+               "select citing_id, 1 from citation_edges where cited_id = :id "
+               "union "
+               "select citation_edges.citing_id, reachable.depth + 1 from citation_edges "
+               "join reachable on citation_edges.cited_id = reachable.id "
+               "where reachable.depth < :max_depth) "
+               "select distinct id as id_of_citing from reachable where depth >= :min_depth")
+        params = {"id": article_id, "min_depth": degree[0], "max_depth": degree[1]}
+    return text(descendants_select("(" + cte + ") as descendants", columns=columns)).params(**params)
+
+
+def descendants_statement(article, degree, method, columns):
+    if method == "ltree":
+        return ltree_descendants_statement(article.id, degree, columns)
+    elif method == "edges":
+        return edge_descendants_statement(article.id, degree, columns)
+    else:
+        raise ValueError("Unknown method " + str(method))
+
+
+def get_descendants(article, session_object, degree=(1,1), method="ltree", columns=ARTICLE_COLUMNS, lazy=False):
+    """
+    Create an ArticleCollection of the citation descendants of an article
+    :param article: An Article object (returned by a lookup function)
+    :param session_object: A SQLAlchemy session object
+    :param degree: Number of generations to query. If left unspecified, all descendants are returned.
+    :param method: "ltree" matches citation paths recorded by the scraper. "edges" walks the citation_edges
+    table with a recursive CTE, so it also finds descendants reached through a path the scraper didn't
+    record (an article already in the database is not expanded again).
+    :param columns: Columns to fetch, e.g. ['ID', 'Handle', 'Year'] to skip abstracts and the author/keyword joins
+    :param lazy: If True, return a LazyArticleCollection that only queries the light columns now, and fetches
+    Authors, Abstract and Keywords when they are first used
+    :return: ArticleCollection
+    """
+    columns = [column for column in ARTICLE_COLUMNS if column in columns]
+    if lazy:
+        columns = [column for column in columns if column in LIGHT_COLUMNS]
+    sql_output = session_object.execute(descendants_statement(article, degree, method, columns))
+    df = pd.DataFrame(sql_output, columns = columns)
+    if lazy:
+        return LazyArticleCollection(df, session_object)
+    return ArticleCollection(df)
+
+
+def iter_descendants(article, session_object, degree=(1,1), method="ltree", columns=ARTICLE_COLUMNS,
+                     chunk_size=10000):
+    """
+    Stream the citation descendants of an article as a series of ArticleCollection chunks. Rows are read
+    through a server-side cursor, so memory use is bounded by chunk_size rather than the number of descendants.
+    :param article: An Article object (returned by a lookup function)
+    :param session_object: A SQLAlchemy session object
+    :param degree: Number of generations to query (see get_descendants)
+    :param method: "ltree" or "edges" (see get_descendants)
+    :param columns: Columns to fetch (see get_descendants)
+    :param chunk_size: Number of articles per chunk
+    :return: A generator of ArticleCollection objects
+    """
+    columns = [column for column in ARTICLE_COLUMNS if column in columns]
+    connection = session_object.connection().execution_options(stream_results=True)
+    sql_output = connection.execute(descendants_statement(article, degree, method, columns))
+    try:
+        while True:
+            rows = sql_output.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield ArticleCollection(pd.DataFrame(rows, columns=columns))
+    finally:
+        sql_output.close()
+
+
+def get_generation_stats(article, session_object):
+    """
+    Read the materialized citation statistics of an article, one row per generation of descendants. The
+    statistics count citation paths recorded by the scraper (like method="ltree" in get_descendants).
+    :param article: An Article object (returned by a lookup function)
+    :param session_object: A SQLAlchemy session object
+    :return: A DataFrame with columns Depth, Paths, Descendants, FirstYear and LastYear, ordered by depth
+    """
+    rows = session_object.query(db.GenerationStats.depth, db.GenerationStats.paths, db.GenerationStats.descendants,
+                                db.GenerationStats.first_year, db.GenerationStats.last_year) \
+        .filter(db.GenerationStats.article_id == article.id) \
+        .order_by(db.GenerationStats.depth)
+    return pd.DataFrame(rows.all(), columns=['Depth', 'Paths', 'Descendants', 'FirstYear', 'LastYear'])
+
+
+def descendant_count(article, session_object):
+    """
+    :param article: An Article object (returned by a lookup function)
+    :param session_object: A SQLAlchemy session object
+    :return: Number of distinct descendants of the article at any depth, from the materialized statistics
+    """
+    count = session_object.query(db.ArticleStats.descendants).filter_by(article_id=article.id).scalar()
+    return 0 if count is None else count
+
+
+# Shared matcher, so abstracts tokenized by one call are reused by the next
+RATES_MATCHER = TermMatcher(RATES_TERMS)
+
+
+def get_articles(article_ids, session_object, columns=ARTICLE_COLUMNS):
+    """
+    Create an ArticleCollection of the articles with the given ids, in the order given
+    :param article_ids: A list of article ids
+    :param session_object: A SQLAlchemy session object
+    :param columns: Columns to fetch (see get_descendants)
+    :return: ArticleCollection
+    """
+    columns = [column for column in ARTICLE_COLUMNS if column in columns]
+    article_ids = [int(id) for id in article_ids]
+    sql_statement = text(descendants_select("unnest(cast(:ids as bigint[])) as descendants(id_of_citing)",
+                                            columns=columns)).params(ids=article_ids)
+    df = pd.DataFrame(session_object.execute(sql_statement), columns=columns)
+    order = {id: position for (position, id) in enumerate(article_ids)}
+    df = df.iloc[df.ID.map(order).argsort()].reset_index(drop=True)
     return ArticleCollection(df)
 
 
-def subset_rates_articles(article_collection):
+def rates_term_counts(article_collection, matcher=None):
+    """
+    Count how often each rates term occurs in the abstract of every article
+    :param article_collection: An ArticleCollection object with an Abstract column
+    :param matcher: Optional terms.TermMatcher, e.g. with other terms or prefix matching; defaults to RATES_MATCHER
+    :return: A DataFrame of counts with one row per article (indexed by handle) and one column per term
+    """
+    matcher = RATES_MATCHER if matcher is None else matcher
+    data = article_collection.articles_df
+    counts = matcher.count_matrix(data.Abstract, keys=data.ID)
+    return pd.DataFrame(counts, index=data.Handle, columns=matcher.terms)
+
+
+def subset_rates_articles(article_collection, matcher=None, min_matches=1):
+    """
+    Select the articles whose abstracts mention rates terms
+    :param article_collection: An ArticleCollection object with an Abstract column
+    :param matcher: Optional terms.TermMatcher (see rates_term_counts)
+    :param min_matches: Minimum number of term occurrences for an article to be kept
+    :return: An ArticleCollection object
+    """
     data = article_collection.articles_df
-    rates_terms = ["interest rate model", "libor", "euribor", "term structure",
-                   "yield curve", "zero coupon", "discount curve", "bond",
-                   "treasury", "gilt", "bund", "short rate", "eonia", "sonia",
-                   "fed funds", "convexity", "duration", "maturity", "maturities",
-                   "caplet", "cap", "swaption", "term premia", "term premium",
-                   "forward rate", "yield", "cms", "market price of risk"]
-    terms_with_spaces = [" " + term + " " for term in rates_terms]
-    data_subset = data[data.Abstract.str.contains("|".join(terms_with_spaces), case=False)]
+    counts = rates_term_counts(article_collection, matcher)
+    data_subset = data[counts.sum(axis=1).to_numpy() >= min_matches]
     return ArticleCollection(data_subset)
 
 
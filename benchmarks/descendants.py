@@ -0,0 +1,71 @@
+# Benchmark comparing analysis.get_descendants over the ltree path table and the citation_edges table.
+# Usage: python -m benchmarks.descendants [--repeat N] [handle ...]
+
+import argparse
+import time
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql import text
+import analysis
+import settings
+
+DEFAULT_HANDLES = {"hjm": "RePEc:ecm:emetrp:v:60:y:1992:i:1:p:77-105",
+                   "vasicek": "RePEc:eee:jfinec:v:5:y:1977:i:2:p:177-188",
+                   "jamshidian": "RePEc:spr:finsto:v:1:y:1997:i:4:p:293-330"}
+
+DEGREES = [(1, 1), (1, 2), (1, 3), (2, 3)]
+
+
+def table_sizes(session):
+    """
+    :return: A dict of table name -> (row count, total size in bytes including indexes)
+    """
+    sizes = dict()
+    for table in ("citations", "citation_edges"):
+        rows = session.execute(text("select count(*) from " + table)).scalar()
+        size = session.execute(text("select pg_total_relation_size(:t)"), {"t": table}).scalar()
+        sizes[table] = (rows, size)
+    return sizes
+
+
+def time_descendants(article, session, degree, method, repeat):
+    """
+    :return: (best wall-clock time in seconds, number of descendants)
+    """
+    best = None
+    count = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = len(analysis.get_descendants(article, session, degree, method=method))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, count
+
+
+def run(session, handles, repeat=3):
+    results = []
+    for handle in handles:
+        article = analysis.lookup_by_handle(handle, session)
+        if article is None:
+            print("Skipping " + handle + ": not in the database")
+            continue
+        for degree in DEGREES:
+            for method in ("ltree", "edges"):
+                seconds, count = time_descendants(article, session, degree, method, repeat)
+                results.append({"handle": handle, "degree": degree, "method": method,
+                                "seconds": seconds, "descendants": count})
+                print("{:<45} {:<8} {:<6} {:>8} rows {:>9.3f}s".format(handle, str(degree), method, count, seconds))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare ltree and edge-table descendant queries")
+    parser.add_argument("handles", nargs="*", default=list(DEFAULT_HANDLES.values()))
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    engine = create_engine(settings.SQL_URL, echo=False)
+    session = sessionmaker(bind=engine)()
+    for table, (rows, size) in table_sizes(session).items():
+        print("{:<15} {:>10} rows {:>10.1f} MB".format(table, rows, size / 1e6))
+    run(session, args.handles, args.repeat)
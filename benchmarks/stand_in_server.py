@@ -0,0 +1,124 @@
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+
+class StandInServer:
+    """
+    Local HTTP server answering RePEc (/cgi-bin/h.cgi?h=...) and CitEc (/api/citedby/<handle>/<user>)
+    requests from a SyntheticSite, with a configurable latency and request rate. Requests beyond the
+    rate get a 429 with a Retry-After header, like a throttling upstream host.
+    Pass url as repec_base_url and citec_base_url to cache.DataCache to crawl it.
+    """
+    def __init__(self, site, latency=0.0, jitter=0.0, max_requests_per_second=None, seed=0):
+        """
+        :param site: A synthetic_site.SyntheticSite
+        :param latency: Seconds to wait before answering every request
+        :param jitter: Extra uniformly random wait of up to this many seconds
+        :param max_requests_per_second: Rate above which requests are throttled; unlimited if None
+        """
+        self.site = site
+        self.latency = latency
+        self.jitter = jitter
+        self.max_requests_per_second = max_requests_per_second
+        self.rng = random.Random(seed)
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        self.window_start = time.monotonic()
+        self.window_count = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:" + str(self.server.server_port)
+
+    def _throttled(self):
+        if self.max_requests_per_second is None:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= 1:
+                self.window_start = now
+                self.window_count = 0
+            self.window_count += 1
+            return self.window_count > self.max_requests_per_second
+
+    def respond(self, path):
+        """
+        :return: (status code, body, extra headers) for a request path
+        """
+        parts = urlsplit(path)
+        if parts.path == "/cgi-bin/h.cgi":
+            kind = "repec"
+            handle = parse_qs(parts.query).get("h", [""])[0]
+            body = self.site.repec_page(handle)
+        elif parts.path.startswith("/api/citedby/"):
+            kind = "citec"
+            handle = unquote(parts.path[len("/api/citedby/"):].rsplit("/", 1)[0])
+            body = self.site.citec_response(handle) if handle in self.site.cites else None
+        else:
+            kind = "other"
+            body = None
+
+        if self._throttled():
+            status, body, headers = 429, "Too many requests", {"Retry-After": "1"}
+        elif body is None:
+            status, body, headers = 404, "Not found", {}
+        else:
+            status, headers = 200, {}
+        with self.lock:
+            self.requests[(kind, status)] += 1
+        return status, body, headers
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                delay = server.latency + (server.rng.uniform(0, server.jitter) if server.jitter else 0)
+                if delay > 0:
+                    time.sleep(delay)
+                status, body, headers = server.respond(self.path)
+                data = body.encode("utf-8")
+                self.send_response(status)
+                for (name, value) in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "text/xml" if "citedby" in self.path else "text/html")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def request_counts(self):
+        """
+        :return: A dict of "<repec|citec|other> <status>" -> number of requests answered
+        """
+        with self.lock:
+            return {kind + " " + str(status): count for ((kind, status), count) in sorted(self.requests.items())}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
@@ -0,0 +1,71 @@
+import random
+from sqlalchemy.dialects.postgresql import insert
+import db
+from writer import build_ltree
+
+
+def generate_citation_chains(n_articles, branching=3.0, extra_path_rate=0.1, seed=0):
+    """
+    Generate citation chains the way repec_scraper records them: a breadth-first tree of
+    first-visit paths from a single root (article 1), plus extra paths to articles that were
+    already visited, as happens when a paper is cited by several others.
+    :param n_articles: Number of articles in the corpus
+    :param branching: Mean number of citing articles per article
+    :param extra_path_rate: Expected number of extra paths per article
+    :param seed: Random seed, so corpora are reproducible
+    :return: A list of citation chains (lists of article ids); the first chain of each article is
+    its first-visit path
+    """
+    rng = random.Random(seed)
+    chains = [[1]]
+    first_paths = {1: [1]}
+    frontier = [1]
+    next_id = 2
+    while next_id <= n_articles:
+        # If every branch has died out, restart from a random article so the corpus reaches n_articles
+        parent = frontier.pop(0) if frontier else rng.randint(1, next_id - 1)
+        n_children = min(int(rng.expovariate(1 / branching)), n_articles - next_id + 1)
+        for _ in range(n_children):
+            chain = first_paths[parent] + [next_id]
+            first_paths[next_id] = chain
+            chains.append(chain)
+            frontier.append(next_id)
+            next_id += 1
+        # Extra paths: the parent is also cited by articles that are already in the corpus
+        n_extra = int(extra_path_rate) + (1 if rng.random() < extra_path_rate % 1 else 0)
+        for _ in range(n_extra):
+            citing = rng.randint(1, next_id - 1)
+            if citing not in first_paths[parent]:
+                chains.append(first_paths[parent] + [citing])
+    return chains
+
+
+def populate(session, chains, batch_size=10000):
+    """
+    Load a synthetic corpus into an empty database: one placeholder article per id, plus the
+    citations and citation_edges rows for every chain
+    """
+    article_ids = sorted({chain[-1] for chain in chains})
+    for start in range(0, len(article_ids), batch_size):
+        rows = [{"id": id, "handle": "RePEc:syn:synthe:" + str(id), "title": "Synthetic article " + str(id),
+                 "year": 1970 + id % 50, "abstract": "Synthetic abstract", "url": ""}
+                for id in article_ids[start:start + batch_size]]
+        session.execute(insert(db.Article.__table__).values(rows))
+    for start in range(0, len(chains), batch_size):
+        batch = chains[start:start + batch_size]
+        session.execute(insert(db.CitationChain.__table__)
+                        .values([{"id_of_citing": chain[-1], "citation_chain": build_ltree(chain)} for chain in batch])
+                        .on_conflict_do_nothing())
+        edges = {db.citation_edge_from_chain(chain) for chain in batch}
+        edge_rows = [{"citing_id": citing_id, "cited_id": cited_id} for (citing_id, cited_id) in filter(None, edges)]
+        if edge_rows:
+            session.execute(insert(db.CitationEdge.__table__).values(edge_rows).on_conflict_do_nothing())
+    session.commit()
+
+
+def reset(engine):
+    """
+    Drop and recreate every table. Only run this against a scratch database.
+    """
+    db.Base.metadata.drop_all(engine)
+    db.migrate(engine)
@@ -0,0 +1,152 @@
+import html
+import json
+import random
+from terms import RATES_TERMS
+
+FILLER_WORDS = ["model", "market", "estimate", "evidence", "policy", "price", "risk", "data", "effect",
+                "analysis", "equilibrium", "dynamic", "structure", "shock", "return", "asset", "investor",
+                "firm", "growth", "inflation", "panel", "volatility", "option", "credit", "liquidity"]
+
+REPEC_PAGE_TEMPLATE = """<html><head><title>{title}</title>
+<script type="application/ld+json">
+{json_ld}
+</script></head><body><h1>{title}</h1></body></html>"""
+
+CITEC_NOT_FOUND = "<citedBy><errorString>Requested document not found</errorString></citedBy>"
+
+
+def synthetic_handle(article_id):
+    return "RePEc:syn:synthe:" + str(article_id)
+
+
+class SyntheticSite:
+    """
+    A reproducible RePEc/CitEc corpus: a citation graph grown breadth-first from one root article, with
+    a RePEc JSON-LD page and a CitEc citation list for every article. Besides the tree of first citations,
+    articles are also cited by articles already in the graph (cross links) and by their own ancestors
+    (cycles), and some citing handles have no RePEc page at all, as happens with real data.
+    """
+    def __init__(self, n_articles, branching=3.0, max_depth=None, cross_link_rate=0.1, cycle_rate=0.01,
+                 missing_rate=0.02, topic_rate=0.3, topic_correlation=0.0, seed=0):
+        """
+        :param n_articles: Number of articles with a RePEc page
+        :param branching: Mean number of citing articles per article
+        :param max_depth: Maximum number of generations below the root; unlimited if None
+        :param cross_link_rate: Expected number of extra citations per article from articles already in the graph
+        :param cycle_rate: Probability that an article is also cited by one of its ancestors
+        :param missing_rate: Probability that a citing handle has no RePEc page (the stand-in server answers 404)
+        :param topic_rate: Probability that an abstract mentions rates terms (see terms.RATES_TERMS)
+        :param topic_correlation: Weight of the parent's topic in that probability: with 1, an article is
+        on-topic exactly when the article it first cites is
+        :param seed: Random seed
+        """
+        self.rng = random.Random(seed)
+        self.topic_rate = topic_rate
+        self.topic_correlation = topic_correlation
+        self.cites = dict()
+        self.depths = {1: 0}
+        self.parents = {1: None}
+        self.missing = set()
+        self.root = synthetic_handle(1)
+
+        frontier = [1]
+        next_id = 2
+        citing_lists = {1: []}
+        while next_id <= n_articles and frontier:
+            parent = frontier.pop(0)
+            if max_depth is not None and self.depths[parent] >= max_depth:
+                continue
+            # Keep growing from the root if every branch died out before reaching n_articles
+            n_children = int(self.rng.expovariate(1 / branching)) if frontier else max(1, round(branching))
+            for _ in range(min(n_children, n_articles - next_id + 1)):
+                citing_lists[parent].append(next_id)
+                citing_lists[next_id] = []
+                self.depths[next_id] = self.depths[parent] + 1
+                self.parents[next_id] = parent
+                frontier.append(next_id)
+                next_id += 1
+        self.n_articles = next_id - 1
+
+        for article_id in range(1, self.n_articles + 1):
+            n_extra = int(cross_link_rate) + (1 if self.rng.random() < cross_link_rate % 1 else 0)
+            for _ in range(n_extra):
+                citing_lists[article_id].append(self.rng.randint(1, self.n_articles))
+            if self.rng.random() < cycle_rate and self.parents[article_id] is not None:
+                citing_lists[article_id].append(self.rng.choice(self.ancestors(article_id)))
+            if self.rng.random() < missing_rate:
+                missing_id = -article_id
+                citing_lists[article_id].append(missing_id)
+                self.missing.add(synthetic_handle(missing_id))
+            self.cites[synthetic_handle(article_id)] = [synthetic_handle(id) for id in
+                                                        dict.fromkeys(citing_lists[article_id]) if id != article_id]
+        self.on_topic = set()
+        self.abstracts = {handle: self._abstract(handle) for handle in self.cites}
+
+    def ancestors(self, article_id):
+        ancestors = []
+        while self.parents[article_id] is not None:
+            article_id = self.parents[article_id]
+            ancestors.append(article_id)
+        return ancestors
+
+    def _abstract(self, handle):
+        # Parents have lower ids, so their topic is already drawn
+        parent = self.parents[self.article_id(handle)]
+        rate = self.topic_rate
+        if parent is not None and self.topic_correlation:
+            rate = ((1 - self.topic_correlation) * rate +
+                    self.topic_correlation * (synthetic_handle(parent) in self.on_topic))
+        words = [self.rng.choice(FILLER_WORDS) for _ in range(self.rng.randint(40, 120))]
+        if self.rng.random() < rate:
+            self.on_topic.add(handle)
+            for _ in range(self.rng.randint(1, 4)):
+                words.insert(self.rng.randrange(len(words)), self.rng.choice(RATES_TERMS))
+        return "We " + " ".join(words) + "."
+
+    def handles(self):
+        return list(self.cites)
+
+    def article_id(self, handle):
+        return int(handle.rsplit(":", 1)[1])
+
+    def repec_page(self, handle):
+        """
+        :return: The RePEc page of a handle, or None if it has none
+        """
+        if handle not in self.cites:
+            return None
+        article_id = self.article_id(handle)
+        year = 1970 + min(self.depths[article_id] * 3, 50)
+        graph = [{"@id": "#periodical", "@type": "Periodical", "name": "Journal of Synthetic Finance " +
+                  str(article_id % 7)},
+                 {"@id": "#number", "@type": "PublicationIssue", "datePublished": str(year) + "-0" +
+                  str(1 + article_id % 9)},
+                 {"@id": "#article", "@type": "ScholarlyArticle", "name": "Synthetic article " + str(article_id),
+                  "author": "Author, A" + str(article_id % 101) + " & Author, B" + str(article_id % 37),
+                  "url": "https://ideas.repec.org/a/syn/synthe/" + str(article_id) + ".html",
+                  "description": self.abstracts[handle],
+                  "keywords": "synthetic; keyword " + str(article_id % 13)}]
+        json_ld = json.dumps({"@context": "https://schema.org", "@graph": graph}, indent=1)
+        return REPEC_PAGE_TEMPLATE.format(title=html.escape("Synthetic article " + str(article_id)), json_ld=json_ld)
+
+    def citec_response(self, handle):
+        """
+        :return: The CitEc citedby response of a handle (a not-found error if nothing cites it)
+        """
+        cites = self.cites.get(handle)
+        if not cites:
+            return CITEC_NOT_FOUND
+        texts = ["<text ref=\"http://citec.repec.org/" + html.escape(cite) + "\">" + "Citing paper</text>"
+                 for cite in cites]
+        return "<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n<citedBy>" + "\n".join(texts) + "</citedBy>"
+
+    def fill_cache(self, storage):
+        """
+        Write every page and citation list into a cache storage backend, as a completed crawl would
+        :return: Number of entries written
+        """
+        for handle in self.cites:
+            name = handle.replace("/", "_")
+            storage.write("repec", name, self.repec_page(handle))
+            storage.write("citec", name, self.citec_response(handle))
+        return 2 * len(self.cites)
@@ -1,113 +1,502 @@
 import codecs
 import glob
+import gzip
+import mmap
 import os
+import sqlite3
+import threading
 import time
-import requests
 import settings
-import datetime
 import logging
-from retrying import retry
+import http_client
+from metrics import registry as metrics
 
-def seconds_to_milliseconds(seconds):
-    return seconds*1000
+class NotCachedException(Exception):
+    pass
 
-@retry(wait_exponential_multiplier=seconds_to_milliseconds(1), wait_exponential_max=seconds_to_milliseconds(settings.WAIT_BEFORE_TIMEOUT))
-def stubborn_request(url):
-    try:
-        output = requests.get(url,
-                              timeout=120,
-                              headers=settings.HEADERS)
-        logging.info("Request to " + url + " succeeded.")
-        return output
-    except Exception:
-        logging.warning("Requests threw an exception. Waiting before trying again...")
-        raise IOError
+
+# How long a cached CitEc citation list is trusted by a refresh crawl before it is requested again
+CITEC_TTL = 7 * 24 * 60 * 60
+
+
+REPEC_BASE_URL = "https://ideas.repec.org"
+CITEC_BASE_URL = "http://citec.repec.org"
+
+
+def repec_url(handle, base_url=REPEC_BASE_URL):
+    return base_url + "/cgi-bin/h.cgi?h=" + handle
+
+
+def citec_url(handle, base_url=CITEC_BASE_URL):
+    return base_url + "/api/citedby/" + handle + "/" + settings.CITEC_USERNAME
+
+
+def stubborn_request(url, headers=None):
+    """
+    Request a page through the shared HTTP client, retrying until it succeeds, fails permanently, or the
+    host keeps blocking us (see http_client.HttpClient)
+    :param headers: Optional extra headers, e.g. If-None-Match for a conditional request (a 304 response is
+    returned like any other)
+    """
+    return http_client.default_client.get(url, headers=headers)
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every thread requesting pages from one host. A token is added every
+    seconds_between_requests seconds, up to burst tokens; acquire() blocks until one is available.
+    """
+    def __init__(self, seconds_between_requests, burst=1):
+        self.seconds_between_requests = seconds_between_requests
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+        self.resume_at = 0
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.seconds_between_requests <= 0:
+            self.tokens = self.burst
+        else:
+            elapsed = now - self.last_refill
+            self.tokens = min(self.burst, self.tokens + elapsed / self.seconds_between_requests)
+        self.last_refill = now
+
+    def acquire(self):
+        """
+        Block until a request to the host is allowed
+        :return: Number of seconds spent waiting
+        """
+        waited = 0
+        # Holding the lock while sleeping queues up other threads for the same host behind us
+        with self.lock:
+            pause = self.resume_at - time.monotonic()
+            if pause > 0:
+                time.sleep(pause)
+                waited += pause
+            self._refill()
+            while self.tokens < 1:
+                delay = (1 - self.tokens) * self.seconds_between_requests
+                time.sleep(delay)
+                waited += delay
+                self._refill()
+            self.tokens -= 1
+        return waited
+
+    def sleep(self, seconds):
+        """
+        Wait out a backoff between attempts (see worker.DatabaseRateLimiter.sleep)
+        """
+        time.sleep(seconds)
+
+    def pause(self, seconds):
+        """
+        Hold back every request to the host for the given number of seconds, e.g. after a 429 response
+        """
+        # Set without the lock, which a thread waiting in acquire() may be holding
+        self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class CacheIndex:
+    """
+    Persistent manifest of the handles held in the cache, stored as a SQLite file in the cache
+    directory. Entries are keyed by file name stem, i.e. the handle with '/' replaced by '_', and
+    paths are stored relative to the cache directory. The database is opened on first use, and is built by walking the cache directory
+    only if it doesn't exist yet; afterwards it is updated on every write.
+    """
+    def __init__(self, cache_location, file_name="cache_index.sqlite"):
+        self.cache_location = cache_location
+        self.index_path = cache_location + file_name
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.connection is None:
+            is_new = not os.path.exists(self.index_path)
+            os.makedirs(self.cache_location, exist_ok=True)
+            self.connection = sqlite3.connect(self.index_path, check_same_thread=False)
+            self.connection.execute("create table if not exists entries ("
+                                    "source text not null, "
+                                    "name text not null, "
+                                    "path text not null, "
+                                    "primary key (source, name))")
+            if is_new:
+                self._build_from_directory()
+        return self.connection
+
+    def _build_from_directory(self):
+        logging.info("Building cache index from the files in " + self.cache_location)
+        for source in ("repec", "citec"):
+            paths = glob.glob(self.cache_location + source + "/*/*")
+            rows = [(source, os.path.basename(path).rsplit(".", 1)[0], os.path.relpath(path, self.cache_location))
+                    for path in paths]
+            self.connection.executemany("insert or replace into entries values (?, ?, ?)", rows)
+        self.connection.commit()
+
+    def lookup(self, source, name):
+        """
+        :return: Path of the cached file, or None if it isn't cached
+        """
+        with self.lock:
+            row = self._connect().execute("select path from entries where source = ? and name = ?",
+                                          (source, name)).fetchone()
+        return None if row is None else self.cache_location + row[0]
+
+    def add(self, source, name, path):
+        with self.lock:
+            connection = self._connect()
+            connection.execute("insert or replace into entries values (?, ?, ?)",
+                               (source, name, os.path.relpath(path, self.cache_location)))
+            connection.commit()
+
+    def remove(self, source, name):
+        with self.lock:
+            connection = self._connect()
+            connection.execute("delete from entries where source = ? and name = ?", (source, name))
+            connection.commit()
+
+    def names(self, source):
+        with self.lock:
+            rows = self._connect().execute("select name from entries where source = ?", (source,)).fetchall()
+        return [row[0] for row in rows]
+
+    def rebuild(self):
+        """
+        Discard the index and rebuild it from the files in the cache directory
+        """
+        with self.lock:
+            connection = self._connect()
+            connection.execute("delete from entries")
+            self._build_from_directory()
+
+
+class FetchLog:
+    """
+    When each cached entry was last requested from upstream, with the ETag and Last-Modified headers of
+    the response, stored as fetch_log.sqlite in the cache directory. It is kept separately from the
+    storage backends, so it works with any of them. Entries cached before the log existed have no record.
+    """
+    def __init__(self, cache_location, file_name="fetch_log.sqlite"):
+        self.cache_location = cache_location
+        self.log_path = cache_location + file_name
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.connection is None:
+            os.makedirs(self.cache_location, exist_ok=True)
+            self.connection = sqlite3.connect(self.log_path, check_same_thread=False)
+            self.connection.execute("create table if not exists fetches ("
+                                    "source text not null, "
+                                    "name text not null, "
+                                    "fetched_at real not null, "
+                                    "etag text, "
+                                    "last_modified text, "
+                                    "primary key (source, name))")
+            self.connection.execute("create table if not exists failures ("
+                                    "source text not null, "
+                                    "name text not null, "
+                                    "status integer, "
+                                    "failed_at real not null, "
+                                    "primary key (source, name))")
+        return self.connection
+
+    def record_failure(self, source, name, status):
+        """
+        Remember that an entry failed permanently (e.g. 404), so it isn't requested again
+        """
+        with self.lock:
+            connection = self._connect()
+            connection.execute("insert or replace into failures values (?, ?, ?, ?)",
+                               (source, name, status, time.time()))
+            connection.commit()
+
+    def failure(self, source, name):
+        """
+        :return: The status code of a permanent failure of the entry, or None if it hasn't failed
+        """
+        with self.lock:
+            row = self._connect().execute("select status from failures where source = ? and name = ?",
+                                          (source, name)).fetchone()
+        return None if row is None else row[0]
+
+    def record(self, source, name, response, fetched_at=None):
+        """
+        :param response: The requests.Response the entry was fetched (or revalidated) with
+        """
+        fetched_at = time.time() if fetched_at is None else fetched_at
+        with self.lock:
+            connection = self._connect()
+            connection.execute("insert or replace into fetches values (?, ?, ?, ?, ?)",
+                               (source, name, fetched_at,
+                                response.headers.get("ETag"), response.headers.get("Last-Modified")))
+            connection.commit()
+
+    def lookup(self, source, name):
+        """
+        :return: A (fetched_at, etag, last_modified) tuple, or None if the fetch wasn't logged
+        """
+        with self.lock:
+            return self._connect().execute("select fetched_at, etag, last_modified from fetches "
+                                           "where source = ? and name = ?", (source, name)).fetchone()
+
+    def fetch_times(self, source):
+        """
+        :return: A dict of name -> time of the last fetch, for every logged entry of a source
+        """
+        with self.lock:
+            rows = self._connect().execute("select name, fetched_at from fetches where source = ?",
+                                           (source,)).fetchall()
+        return dict(rows)
+
+
+class DirectoryStorage:
+    """
+    Default cache storage: one uncompressed file per handle, in one directory per publisher
+    (e.g. repec/eee/RePEc:eee:jfinec:v:5:y:1977:i:2:p:177-188.html).
+    """
+    extensions = {"repec": ".html", "citec": ".xml"}
+
+    def __init__(self, cache_location):
+        if not cache_location.endswith("/"):
+            cache_location = cache_location + "/"
+        self.cache_location = cache_location
+        self.index = CacheIndex(cache_location)
+
+    def _build_file_path(self, source, name):
+        return self.cache_location + source + "/" + name.split(":")[1] + "/" + name + self.extensions[source]
+
+    def read(self, source, name):
+        """
+        :return: The cached text, or None if it isn't cached
+        """
+        cached_path = self.index.lookup(source, name)
+        if cached_path is None:
+            return None
+        try:
+            with codecs.open(cached_path, 'r') as file:
+                return file.read()
+        except FileNotFoundError:
+            logging.warning("Cached file " + cached_path + " has gone missing; requesting it again")
+            self.index.remove(source, name)
+            return None
+
+    def write(self, source, name, text):
+        file_path = self._build_file_path(source, name)
+        # exist_ok, since prefetching threads may create the same publisher directory concurrently
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        file = open(file_path, 'w')
+        file.write(text)
+        file.close()
+        self.index.add(source, name, file_path)
+
+    def names(self, source):
+        return self.index.names(source)
+
+
+class PackStorage:
+    """
+    Cache storage in one append-only pack file per source (repec.pack, citec.pack). Every entry
+    is compressed as its own gzip member, and pack_index.sqlite maps each name to the entry's
+    offset and length, so reading an entry decompresses only that entry. Packs are read through
+    mmap, so a cold scan doesn't pay for an open() per entry.
+    """
+    def __init__(self, cache_location, compress_level=6):
+        if not cache_location.endswith("/"):
+            cache_location = cache_location + "/"
+        self.cache_location = cache_location
+        self.compress_level = compress_level
+        self.index_path = cache_location + "pack_index.sqlite"
+        self.connection = None
+        self.maps = dict()
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.connection is None:
+            os.makedirs(self.cache_location, exist_ok=True)
+            self.connection = sqlite3.connect(self.index_path, check_same_thread=False)
+            self.connection.execute("create table if not exists entries ("
+                                    "source text not null, "
+                                    "name text not null, "
+                                    "offset integer not null, "
+                                    "length integer not null, "
+                                    "primary key (source, name))")
+        return self.connection
+
+    def _pack_path(self, source):
+        return self.cache_location + source + ".pack"
+
+    def _map(self, source, end):
+        # Re-map the pack once it has grown past the end of the current mapping
+        current = self.maps.get(source)
+        if current is None or len(current) < end:
+            if current is not None:
+                current.close()
+            with open(self._pack_path(source), 'rb') as file:
+                current = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[source] = current
+        return current
+
+    def read(self, source, name):
+        """
+        :return: The cached text, or None if it isn't cached
+        """
+        with self.lock:
+            row = self._connect().execute("select offset, length from entries where source = ? and name = ?",
+                                          (source, name)).fetchone()
+            if row is None:
+                return None
+            offset, length = row
+            data = self._map(source, offset + length)[offset:offset + length]
+        return gzip.decompress(data).decode('utf-8')
+
+    def write(self, source, name, text):
+        data = gzip.compress(text.encode('utf-8'), compresslevel=self.compress_level)
+        with self.lock:
+            connection = self._connect()
+            with open(self._pack_path(source), 'ab') as file:
+                offset = file.tell()
+                file.write(data)
+            # A rewritten entry is appended again; the index points at the newest copy
+            connection.execute("insert or replace into entries values (?, ?, ?, ?)",
+                               (source, name, offset, len(data)))
+            connection.commit()
+
+    def names(self, source):
+        with self.lock:
+            rows = self._connect().execute("select name from entries where source = ?", (source,)).fetchall()
+        return [row[0] for row in rows]
+
+
+# Storage backends by the name used to select them, e.g. scrape_RePEc.py --storage pack
+STORAGE_CLASSES = {"directory": DirectoryStorage, "pack": PackStorage}
+
+
+def migrate_storage(from_storage, to_storage, sources=("repec", "citec")):
+    """
+    Copy every cached entry from one storage backend to another
+    :return: Number of entries copied
+    """
+    copied = 0
+    for source in sources:
+        for name in from_storage.names(source):
+            text = from_storage.read(source, name)
+            if text is not None:
+                to_storage.write(source, name, text)
+                copied += 1
+                if copied % 10000 == 0:
+                    logging.info("Migrated " + str(copied) + " cache entries")
+    return copied
 
 
 class DataCache:
-    last_repec_request_time = datetime.datetime.now()
-    last_citec_request_time = datetime.datetime.now()
-
-    @classmethod
-    def reset_citec_wait_time(cls):
-        cls.last_citec_request_time = datetime.datetime.now()
-
-    @classmethod
-    def reset_repec_wait_time(cls):
-        cls.last_repec_request_time = datetime.datetime.now()
-
-    @classmethod
-    def get_repec_wait_time(cls):
-        current = datetime.datetime.now()
-        diff = current - cls.last_repec_request_time
-        return max(settings.REPEC_WAIT_BETWEEN_REQUESTS - diff.seconds, 0)
-
-    @classmethod
-    def get_citec_wait_time(cls):
-        current = datetime.datetime.now()
-        diff = current - cls.last_citec_request_time
-        return max(settings.CITEC_WAIT_BETWEEN_REQUESTS - diff.seconds, 0)
-
-    def __init__(self, cache_location=settings.CACHE_LOCATION):
+    # Default limiter per upstream host, shared by every DataCache instance and thread
+    repec_limiter = RateLimiter(settings.REPEC_WAIT_BETWEEN_REQUESTS)
+    citec_limiter = RateLimiter(settings.CITEC_WAIT_BETWEEN_REQUESTS)
+
+    def __init__(self, cache_location=settings.CACHE_LOCATION, storage=None, offline=False, client=None,
+                 repec_base_url=REPEC_BASE_URL, citec_base_url=CITEC_BASE_URL, repec_limiter=None, citec_limiter=None):
+        """
+        :param storage: Optional storage backend (e.g. PackStorage); defaults to DirectoryStorage
+        :param offline: If True, never make network requests; cache misses raise NotCachedException
+        :param client: Optional http_client.HttpClient; defaults to the shared http_client.default_client
+        :param repec_base_url: Scheme and host to request RePEc pages from, e.g. a local stand-in server
+        :param citec_base_url: Scheme and host to request CitEc citation lists from
+        :param repec_limiter: Optional limiter to use instead of the shared DataCache.repec_limiter, e.g. a
+        worker.DatabaseRateLimiter shared with other processes
+        :param citec_limiter: Optional limiter to use instead of DataCache.citec_limiter
+        """
         # append final '/' if not included in path
         if not cache_location.endswith("/"):
             cache_location = cache_location + "/"
 
         self.cache_location = cache_location
-        self.repec_list = glob.glob(cache_location + "repec" + "/*/*")
-        self.citec_list = glob.glob(cache_location + "citec" + "/*/*")
-
-    def _build_handle_from_filename(self, filename):
-        return filename.replace("_", "/").split(".")[0]
+        self.storage = DirectoryStorage(cache_location) if storage is None else storage
+        self.offline = offline
+        self.fetch_log = FetchLog(cache_location)
+        self.client = http_client.default_client if client is None else client
+        self.repec_base_url = repec_base_url
+        self.citec_base_url = citec_base_url
+        self.repec_limiter = DataCache.repec_limiter if repec_limiter is None else repec_limiter
+        self.citec_limiter = DataCache.citec_limiter if citec_limiter is None else citec_limiter
 
-    def request_repec(self, handle):
-        def build_file_path(filename):
-            return build_file_directory(filename) + filename
+    def _get(self, source, name, url, limiter, headers=None):
+        status = self.fetch_log.failure(source, name)
+        if status is not None:
+            raise http_client.PermanentHTTPError("Request to " + url + " failed earlier with status " + str(status),
+                                                 status)
+        block_pattern = http_client.CITEC_BLOCK_PATTERN if source == "citec" else None
+        try:
+            return self.client.get(url, headers=headers, limiter=limiter, block_pattern=block_pattern)
+        except http_client.PermanentHTTPError as e:
+            self.fetch_log.record_failure(source, name, e.status_code)
+            raise
 
-        def build_file_directory(filename):
-            filename_components = filename.split(":")
-            return self.cache_location + "repec/" + filename_components[1] + "/"
+    def _request(self, source, handle, url, limiter):
+        name = handle.replace("/", "_")
+        cached = self.storage.read(source, name)
+        if cached is not None:
+            metrics.inc("cache_hits", source=source)
+            return cached
+        metrics.inc("cache_misses", source=source)
+        if self.offline:
+            raise NotCachedException(source + " data for " + handle + " is not in the cache")
 
-        corresp_file = handle.replace("/", "_") + ".html"
-        corresp_dir = build_file_directory(corresp_file)
+        request = self._get(source, name, url, limiter)
+        self.storage.write(source, name, request.text)
+        self.fetch_log.record(source, name, request)
+        return request.text
 
-        if build_file_path(corresp_file) in self.repec_list:
-            file = codecs.open(build_file_path(corresp_file), 'r')
-            return file.read()
-        else:
-            time.sleep(DataCache.get_repec_wait_time())
-            request = stubborn_request("https://ideas.repec.org/cgi-bin/h.cgi?h=" + handle)
-            DataCache.reset_repec_wait_time()
-            if not os.path.exists(corresp_dir):
-                os.makedirs(corresp_dir)
-            file = open(build_file_path(corresp_file), 'w')
-            file.write(request.text)
-            file.close()
-            self.repec_list.append(corresp_file)
-            return request.text
+    def _refresh(self, source, handle, url, limiter, max_age, before_store=None):
+        name = handle.replace("/", "_")
+        fetch = self.fetch_log.lookup(source, name)
+        if fetch is not None and time.time() - fetch[0] < max_age:
+            metrics.inc("refresh_skipped", source=source)
+            return None
+        cached = self.storage.read(source, name)
+        if self.offline:
+            raise NotCachedException(source + " data for " + handle + " can't be refreshed offline")
 
-    def request_citec(self, handle):
-        def build_file_path(filename):
-            return build_file_directory(filename) + filename
+        headers = dict()
+        if cached is not None and fetch is not None:
+            fetched_at, etag, last_modified = fetch
+            if etag is not None:
+                headers["If-None-Match"] = etag
+            if last_modified is not None:
+                headers["If-Modified-Since"] = last_modified
+        request = self._get(source, name, url, limiter, headers)
+        metrics.inc("refreshed", source=source, status=request.status_code)
+        if request.status_code == 304:
+            logging.info(source + " data for " + handle + " has not changed")
+            self.fetch_log.record(source, name, request)
+            return cached, cached
+        if before_store is not None:
+            before_store(cached, request.text)
+        self.storage.write(source, name, request.text)
+        self.fetch_log.record(source, name, request)
+        return cached, request.text
 
-        def build_file_directory(filename):
-            filename_components = filename.split(":")
-            return self.cache_location + "citec/" + filename_components[1] + "/"
+    def request_repec(self, handle):
+        return self._request("repec", handle,
+                             repec_url(handle, self.repec_base_url),
+                             self.repec_limiter)
 
-        corresp_file = handle.replace("/", "_") + ".xml"
-        corresp_dir = build_file_directory(corresp_file)
+    def request_citec(self, handle):
+        return self._request("citec", handle,
+                             citec_url(handle, self.citec_base_url),
+                             self.citec_limiter)
 
-        if build_file_path(corresp_file) in self.citec_list:
-            file = codecs.open(build_file_path(corresp_file), 'r')
-            return file.read()
-        else:
-            time.sleep(DataCache.get_citec_wait_time())
-            request = stubborn_request("http://citec.repec.org/api/citedby/" + handle + "/" + settings.CITEC_USERNAME)
-            DataCache.reset_citec_wait_time()
-            if not os.path.exists(corresp_dir):
-                os.makedirs(corresp_dir)
-            file = open(build_file_path(corresp_file), 'w')
-            file.write(request.text)
-            file.close()
-            self.citec_list.append(corresp_file)
-            return request.text
\ No newline at end of file
+    def refresh_citec(self, handle, max_age=CITEC_TTL, before_store=None):
+        """
+        Request the CitEc citation list of a handle again if the cached copy is older than max_age (or its
+        age is unknown), conditionally on the ETag/Last-Modified of the cached copy where there is one
+        :param max_age: Maximum age of the cached copy, in seconds
+        :param before_store: Optional function f(previously cached text or None, new text), called with a
+        changed list before it replaces the cached one; if it raises, the cache and fetch log are left as they were
+        :return: (previously cached text or None, current text), or None if the cached copy is recent enough
+        """
+        return self._refresh("citec", handle,
+                             citec_url(handle, self.citec_base_url),
+                             self.citec_limiter, max_age, before_store)
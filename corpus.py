@@ -0,0 +1,151 @@
+import os
+import numpy as np
+import db
+
+NO_ABSTRACT = "No abstract is available for this item."
+
+
+def default_tokenizer(text):
+    # gensim is only needed for the word2vec pipeline, so it is imported on first use
+    import gensim
+    return gensim.utils.simple_preprocess(text)
+
+
+def unseen_articles(session_object, seen_ids, criteria=(), batch_size=10000):
+    """
+    Read the articles whose ids aren't in seen_ids. Concurrent workers (see worker.run_worker) commit
+    articles with reserved ids out of order, so an article can appear with a lower id than ones already
+    seen: the ids are compared as sets rather than against the highest id seen.
+    :param seen_ids: An array of article ids
+    :param criteria: Optional list of filters on db.Article
+    :return: A generator of lists of at most batch_size (id, abstract) tuples, in id order
+    """
+    ids = np.fromiter((id for (id,) in session_object.query(db.Article.id).filter(*criteria).yield_per(batch_size)),
+                      dtype=np.int64)
+    ids = np.setdiff1d(ids, np.asarray(seen_ids, dtype=np.int64))
+    for start in range(0, len(ids), batch_size):
+        yield session_object.query(db.Article.id, db.Article.abstract) \
+            .filter(db.Article.id.in_(ids[start:start + batch_size].tolist())) \
+            .order_by(db.Article.id) \
+            .all()
+
+
+class TokenCorpus:
+    """
+    Abstracts tokenized once and stored on disk in a directory:
+      vocabulary.txt  - one token per line; the line number is the token id
+      tokens.bin      - uint32 token ids of every abstract, concatenated
+      ends.bin        - int64 end position of each abstract in tokens.bin
+      article_ids.bin - int64 article id of each abstract
+    The binary files are memory-mapped. Iterating over the corpus yields one list of tokens per
+    abstract and can be restarted, so it can be passed straight to gensim's Word2Vec and Phrases.
+    """
+    def __init__(self, directory, tokenizer=default_tokenizer):
+        if not directory.endswith("/"):
+            directory = directory + "/"
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.tokenizer = tokenizer
+        self.vocabulary = []
+        if os.path.exists(self._path("vocabulary.txt")):
+            with open(self._path("vocabulary.txt"), encoding="utf-8") as file:
+                self.vocabulary = file.read().splitlines()
+        self.token_index = {token: id for (id, token) in enumerate(self.vocabulary)}
+        self._repair()
+
+    def _path(self, file_name):
+        return self.directory + file_name
+
+    def _load(self, file_name, dtype):
+        path = self._path(file_name)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r")
+
+    def _repair(self):
+        # Drop anything past the last complete abstract, e.g. after an interrupted update
+        n_documents = min(len(self._load("ends.bin", np.int64)), len(self._load("article_ids.bin", np.int64)))
+        for file_name, dtype in (("ends.bin", np.int64), ("article_ids.bin", np.int64)):
+            if os.path.exists(self._path(file_name)):
+                os.truncate(self._path(file_name), n_documents * np.dtype(dtype).itemsize)
+        ends = self._load("ends.bin", np.int64)
+        n_tokens = int(ends[-1]) if len(ends) > 0 else 0
+        if os.path.exists(self._path("tokens.bin")):
+            os.truncate(self._path("tokens.bin"), n_tokens * np.dtype(np.uint32).itemsize)
+        self._reload()
+
+    def _reload(self):
+        self.tokens = self._load("tokens.bin", np.uint32)
+        self.ends = self._load("ends.bin", np.int64)
+        self.article_ids = self._load("article_ids.bin", np.int64)
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __iter__(self):
+        vocabulary = self.vocabulary
+        start = 0
+        for end in self.ends:
+            yield [vocabulary[id] for id in self.tokens[start:end]]
+            start = end
+
+    def token_ids(self, index):
+        """
+        :param index: Position of an abstract in the corpus
+        :return: An array of the abstract's token ids
+        """
+        start = self.ends[index - 1] if index > 0 else 0
+        return self.tokens[start:self.ends[index]]
+
+    def _append(self, article_ids, documents):
+        new_tokens = [token for document in documents for token in document if token not in self.token_index]
+        with open(self._path("vocabulary.txt"), "a", encoding="utf-8") as file:
+            for token in dict.fromkeys(new_tokens):
+                self.token_index[token] = len(self.vocabulary)
+                self.vocabulary.append(token)
+                file.write(token + "\n")
+
+        offset = int(self.ends[-1]) if len(self.ends) > 0 else 0
+        ids = np.fromiter((self.token_index[token] for document in documents for token in document), dtype=np.uint32)
+        ends = offset + np.cumsum([len(document) for document in documents], dtype=np.int64)
+        # Tokens are written first, so an interrupted append leaves only tokens that _repair discards
+        with open(self._path("tokens.bin"), "ab") as file:
+            ids.tofile(file)
+        with open(self._path("ends.bin"), "ab") as file:
+            ends.tofile(file)
+        with open(self._path("article_ids.bin"), "ab") as file:
+            np.asarray(article_ids, dtype=np.int64).tofile(file)
+        # The next batch continues from these ends
+        self._reload()
+
+    def update(self, session_object, batch_size=10000):
+        """
+        Tokenize and append the abstracts of articles that aren't in the corpus yet
+        :param session_object: A SQLAlchemy session object
+        :param batch_size: Number of abstracts read from the database and written per batch
+        :return: Number of abstracts added
+        """
+        added = 0
+        for batch in unseen_articles(session_object, self.article_ids,
+                                     [db.Article.abstract != "", db.Article.abstract != NO_ABSTRACT], batch_size):
+            self._append([article_id for (article_id, _) in batch],
+                         [self.tokenizer(abstract) for (_, abstract) in batch])
+            added += len(batch)
+        self._repair()
+        return added
+
+
+class PhrasedCorpus:
+    """
+    Restartable iterable applying a gensim Phrases/Phraser model to every abstract of a TokenCorpus
+    """
+    def __init__(self, token_corpus, phrases):
+        self.token_corpus = token_corpus
+        self.phrases = phrases
+
+    def __len__(self):
+        return len(self.token_corpus)
+
+    def __iter__(self):
+        for sentence in self.token_corpus:
+            yield self.phrases[sentence]
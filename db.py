@@ -1,10 +1,11 @@
-from sqlalchemy import Column, Integer, String, BigInteger, UniqueConstraint
+import logging
+from sqlalchemy import Column, Integer, String, BigInteger, Float, DateTime, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.schema import ForeignKey, Table
 from sqlalchemy_utils import LtreeType
 from sqlalchemy import Index
 from sqlalchemy.orm import relationship, remote, foreign, backref
-from sqlalchemy import func
+from sqlalchemy import func, inspect
 from sqlalchemy.sql.expression import cast, text
 
 Base = declarative_base()
@@ -15,13 +16,13 @@ Base = declarative_base()
 author_article_association = Table("author_article_association",
                                    Base.metadata,
                                    Column("author_id", BigInteger, ForeignKey("authors.id")),
-                                   Column("article_id", BigInteger, ForeignKey("articles.id"))
+                                   Column("article_id", BigInteger, ForeignKey("articles.id"), index=True)
                                    )
 
 keyword_article_association = Table("keyword_article_association",
                                     Base.metadata,
                                     Column("keyword_id", BigInteger, ForeignKey("keywords.id")),
-                                    Column("article_id", BigInteger, ForeignKey("articles.id"))
+                                    Column("article_id", BigInteger, ForeignKey("articles.id"), index=True)
                                     )
 
 class Venue(Base):
@@ -116,7 +117,7 @@ class Author(Base):
 class CitationChain(Base):
     __tablename__ = 'citations'
 
-    id_of_citing = Column(BigInteger, ForeignKey("articles.id"), nullable=False)
+    id_of_citing = Column(BigInteger, ForeignKey("articles.id"), nullable=False, index=True)
     citation_chain = Column(LtreeType, primary_key=True)
     corresp_article = relationship(
         'Article',
@@ -129,8 +130,8 @@ class CitationChain(Base):
         viewonly=True
     )
 
-    __tableargs__ = (
-        Index('ix_citations_citation_chain', citation_chain, postgresql_using="gist")
+    __table_args__ = (
+        Index('ix_citations_citation_chain', citation_chain, postgresql_using="gist"),
     )
 
     def __str__(self):
@@ -140,6 +141,182 @@ class CitationChain(Base):
         return 'CitationChain(' + str(self.corresp_article) + ": " + str(self.citation_chain) + ")"
 
 
+class CitationEdge(Base):
+    """
+    One row per citation: the article citing_id cites cited_id. Unlike CitationChain, which holds
+    one row per root-to-node path, this table grows with the number of citations.
+    """
+    __tablename__ = 'citation_edges'
+
+    citing_id = Column(BigInteger, ForeignKey("articles.id"), primary_key=True)
+    cited_id = Column(BigInteger, ForeignKey("articles.id"), primary_key=True)
+
+    __table_args__ = (
+        Index('ix_citation_edges_citing_id', citing_id),
+        Index('ix_citation_edges_cited_id', cited_id),
+    )
+
+    def __str__(self):
+        return 'CitationEdge(' + str(self.citing_id) + " -> " + str(self.cited_id) + ")"
+
+    def __repr__(self):
+        return 'CitationEdge(' + str(self.citing_id) + " -> " + str(self.cited_id) + ")"
+
+
+class DescendantPair(Base):
+    """
+    One row per (ancestor, descendant, depth) found in the citation chains; used to keep the distinct
+    descendant counts in GenerationStats and ArticleStats up to date as chains are added
+    """
+    __tablename__ = 'descendant_pairs'
+
+    ancestor_id = Column(BigInteger, primary_key=True)
+    descendant_id = Column(BigInteger, primary_key=True)
+    depth = Column(Integer, primary_key=True)
+
+
+class GenerationStats(Base):
+    """
+    Citation statistics for one generation (depth) of an article's descendants: the number of citation
+    paths, the number of distinct descendants, and the first and last year of those descendants
+    """
+    __tablename__ = 'generation_stats'
+
+    article_id = Column(BigInteger, ForeignKey("articles.id"), primary_key=True)
+    depth = Column(Integer, primary_key=True)
+    paths = Column(BigInteger, nullable=False)
+    descendants = Column(BigInteger, nullable=False)
+    first_year = Column(Integer)
+    last_year = Column(Integer)
+
+    def __repr__(self):
+        return 'GenerationStats(' + str(self.article_id) + ", depth " + str(self.depth) + ": " + \
+               str(self.descendants) + " descendants)"
+
+
+class ArticleStats(Base):
+    """
+    Citation statistics over all of an article's descendants, whatever their depth
+    """
+    __tablename__ = 'article_stats'
+
+    article_id = Column(BigInteger, ForeignKey("articles.id"), primary_key=True)
+    paths = Column(BigInteger, nullable=False)
+    descendants = Column(BigInteger, nullable=False)
+    max_depth = Column(Integer, nullable=False)
+    first_year = Column(Integer)
+    last_year = Column(Integer)
+
+    def __repr__(self):
+        return 'ArticleStats(' + str(self.article_id) + ": " + str(self.descendants) + " descendants)"
+
+
+class FrontierHandle(Base):
+    """
+    One row per handle waiting to be scraped (see frontier.Frontier). Handles are taken in order of
+    priority, then of insertion; by default the priority is the depth, so the crawl is breadth-first.
+    When several workers share the frontier, a handle taken by one is leased to it until lease_expires.
+    """
+    __tablename__ = 'frontier'
+
+    id = Column(BigInteger, primary_key=True)
+    handle = Column(String, nullable=False, unique=True)
+    depth = Column(Integer, nullable=False)
+    priority = Column(Float, nullable=False)
+    leased_by = Column(String)
+    lease_expires = Column(DateTime(timezone=True))
+
+    __table_args__ = (
+        Index('ix_frontier_priority_id', priority, id),
+    )
+
+    def __repr__(self):
+        return 'FrontierHandle(' + self.handle + ", priority " + str(self.priority) + ")"
+
+
+class FrontierChain(Base):
+    """
+    The citation chains a queued handle was reached by, as dot-separated article ids ('' for a seed)
+    """
+    __tablename__ = 'frontier_chains'
+
+    handle = Column(String, primary_key=True)
+    citation_chain = Column(String, primary_key=True)
+
+
+class HostRateLimit(Base):
+    """
+    Request rate of one upstream host, shared by every worker process (see worker.DatabaseRateLimiter):
+    the earliest time the next request may be made, by the database clock
+    """
+    __tablename__ = 'host_rate_limits'
+
+    host = Column(String, primary_key=True)
+    seconds_between_requests = Column(Float, nullable=False)
+    next_request_at = Column(DateTime(timezone=True), nullable=False)
+
+    def __repr__(self):
+        return 'HostRateLimit(' + self.host + ", every " + str(self.seconds_between_requests) + " seconds)"
+
+
+def citation_edge_from_chain(citation_chain_list):
+    """
+    :param citation_chain_list: A citation chain, e.g. [1, 10, 12]
+    :return: A (citing_id, cited_id) tuple for the chain's last link, or None for a root chain
+    """
+    if len(citation_chain_list) < 2:
+        return None
+    return citation_chain_list[-1], citation_chain_list[-2]
+
+
+# The edge of the last link of every citation chain, as citation_edge_from_chain gives it
+BACKFILL_EDGES_SQL = text("insert into citation_edges (citing_id, cited_id) "
+                          "select distinct ltree2text(subpath(citation_chain, -1))::bigint, "
+                          "ltree2text(subpath(citation_chain, -2, 1))::bigint "
+                          "from citations where nlevel(citation_chain) > 1 "
+                          "on conflict do nothing;")
+
+# True for a database scraped before citation_edges existed
+NEEDS_EDGE_BACKFILL_SQL = text("select not exists (select 1 from citation_edges) "
+                               "and exists (select 1 from citations where nlevel(citation_chain) > 1);")
+
+
+def backfill_citation_edges(session):
+    """
+    Fill citation_edges from the last link of every row in the citations table
+    """
+    session.execute(BACKFILL_EDGES_SQL)
+    session.commit()
+
+
+def migrate(engine):
+    """
+    Bring a database up to date with the definitions above: create the ltree extension, any
+    missing tables, and any missing nullable columns and indexes on existing tables (which
+    create_all skips). If citation_edges is empty while citations isn't, it is backfilled from the
+    citation chains. Safe to run on every start.
+    :param engine: A SQLAlchemy engine
+    """
+    with engine.begin() as connection:
+        connection.execute(text("create extension if not exists ltree;"))
+    Base.metadata.create_all(engine)
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            # Only checked first, since altering a table locks it against the scraper's queries
+            if column.name not in existing and column.nullable:
+                with engine.begin() as connection:
+                    connection.execute(text("alter table " + table.name + " add column " + column.name + " " +
+                                            column.type.compile(dialect=engine.dialect) + ";"))
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+    with engine.begin() as connection:
+        if connection.execute(NEEDS_EDGE_BACKFILL_SQL).scalar():
+            logging.info("Backfilling citation_edges from the citations table")
+            connection.execute(BACKFILL_EDGES_SQL)
+
+
 def latest_article_id(session):
     latest_entry = session.query(Article).order_by(Article.id.desc()).first()
     if latest_entry is None:
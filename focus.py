@@ -0,0 +1,114 @@
+from metrics import registry as metrics
+from terms import RATES_TERMS, TermMatcher
+
+
+class FocusedCrawl:
+    """
+    Relevance scores for a focused crawl, and a tally of how much of the crawl went to relevant articles.
+
+    An article's score is the number of rates terms (see terms.TermMatcher) in its title, abstract and
+    keywords. A citing handle found on CitEc has no RePEc page yet, so it is scored from the text CitEc
+    gives for it plus a share (inherit) of the score of the article it cites: papers citing an on-topic
+    paper tend to be on-topic too. Handles are queued with priority depth / (1 + score), so relevant
+    branches are expanded before shallower irrelevant ones while the max_links budget lasts.
+
+    Irrelevant articles are still expanded up to prune_depth citations below the last relevant article
+    (or seed) in their chain, since on-topic papers are sometimes only reachable through off-topic ones;
+    beyond that, their citations aren't followed at all.
+    """
+    def __init__(self, matcher=None, min_score=1, prune_depth=2, inherit=0.5):
+        """
+        :param matcher: Optional terms.TermMatcher; defaults to one for terms.RATES_TERMS
+        :param min_score: Score from which an article counts as relevant
+        :param prune_depth: Number of irrelevant articles in a row a chain may have and still be expanded
+        :param inherit: Share of an article's score passed on to the handles citing it
+        """
+        self.matcher = TermMatcher(RATES_TERMS) if matcher is None else matcher
+        self.min_score = min_score
+        self.prune_depth = prune_depth
+        self.inherit = inherit
+        self.scraped = 0
+        self.relevant = 0
+        self.pruned = 0
+        # Article id -> number of irrelevant articles at the end of its chain, for the articles scored so far
+        self.irrelevant_hops = dict()
+
+    def text_score(self, text):
+        return int(self.matcher.count(text).sum())
+
+    def article_score(self, article):
+        """
+        :param article: A dict from scraper.extract_article
+        """
+        return self.text_score(" ".join([article.get("title", ""), article.get("abstract", "")] +
+                                        article.get("keywords", [])))
+
+    def is_relevant(self, score):
+        return score >= self.min_score
+
+    def _parent_hops(self, citation_chain):
+        # Seeds, and articles scraped before this crawl started, count as relevant
+        return self.irrelevant_hops.get(citation_chain[-1], 0) if citation_chain else 0
+
+    def remap_ids(self, remap):
+        """
+        See writer.BatchWriter.remap_listeners
+        :param remap: A dict of old article id -> new article id
+        """
+        for (old_id, new_id) in remap.items():
+            if old_id in self.irrelevant_hops:
+                self.irrelevant_hops[new_id] = self.irrelevant_hops.pop(old_id)
+
+    def may_prune(self, citation_chain):
+        """
+        :param citation_chain: The chain a handle is queued with (ending with the id of the article it cites)
+        :return: True if the handle's citations won't be followed unless it turns out to be relevant
+        """
+        return self._parent_hops(citation_chain) + 1 > self.prune_depth
+
+    def prune(self, citation_chain, score):
+        """
+        :param citation_chain: The chain of a scraped article, ending with its own id
+        :return: True if the citations of the article shouldn't be followed
+        """
+        hops = 0 if self.is_relevant(score) else self._parent_hops(citation_chain[:-1]) + 1
+        self.irrelevant_hops[citation_chain[-1]] = hops
+        if hops > self.prune_depth:
+            self.pruned += 1
+            metrics.inc("focused_pruned")
+            return True
+        return False
+
+    def priority(self, depth, score):
+        return depth / (1.0 + score)
+
+    def rank(self, entries, depth, parent_score):
+        """
+        :param entries: A list of (citing handle, CitEc text) tuples, see scraper.parse_citec_entries
+        :param depth: Depth of the citing handles
+        :param parent_score: Score of the article they cite
+        :return: A list of (citing handle, frontier priority) tuples, best first
+        """
+        if not entries:
+            return []
+        scores = self.matcher.count_matrix([text for (_, text) in entries]).sum(axis=1) + self.inherit * parent_score
+        ranked = [(handle, self.priority(depth, float(score))) for ((handle, _), score) in zip(entries, scores)]
+        return sorted(ranked, key=lambda entry: entry[1])
+
+    def record(self, score):
+        """
+        Count a scraped article towards the crawl's budget
+        """
+        self.scraped += 1
+        relevant = self.is_relevant(score)
+        if relevant:
+            self.relevant += 1
+        metrics.inc("focused_articles", relevant=str(relevant).lower())
+
+    def relevant_share(self):
+        return self.relevant / self.scraped if self.scraped else 0.0
+
+    def summary(self):
+        return ("Focused crawl: " + str(self.relevant) + " of " + str(self.scraped) + " scraped articles relevant (" +
+                str(round(100 * self.relevant_share(), 1)) + "%), citations of " + str(self.pruned) +
+                " irrelevant articles pruned")
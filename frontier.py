@@ -0,0 +1,236 @@
+import logging
+import time
+from collections import namedtuple
+from datetime import timedelta
+from sqlalchemy import event, func, or_, select, tuple_
+from sqlalchemy.dialects.postgresql import insert
+import db
+from metrics import registry as metrics
+from writer import build_ltree
+
+# Maximum number of rows per INSERT statement
+WRITE_CHUNK_SIZE = 5000
+
+# A handle taken from the frontier, with every citation chain it was queued with (shortest first)
+FrontierItem = namedtuple("FrontierItem", "handle citation_chains")
+
+
+def parse_chain(citation_chain):
+    return [int(id) for id in citation_chain.split(".")] if citation_chain else []
+
+
+class Frontier:
+    """
+    Crawl queue stored in the frontier and frontier_chains tables, written through the scraper's own
+    session. Nothing is committed here: queued handles and finished items are written to the session
+    just before its next commit (i.e. the BatchWriter's), so an item leaves the frontier in the same
+    transaction as the articles and chains written for it, and a crash loses nothing.
+
+    Each handle is queued once, however many chains lead to it; the chains are kept alongside, and the
+    handle takes the lowest priority (by default, the depth) it was queued with.
+
+    With a worker_id, the frontier is shared by several worker processes: take() claims handles in a
+    transaction of its own, with SELECT ... FOR UPDATE SKIP LOCKED so workers never wait for each other
+    or get the same handles, and leases them to the worker for lease_seconds. Finishing a handle ends
+    its lease; handles whose lease ran out (e.g. because their worker crashed) are claimed again.
+    """
+    def __init__(self, db_session, worker_id=None, lease_seconds=600):
+        """
+        :param worker_id: Name of this worker, if the frontier is shared with other workers
+        :param lease_seconds: How long a worker may hold handles it took before others can claim them
+        """
+        self.db_session = db_session
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.pending = dict()
+        self.finished = []
+        self.in_flight = set()
+        self.renewed_at = 0
+        event.listen(db_session, "before_commit", self._before_commit)
+
+    def _before_commit(self, session):
+        self.write_pending()
+
+    def put(self, item, priority=None):
+        """
+        Queue a handle with one citation chain
+        :param item: A scraper.ArticleInfo(handle, citation_chain)
+        :param priority: Handles with lower priority are taken first; defaults to the chain's length (depth)
+        """
+        depth = len(item.citation_chain)
+        priority = depth if priority is None else priority
+        entry = self.pending.get(item.handle)
+        if entry is None:
+            self.pending[item.handle] = [priority, depth, {build_ltree(item.citation_chain)}]
+        else:
+            entry[0] = min(entry[0], priority)
+            entry[1] = min(entry[1], depth)
+            entry[2].add(build_ltree(item.citation_chain))
+
+    def put_many(self, items, priority=None):
+        for item in items:
+            self.put(item, priority)
+
+    def remap_ids(self, remap):
+        """
+        Replace article ids in the chains of queued handles, see writer.BatchWriter.remap_listeners
+        :param remap: A dict of old id -> new id
+        """
+        for entry in self.pending.values():
+            entry[2] = {build_ltree([remap.get(id, id) for id in parse_chain(chain)]) for chain in entry[2]}
+
+    def write_pending(self):
+        """
+        Write the queued handles and finished items to the session, without committing
+        """
+        if self.pending:
+            frontier_table = db.FrontierHandle.__table__
+            # Sorted, so that workers writing overlapping handles lock their rows in the same order
+            handle_rows = [{"handle": handle, "priority": priority, "depth": depth}
+                           for (handle, (priority, depth, _)) in sorted(self.pending.items())]
+            chain_rows = [{"handle": handle, "citation_chain": chain}
+                          for (handle, (_, _, chains)) in sorted(self.pending.items()) for chain in sorted(chains)]
+            # In chunks, to stay below the limit on parameters per statement
+            for start in range(0, len(handle_rows), WRITE_CHUNK_SIZE):
+                statement = insert(frontier_table).values(handle_rows[start:start + WRITE_CHUNK_SIZE])
+                self.db_session.execute(statement.on_conflict_do_update(
+                    index_elements=["handle"],
+                    set_={"priority": func.least(frontier_table.c.priority, statement.excluded.priority),
+                          "depth": func.least(frontier_table.c.depth, statement.excluded.depth)}))
+            for start in range(0, len(chain_rows), WRITE_CHUNK_SIZE):
+                self.db_session.execute(insert(db.FrontierChain.__table__)
+                                        .values(chain_rows[start:start + WRITE_CHUNK_SIZE])
+                                        .on_conflict_do_nothing())
+            self.pending = dict()
+        if self.finished:
+            # Only the chains that were processed are removed: a handle queued again while it was in flight
+            # stays in the frontier with its new chains
+            processed = [(item.handle, build_ltree(chain)) for item in self.finished for chain in item.citation_chains]
+            self.db_session.execute(db.FrontierChain.__table__.delete()
+                                    .where(tuple_(db.FrontierChain.handle, db.FrontierChain.citation_chain)
+                                           .in_(processed)))
+            remaining = select([db.FrontierChain.handle]).where(db.FrontierChain.handle == db.FrontierHandle.handle)
+            finished_handles = [item.handle for item in self.finished]
+            self.db_session.execute(db.FrontierHandle.__table__.delete()
+                                    .where(db.FrontierHandle.handle.in_(finished_handles))
+                                    .where(~remaining.exists()))
+            if self.worker_id is not None:
+                # Handles queued again by another worker while leased to this one can be claimed at once
+                self.db_session.execute(db.FrontierHandle.__table__.update()
+                                        .where(db.FrontierHandle.handle.in_(finished_handles))
+                                        .where(db.FrontierHandle.leased_by == self.worker_id)
+                                        .values(leased_by=None, lease_expires=None))
+            self.finished = []
+
+    def __len__(self):
+        """
+        :return: Number of handles waiting, not counting those taken but not yet finished
+        """
+        self.write_pending()
+        return self.db_session.query(func.count(db.FrontierHandle.id)).scalar() - len(self.in_flight)
+
+    def empty(self):
+        return len(self) == 0
+
+    def take(self, n):
+        """
+        Take the n handles with the lowest priority. They stay in the frontier until finish() is called
+        for them and the session is committed.
+        :return: A list of FrontierItem tuples
+        """
+        self.write_pending()
+        if self.worker_id is not None:
+            handles = self._claim(n)
+        else:
+            handles = [handle for (handle,) in self.db_session.query(db.FrontierHandle.handle)
+                       .filter(db.FrontierHandle.handle.notin_(self.in_flight))
+                       .order_by(db.FrontierHandle.priority, db.FrontierHandle.id)
+                       .limit(n)]
+        chains = dict()
+        for (handle, chain) in self.db_session.query(db.FrontierChain.handle, db.FrontierChain.citation_chain) \
+                .filter(db.FrontierChain.handle.in_(handles)):
+            chains.setdefault(handle, []).append(parse_chain(chain))
+        self.in_flight.update(handles)
+        return [FrontierItem(handle, sorted(chains.get(handle, [[]]), key=lambda chain: (len(chain), chain)))
+                for handle in handles]
+
+    def claim_statement(self, n):
+        """
+        :return: An UPDATE leasing the n unleased (or expired) handles with the lowest priority to this worker,
+        returning their handle, priority, id and previous holder
+        """
+        frontier_table = db.FrontierHandle.__table__
+        now = func.clock_timestamp()
+        claimable = (select([frontier_table.c.id, frontier_table.c.leased_by.label("previous_worker")])
+                     .where(or_(frontier_table.c.lease_expires.is_(None), frontier_table.c.lease_expires < now))
+                     .order_by(frontier_table.c.priority, frontier_table.c.id)
+                     .limit(n)
+                     .with_for_update(skip_locked=True)
+                     .subquery())
+        return (frontier_table.update()
+                .where(frontier_table.c.id == claimable.c.id)
+                .values(leased_by=self.worker_id, lease_expires=now + timedelta(seconds=self.lease_seconds))
+                .returning(frontier_table.c.handle, frontier_table.c.priority, frontier_table.c.id,
+                           claimable.c.previous_worker))
+
+    def _claim(self, n):
+        # Committed straight away, in a transaction of its own, so other workers see the leases
+        with self.db_session.get_bind().begin() as connection:
+            rows = connection.execute(self.claim_statement(n)).fetchall()
+        self.renewed_at = time.monotonic()
+        reclaimed = [handle for (handle, _, _, previous_worker) in rows if previous_worker is not None]
+        if reclaimed:
+            logging.warning("Reclaimed " + str(len(reclaimed)) + " handles whose lease expired, e.g. " + reclaimed[0])
+            metrics.inc("frontier_reclaimed", len(reclaimed))
+        return [handle for (handle, _, _, _) in sorted(rows, key=lambda row: (row[1], row[2]))]
+
+    def renew_leases(self):
+        """
+        Extend the leases of the handles this worker took and hasn't committed yet. Cheap to call often:
+        the database is only updated once a third of lease_seconds has passed since the last renewal.
+        May be called from other threads (see worker.DatabaseRateLimiter.heartbeats).
+        :return: Number of leases extended
+        """
+        if self.worker_id is None or time.monotonic() - self.renewed_at < self.lease_seconds / 3:
+            return 0
+        # Finished handles stay leased until the commit that removes them from the frontier
+        handles = self.in_flight.copy() | {item.handle for item in list(self.finished)}
+        self.renewed_at = time.monotonic()
+        if not handles:
+            return 0
+        frontier_table = db.FrontierHandle.__table__
+        with self.db_session.get_bind().begin() as connection:
+            result = connection.execute(frontier_table.update()
+                                        .where(frontier_table.c.leased_by == self.worker_id)
+                                        .where(frontier_table.c.handle.in_(list(handles)))
+                                        .values(lease_expires=func.clock_timestamp() +
+                                                timedelta(seconds=self.lease_seconds)))
+        return result.rowcount
+
+    def release_leases(self):
+        """
+        End every lease held by this worker's id, e.g. ones left by an earlier run that crashed
+        :return: Number of handles released
+        """
+        frontier_table = db.FrontierHandle.__table__
+        with self.db_session.get_bind().begin() as connection:
+            result = connection.execute(frontier_table.update()
+                                        .where(frontier_table.c.leased_by == self.worker_id)
+                                        .values(leased_by=None, lease_expires=None))
+        self.in_flight = set()
+        return result.rowcount
+
+    def finish(self, item):
+        """
+        Remove a taken item (and the chains it was taken with) from the frontier, at the next commit
+        """
+        self.finished.append(item)
+        self.in_flight.discard(item.handle)
+
+    def clear(self):
+        self.pending = dict()
+        self.finished = []
+        self.in_flight = set()
+        self.db_session.execute(db.FrontierChain.__table__.delete())
+        self.db_session.execute(db.FrontierHandle.__table__.delete())
+        logging.info("Cleared the crawl frontier")
@@ -0,0 +1,271 @@
+import json
+import os
+import numpy as np
+from sqlalchemy import func
+import db
+
+# Arrays saved by CitationGraph.save, each under path + "." + name + ".npy"
+ARRAY_NAMES = ["ids", "indptr", "indices", "reverse_indptr", "reverse_indices", "handle_bytes", "handle_ends"]
+
+
+def build_csr(sources, targets, n_nodes):
+    """
+    :param sources: Array of node indexes, one per edge
+    :param targets: Array of node indexes, one per edge
+    :param n_nodes: Number of nodes
+    :return: (indptr, indices) arrays; the targets of node i are indices[indptr[i]:indptr[i + 1]], sorted
+    """
+    # One sort on a combined key is much faster than np.lexsort on the two columns
+    order = np.argsort(sources.astype(np.int64) * n_nodes + targets)
+    indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=n_nodes), out=indptr[1:])
+    return indptr, targets[order].astype(np.int32)
+
+
+def gather(indptr, indices, nodes):
+    """
+    :return: The concatenated neighbours of every node in nodes, without a Python loop over the nodes
+    """
+    starts = indptr[nodes]
+    counts = indptr[nodes + 1] - starts
+    total = int(counts.sum())
+    if total == 0:
+        return np.zeros(0, dtype=indices.dtype)
+    # Position of each gathered edge: its node's start, plus its offset within that node's range
+    offsets = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(total)
+    return indices[offsets]
+
+
+class CitationGraph:
+    """
+    The citation_edges table held in memory as two CSR (compressed sparse row) adjacency structures over
+    node indexes 0..n-1, where node i is the article with id ids[i] (ids is sorted):
+      indptr/indices                 - cited -> citing, i.e. towards descendants
+      reverse_indptr/reverse_indices - citing -> cited, i.e. towards ancestors
+    Handles are kept as one UTF-8 byte array with end offsets, so every part of the graph is a NumPy
+    array that can be saved as .npy and memory-mapped back. Each direction takes 4 bytes per edge plus 8 bytes per article.
+    """
+    def __init__(self, ids, indptr, indices, reverse_indptr, reverse_indices, handle_bytes, handle_ends):
+        self.ids = ids
+        self.indptr = indptr
+        self.indices = indices
+        self.reverse_indptr = reverse_indptr
+        self.reverse_indices = reverse_indices
+        self.handle_bytes = handle_bytes
+        self.handle_ends = handle_ends
+        self._handle_index = None
+
+    @classmethod
+    def from_edges(cls, citing_ids, cited_ids, articles=()):
+        """
+        :param citing_ids: Array of the citing article id of each edge
+        :param cited_ids: Array of the cited article id of each edge
+        :param articles: Iterable of (id, handle) pairs; articles without edges are added as isolated nodes
+        :return: A CitationGraph object
+        """
+        citing_ids = np.asarray(citing_ids, dtype=np.int64)
+        cited_ids = np.asarray(cited_ids, dtype=np.int64)
+        handles = dict(articles)
+        article_ids = np.fromiter(handles.keys(), dtype=np.int64, count=len(handles))
+        ids, inverse = np.unique(np.concatenate([article_ids, citing_ids, cited_ids]), return_inverse=True)
+        citing = inverse[len(article_ids):len(article_ids) + len(citing_ids)]
+        cited = inverse[len(article_ids) + len(citing_ids):]
+        indptr, indices = build_csr(cited, citing, len(ids))
+        reverse_indptr, reverse_indices = build_csr(citing, cited, len(ids))
+        encoded = [handles.get(int(id), "").encode("utf-8") for id in ids]
+        handle_bytes = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        handle_ends = np.cumsum([len(handle) for handle in encoded], dtype=np.int64)
+        return cls(ids, indptr, indices, reverse_indptr, reverse_indices, handle_bytes, handle_ends)
+
+    @classmethod
+    def from_database(cls, session_object, chunk_size=1000000):
+        """
+        Load every row of the citation_edges table, and the handle of every article
+        :param session_object: A SQLAlchemy session object
+        :param chunk_size: Number of rows read from the server-side cursor at a time
+        :return: A CitationGraph object
+        """
+        connection = session_object.connection().execution_options(stream_results=True)
+        edges = connection.execute(db.CitationEdge.__table__.select()
+                                   .with_only_columns([db.CitationEdge.citing_id, db.CitationEdge.cited_id]))
+        blocks = []
+        while True:
+            rows = edges.fetchmany(chunk_size)
+            if not rows:
+                break
+            blocks.append(np.array(rows, dtype=np.int64).reshape(-1, 2))
+        edges.close()
+        edge_array = np.concatenate(blocks) if blocks else np.zeros((0, 2), dtype=np.int64)
+        articles = session_object.query(db.Article.id, db.Article.handle).yield_per(chunk_size)
+        return cls.from_edges(edge_array[:, 0], edge_array[:, 1], articles)
+
+    @staticmethod
+    def database_version(session_object):
+        """
+        :return: A dict that changes whenever edges or articles are added, to tell whether a saved graph is stale
+        """
+        n_edges = session_object.query(func.count()).select_from(db.CitationEdge).scalar()
+        return {"edges": n_edges, "latest_article_id": db.latest_article_id(session_object)}
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        :param path: Path prefix the graph was saved under
+        """
+        return cls(*[np.load(path + "." + name + ".npy", mmap_mode=mmap_mode) for name in ARRAY_NAMES])
+
+    def save(self, path, version=None):
+        for name in ARRAY_NAMES:
+            np.save(path + "." + name + ".npy", np.asarray(getattr(self, name)))
+        if version is not None:
+            with open(path + ".version.json", "w") as file:
+                json.dump(version, file)
+
+    @classmethod
+    def cached(cls, session_object, path):
+        """
+        Load the graph saved under path, rebuilding and saving it first if the database has changed since
+        :param session_object: A SQLAlchemy session object
+        :param path: Path prefix of the saved graph, e.g. settings.CACHE_LOCATION + "citation_graph"
+        :return: A CitationGraph object
+        """
+        version = cls.database_version(session_object)
+        if os.path.exists(path + ".version.json"):
+            with open(path + ".version.json") as file:
+                if json.load(file) == version:
+                    return cls.load(path)
+        cls.from_database(session_object).save(path, version)
+        return cls.load(path)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def n_edges(self):
+        return len(self.indices)
+
+    def index_of(self, article_ids):
+        """
+        :param article_ids: An article id or array of article ids
+        :return: The node index (or array of node indexes) of the articles
+        """
+        article_ids = np.asarray(article_ids, dtype=np.int64)
+        indexes = np.searchsorted(self.ids, article_ids)
+        if np.any(indexes >= len(self.ids)) or np.any(self.ids[np.minimum(indexes, len(self.ids) - 1)] != article_ids):
+            raise KeyError("Article id not in citation graph")
+        return indexes
+
+    def handle(self, index):
+        end = self.handle_ends[index]
+        start = self.handle_ends[index - 1] if index > 0 else 0
+        return bytes(self.handle_bytes[start:end]).decode("utf-8")
+
+    def handles(self, indexes):
+        return [self.handle(index) for index in indexes]
+
+    def index_of_handle(self, handle):
+        if self._handle_index is None:
+            self._handle_index = {self.handle(index): index for index in range(len(self.ids))}
+        return self._handle_index[handle]
+
+    def _adjacency(self, direction):
+        if direction == "descendants":
+            return self.indptr, self.indices
+        elif direction == "ancestors":
+            return self.reverse_indptr, self.reverse_indices
+        else:
+            raise ValueError("Unknown direction " + str(direction))
+
+    def bfs(self, sources, max_depth=None, direction="descendants"):
+        """
+        Breadth-first search from one or more nodes, one vectorized step per generation
+        :param sources: A node index or array of node indexes
+        :param max_depth: Number of generations to follow; all if None
+        :param direction: "descendants" follows citing articles, "ancestors" follows cited articles
+        :return: An array with the depth of every node, or -1 for nodes that weren't reached
+        """
+        indptr, indices = self._adjacency(direction)
+        depths = np.full(len(self.ids), -1, dtype=np.int32)
+        frontier = np.unique(np.asarray(sources, dtype=np.int64))
+        depths[frontier] = 0
+        depth = 0
+        while len(frontier) > 0 and (max_depth is None or depth < max_depth):
+            depth += 1
+            neighbours = gather(indptr, indices, frontier)
+            frontier = np.unique(neighbours[depths[neighbours] < 0])
+            depths[frontier] = depth
+        return depths
+
+    def k_hop(self, sources, k, direction="descendants"):
+        """
+        :return: A sorted array of the node indexes between 1 and k generations away from the sources
+        """
+        depths = self.bfs(sources, k, direction)
+        return np.flatnonzero(depths > 0)
+
+    def shortest_path(self, source, target, direction="descendants"):
+        """
+        :param source: Node index to start from, e.g. a seed paper
+        :param target: Node index to reach, e.g. one of its descendants
+        :return: A list of node indexes from source to target, or None if target can't be reached
+        """
+        indptr, indices = self._adjacency(direction)
+        parents = np.full(len(self.ids), -1, dtype=np.int64)
+        parents[source] = source
+        frontier = np.array([source], dtype=np.int64)
+        while len(frontier) > 0 and parents[target] < 0:
+            counts = indptr[frontier + 1] - indptr[frontier]
+            neighbours = gather(indptr, indices, frontier)
+            origins = np.repeat(frontier, counts)
+            new = parents[neighbours] < 0
+            # np.unique keeps the first occurrence, so each new node gets a single parent
+            frontier, first = np.unique(neighbours[new], return_index=True)
+            parents[frontier] = origins[new][first]
+        if parents[target] < 0:
+            return None
+        path = [int(target)]
+        while path[-1] != source:
+            path.append(int(parents[path[-1]]))
+        return path[::-1]
+
+    def common_ancestors(self, first, second):
+        """
+        :return: A sorted array of the node indexes that both nodes descend from
+        """
+        return np.flatnonzero((self.bfs(first, direction="ancestors") > 0) &
+                              (self.bfs(second, direction="ancestors") > 0))
+
+    def pagerank(self, damping=0.85, tolerance=1e-10, max_iterations=100):
+        """
+        PageRank by power iteration, with each article passing its rank on to the articles it cites.
+        Articles that cite nothing in the graph spread their rank evenly over every article.
+        :return: An array with the PageRank of every node, summing to 1
+        """
+        n = len(self.ids)
+        if n == 0:
+            return np.zeros(0)
+        out_degree = np.diff(self.reverse_indptr)
+        citing = np.repeat(np.arange(n), out_degree)
+        dangling = out_degree == 0
+        rank = np.full(n, 1.0 / n)
+        for _ in range(max_iterations):
+            shares = np.where(dangling, 0.0, rank / np.maximum(out_degree, 1))
+            updated = np.bincount(self.reverse_indices, weights=shares[citing], minlength=n)
+            updated = damping * (updated + rank[dangling].sum() / n) + (1 - damping) / n
+            converged = np.abs(updated - rank).sum() < tolerance
+            rank = updated
+            if converged:
+                break
+        return rank
+
+    def co_citations(self, node):
+        """
+        Co-citation counts: how many articles cite both this node and each other node
+        :return: (node indexes, counts) arrays, sorted by descending count
+        """
+        citing = gather(self.indptr, self.indices, np.array([node], dtype=np.int64))
+        cited_together = gather(self.reverse_indptr, self.reverse_indices, citing)
+        cited_together = cited_together[cited_together != node]
+        nodes, counts = np.unique(cited_together, return_counts=True)
+        order = np.argsort(-counts, kind="stable")
+        return nodes[order], counts[order]
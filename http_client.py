@@ -0,0 +1,190 @@
+import email.utils
+import logging
+import random
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+import settings
+from metrics import registry as metrics
+
+# Outcomes of a request, see classify()
+OK = "ok"
+NOT_MODIFIED = "not_modified"
+PERMANENT = "permanent"
+THROTTLED = "throttled"
+BLOCKED = "blocked"
+TRANSIENT = "transient"
+
+PERMANENT_STATUSES = {400, 404, 410, 414, 451}
+BLOCKED_STATUSES = {401, 403}
+
+# CitEc answers 200 with an error string when it stops serving us; any error other than a missing document
+CITEC_BLOCK_PATTERN = re.compile(r"<errorString>(?!\s*Requested document not found\s*<)", re.IGNORECASE)
+
+# Seconds to back off after a block response without a Retry-After header
+BLOCK_BACKOFF = 15 * 60
+
+
+class HTTPFailure(IOError):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class PermanentHTTPError(HTTPFailure):
+    """
+    The server says the page doesn't exist (e.g. 404 or 410); requesting it again won't help
+    """
+    pass
+
+
+class BlockedError(HTTPFailure):
+    """
+    The server is still refusing requests after backing off
+    """
+    pass
+
+
+def classify(response, block_pattern=None):
+    """
+    :param response: A requests.Response object
+    :param block_pattern: Optional regex that marks a successful response as a block page
+    :return: One of OK, NOT_MODIFIED, PERMANENT, THROTTLED, BLOCKED or TRANSIENT
+    """
+    status = response.status_code
+    if status == 304:
+        return NOT_MODIFIED
+    if status in PERMANENT_STATUSES:
+        return PERMANENT
+    if status in BLOCKED_STATUSES:
+        return BLOCKED
+    if status == 429 or (status == 503 and "Retry-After" in response.headers):
+        return THROTTLED
+    if 200 <= status < 300:
+        if block_pattern is not None and block_pattern.search(response.text):
+            return BLOCKED
+        return OK
+    return TRANSIENT
+
+
+def retry_after(response):
+    """
+    :return: The number of seconds in the response's Retry-After header, or None
+    """
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HttpClient:
+    """
+    Shared HTTP layer for the scraper: one pooled keep-alive requests.Session per host, gzip transfer
+    encoding, optional conditional headers, and retries that depend on what went wrong:
+      - network errors and 5xx responses are retried with exponential backoff and jitter
+      - 429/503 responses and block pages pause the host's limiter (for Retry-After seconds if given),
+        so every thread requesting from that host backs off together, then are retried
+      - permanent failures (404, 410, ...) raise PermanentHTTPError at once
+    """
+    def __init__(self, pool_size=10, timeout=120, max_attempts=8, max_backoff=settings.WAIT_BEFORE_TIMEOUT,
+                 block_backoff=BLOCK_BACKOFF, max_blocks=3):
+        """
+        :param pool_size: Number of keep-alive connections kept per host
+        :param max_attempts: Number of attempts after network errors or 5xx responses before giving up
+        :param max_backoff: Longest wait between two attempts, in seconds
+        :param max_blocks: Number of consecutive throttle/block responses before raising BlockedError
+        """
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+        self.block_backoff = block_backoff
+        self.max_blocks = max_blocks
+        self.sessions = dict()
+        self.lock = threading.Lock()
+
+    def session(self, host):
+        with self.lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                session.headers.update(settings.HEADERS)
+                session.headers["Accept-Encoding"] = "gzip, deflate"
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.sessions[host] = session
+            return self.sessions[host]
+
+    def _backoff(self, attempt):
+        return min(self.max_backoff, 2 ** attempt) * random.uniform(0.5, 1)
+
+    def get(self, url, headers=None, limiter=None, block_pattern=None):
+        """
+        :param headers: Optional extra headers, e.g. If-None-Match for a conditional request
+        :param limiter: Optional cache.RateLimiter of the host, acquired before every attempt
+        :param block_pattern: Optional regex that marks a successful response as a block page
+        :return: A requests.Response with status 2xx or 304
+        """
+        host = urlsplit(url).netloc
+        session = self.session(host)
+        failures = 0
+        blocks = 0
+        while True:
+            if limiter is not None:
+                metrics.observe("rate_limit_wait_seconds", limiter.acquire(), host=host)
+            try:
+                with metrics.timer("fetch_seconds", host=host):
+                    response = session.get(url, headers=headers, timeout=self.timeout)
+            except requests.RequestException as e:
+                outcome = TRANSIENT
+                response = None
+                logging.warning("Request to " + url + " failed: " + str(e))
+            else:
+                outcome = classify(response, block_pattern)
+            metrics.inc("responses", host=host, outcome=outcome)
+
+            if outcome in (OK, NOT_MODIFIED):
+                logging.info("Request to " + url + " succeeded.")
+                return response
+            elif outcome == PERMANENT:
+                raise PermanentHTTPError("Request to " + url + " failed with status " + str(response.status_code),
+                                         response.status_code)
+            elif outcome in (THROTTLED, BLOCKED):
+                blocks += 1
+                if blocks > self.max_blocks:
+                    raise BlockedError("Still " + outcome + " after " + str(self.max_blocks) + " back-offs: " + url,
+                                       response.status_code)
+                delay = retry_after(response)
+                if delay is None:
+                    delay = self.block_backoff if outcome == BLOCKED else self._backoff(blocks + 4)
+                logging.warning("Request to " + url + " was " + outcome + ". Backing off for " +
+                                str(round(delay)) + " seconds...")
+                metrics.inc("retries", host=host, outcome=outcome)
+                if limiter is not None:
+                    limiter.pause(delay)
+                else:
+                    time.sleep(delay)
+            else:
+                failures += 1
+                if failures >= self.max_attempts:
+                    raise HTTPFailure("Giving up on " + url + " after " + str(failures) + " attempts",
+                                      None if response is None else response.status_code)
+                delay = self._backoff(failures)
+                metrics.inc("retries", host=host, outcome=outcome)
+                logging.warning("Waiting " + str(round(delay, 1)) + " seconds before trying again...")
+                if limiter is not None:
+                    limiter.sleep(delay)
+                else:
+                    time.sleep(delay)
+
+
+# Client shared by every DataCache
+default_client = HttpClient()
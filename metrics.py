@@ -0,0 +1,230 @@
+import bisect
+import contextlib
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.sum, "buckets": dict(zip([str(b) for b in BUCKETS] + ["+Inf"],
+                                                                          self.counts))}
+
+
+class _Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms of a crawl, keyed by name and labels (e.g. host="citec.repec.org").
+    While disabled, which is the default, every method returns straight away, so instrumented code
+    costs one attribute lookup and call per event.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.counters = dict()
+        self.gauges = dict()
+        self.histograms = dict()
+        self.started_at = time.time()
+        self.lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+        self.started_at = time.time()
+
+    def reset(self):
+        with self.lock:
+            self.counters = dict()
+            self.gauges = dict()
+            self.histograms = dict()
+            self.started_at = time.time()
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def timer(self, name, **labels):
+        """
+        :return: A context manager recording the time spent in its block in the named histogram
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def snapshot(self):
+        """
+        :return: A JSON-serializable dict of every metric
+        """
+        def entries(metrics, value):
+            return [{"name": name, "labels": dict(labels), "value": value(metric)}
+                    for ((name, labels), metric) in sorted(metrics.items())]
+        with self.lock:
+            return {"started_at": self.started_at,
+                    "elapsed_seconds": time.time() - self.started_at,
+                    "counters": entries(self.counters, lambda value: value),
+                    "gauges": entries(self.gauges, lambda value: value),
+                    "histograms": entries(self.histograms, Histogram.to_dict)}
+
+    def prometheus_text(self):
+        """
+        :return: Every metric in the Prometheus text exposition format, with names prefixed by quantcites_
+        """
+        def series(name, labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return "quantcites_" + name
+            return "quantcites_" + name + "{" + ",".join(k + '="' + str(v) + '"' for (k, v) in pairs) + "}"
+
+        lines = []
+        with self.lock:
+            for ((name, labels), value) in sorted(self.counters.items()):
+                lines.append(series(name + "_total", labels) + " " + str(value))
+            for ((name, labels), value) in sorted(self.gauges.items()):
+                lines.append(series(name, labels) + " " + str(value))
+            for ((name, labels), histogram) in sorted(self.histograms.items()):
+                cumulative = 0
+                for (bound, count) in zip([str(b) for b in BUCKETS] + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append(series(name + "_bucket", labels, [("le", bound)]) + " " + str(cumulative))
+                lines.append(series(name + "_sum", labels) + " " + str(histogram.sum))
+                lines.append(series(name + "_count", labels) + " " + str(histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """
+        Write every metric to a file: Prometheus text if path ends in .prom, JSON otherwise
+        """
+        content = self.prometheus_text() if path.endswith(".prom") else json.dumps(self.snapshot(), indent=1)
+        with open(path + ".tmp", "w") as file:
+            file.write(content)
+        # Replace the file in one step, so a scraper of the file never reads a partial write
+        os.replace(path + ".tmp", path)
+
+    def summary(self):
+        """
+        :return: A human-readable summary of the run, one metric per line
+        """
+        snapshot = self.snapshot()
+        lines = ["Crawl metrics after " + str(round(snapshot["elapsed_seconds"])) + " seconds:"]
+
+        def label_text(labels):
+            return "" if not labels else " (" + ", ".join(k + "=" + str(v) for (k, v) in labels.items()) + ")"
+        for entry in snapshot["counters"] + snapshot["gauges"]:
+            lines.append("  " + entry["name"] + label_text(entry["labels"]) + ": " + str(entry["value"]))
+        for entry in snapshot["histograms"]:
+            histogram = entry["value"]
+            mean = histogram["sum"] / histogram["count"] if histogram["count"] else 0.0
+            lines.append("  " + entry["name"] + label_text(entry["labels"]) + ": " + str(histogram["count"]) +
+                         " observations, " + str(round(histogram["sum"], 3)) + "s total, " +
+                         str(round(mean * 1000, 1)) + "ms mean")
+        return "\n".join(lines)
+
+
+class MetricsWriter:
+    """
+    Background thread writing the metrics to a file every interval seconds, and once more when stopped
+    """
+    def __init__(self, metrics, path, interval=60):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.metrics.write(self.path)
+            except OSError as e:
+                logging.warning("Couldn't write metrics to " + self.path + ": " + str(e))
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.metrics.write(self.path)
+
+
+@contextlib.contextmanager
+def profiled(path=None, top=30):
+    """
+    Run a block under cProfile. The statistics are saved to path (for pstats or snakeviz) if given,
+    and the top functions by cumulative time are logged either way.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if path is not None:
+            profiler.dump_stats(path)
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(top)
+        logging.info("Profile of the crawl:\n" + output.getvalue())
+
+
+# Registry shared by the scraper, cache and HTTP client; enabled by scrape_RePEc.py --metrics
+registry = Metrics()
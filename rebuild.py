@@ -0,0 +1,108 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+import cache
+import db
+import scraper
+import settings
+
+# DataCache used by each parse worker process, created by _init_worker
+_worker_cache = None
+
+
+def _init_worker(cache_location, storage_class):
+    global _worker_cache
+    storage = None if storage_class is None else storage_class(cache_location)
+    _worker_cache = cache.DataCache(cache_location, storage=storage, offline=True)
+
+
+def _parse_repec(handle):
+    return scraper.get_repec_data(_worker_cache, handle)
+
+
+def _parse_citec(handle):
+    return scraper.get_citec_entries(_worker_cache, handle)
+
+
+class ParsePoolFetcher(scraper.SerialFetcher):
+    """
+    Reads and parses cached RePEc/CitEc data in a pool of worker processes. Parsing for upcoming
+    queue items runs ahead of the scraper, which consumes the results (or the exceptions raised
+    while parsing) in queue order.
+    """
+    def __init__(self, cache_location, storage_class=None, processes=None):
+        super().__init__(None)
+        self.executor = ProcessPoolExecutor(max_workers=processes,
+                                            initializer=_init_worker,
+                                            initargs=(cache_location, storage_class))
+        self.pending = dict()
+
+    def _submit(self, source, handle):
+        if (source, handle) not in self.pending:
+            parse = _parse_repec if source == "repec" else _parse_citec
+            self.pending[(source, handle)] = self.executor.submit(parse, handle)
+
+    def _result(self, source, handle):
+        self._submit(source, handle)
+        return self.pending.pop((source, handle)).result()
+
+    def prefetch(self, handle):
+        self._submit("repec", handle)
+
+    def prefetch_cites(self, handle):
+        self._submit("citec", handle)
+
+    def discard_pending(self):
+        """
+        Cancel the parses the scraper didn't use (see scraper.ThreadedFetcher.discard_pending)
+        """
+        for future in self.pending.values():
+            future.cancel()
+        self.pending = dict()
+
+    def repec_data(self, handle):
+        return self._result("repec", handle)
+
+    def citec_cites(self, handle):
+        return [cite for (cite, _) in self._result("citec", handle)]
+
+    def citec_entries(self, handle):
+        return self._result("citec", handle)
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+def offline_rebuild(db_session,
+                    seed_handles,
+                    max_links=100,
+                    cache_location=settings.CACHE_LOCATION,
+                    storage_class=None,
+                    processes=None,
+                    batch_size=1000):
+    """
+    Rebuild the database from the cache alone, without any network requests. The crawl runs
+    through repec_scraper, so its order and max_links semantics match an online crawl; only the
+    parsing is spread over a process pool, and results are written in large batches.
+    :param db_session: A SQLAlchemy session object for an empty database
+    :param seed_handles: A list of RePEc handles to start from
+    :param cache_location: Path of the cache to read from
+    :param storage_class: Optional cache storage backend class (e.g. cache.PackStorage)
+    :param processes: Number of parse processes; defaults to the number of CPUs
+    :param batch_size: Number of articles (or citation chains) written to the database per commit
+    """
+    if db_session.query(db.Article).count() > 0:
+        raise ValueError("Offline rebuild expects an empty database")
+    if not cache_location.endswith("/"):
+        cache_location = cache_location + "/"
+
+    processes = processes or os.cpu_count()
+    logging.info("Rebuilding database from " + cache_location + " with " + str(processes) + " parse processes")
+    scraper.repec_scraper(db_session=db_session,
+                          cache=None,
+                          seed_handles=seed_handles,
+                          max_links=max_links,
+                          workers=processes,
+                          prefetch_window=processes * 16,
+                          batch_size=batch_size,
+                          fetcher=ParsePoolFetcher(cache_location, storage_class, processes))
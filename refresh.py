@@ -0,0 +1,123 @@
+import logging
+import time
+from functools import partial
+from sqlalchemy import func
+import cache
+import db
+import scraper
+from http_client import PermanentHTTPError
+from frontier import Frontier
+from writer import parse_ltree
+
+
+def refresh_candidates(db_session, data_cache, max_age=cache.CITEC_TTL):
+    """
+    Find the articles whose cached CitEc citation list is older than max_age, or of unknown age
+    :param db_session: A SQLAlchemy session object
+    :param data_cache: A cache.DataCache object
+    :param max_age: Maximum age of a citation list, in seconds
+    :return: A list of (article id, handle) tuples, articles with the most descendants first
+    """
+    fetch_times = data_cache.fetch_log.fetch_times("citec")
+    stale_before = time.time() - max_age
+    descendants = func.coalesce(db.ArticleStats.descendants, 0)
+    rows = db_session.query(db.Article.id, db.Article.handle) \
+        .outerjoin(db.ArticleStats, db.ArticleStats.article_id == db.Article.id) \
+        .order_by(descendants.desc(), db.Article.id)
+    return [(article_id, handle) for (article_id, handle) in rows
+            if fetch_times.get(handle.replace("/", "_"), 0) < stale_before]
+
+
+def citation_list(handle, text):
+    """
+    :return: The citing handles in a CitEc response, or an empty list if there is none or it has none
+    """
+    if text is None:
+        return []
+    try:
+        return scraper.parse_citec_response(handle, text)
+    except scraper.NoDataException:
+        return []
+
+
+def new_citations(handle, old_text, new_text):
+    """
+    :return: The handles in the new CitEc response that weren't in the old one, in the new response's order
+    """
+    new_cites = citation_list(handle, new_text)
+    try:
+        old_cites = set(citation_list(handle, old_text))
+    except Exception:
+        # e.g. a "blocking our IP" response was cached instead of a citation list
+        logging.warning("Cached CitEc data for " + handle + " couldn't be parsed; treating every citation as new")
+        old_cites = set()
+    return [cite for cite in dict.fromkeys(new_cites) if cite not in old_cites]
+
+
+def queue_new_citations(db_session, frontier, article_id, handle, queued, old_text, new_text):
+    """
+    Queue the handles that are new in a refreshed CitEc response, once for every citation chain of the cited
+    article, and commit them to the frontier. Passed to DataCache.refresh_citec as before_store, so the new
+    response only replaces the cached one once its citations can't be lost.
+    :param queued: A list the number of queued (handle, chain) pairs is appended to
+    """
+    cites = new_citations(handle, old_text, new_text)
+    if not cites:
+        return
+    chains = [parse_ltree(chain) for (chain,) in
+              db_session.query(db.CitationChain.citation_chain).filter_by(id_of_citing=article_id)]
+    for cite in cites:
+        for chain in chains:
+            frontier.put(scraper.ArticleInfo(cite, chain))
+    db_session.commit()
+    queued.append(len(cites) * len(chains))
+    logging.info("Queued " + str(len(cites)) + " new citations of " + handle)
+
+
+def refresh_crawl(db_session,
+                  data_cache,
+                  max_age=cache.CITEC_TTL,
+                  max_refreshes=None,
+                  max_new_links=1000,
+                  workers=1,
+                  batch_size=100):
+    """
+    Bring an existing database up to date with citations published since it was scraped. The CitEc
+    citation lists of articles are requested again once they are older than max_age, most cited articles
+    first, conditionally where CitEc gave an ETag or Last-Modified date. Only the handles that are new in
+    a list are queued, once for every citation chain of the cited article, and then scraped as usual.
+    RePEc pages are only requested for articles that aren't in the database yet.
+    :param db_session: A SQLAlchemy session object
+    :param data_cache: A cache.DataCache object
+    :param max_age: Maximum age of a cached citation list, in seconds
+    :param max_refreshes: Maximum number of citation lists to request; all stale lists if None
+    :param max_new_links: Number of links the scraper may follow beyond what is in the database
+    :param workers: Number of download threads per host (see scraper.repec_scraper)
+    :param batch_size: Number of articles written to the database per commit
+    :return: Number of handles queued
+    """
+    frontier = Frontier(db_session)
+
+    candidates = refresh_candidates(db_session, data_cache, max_age)
+    if max_refreshes is not None:
+        candidates = candidates[:max_refreshes]
+    logging.info("Refreshing " + str(len(candidates)) + " CitEc citation lists")
+
+    queued = []
+    for (article_id, handle) in candidates:
+        try:
+            # If the refresh is interrupted, the old list stays cached, and the handle is refreshed again next time
+            data_cache.refresh_citec(handle, max_age,
+                                     before_store=partial(queue_new_citations, db_session, frontier, article_id,
+                                                          handle, queued))
+        except PermanentHTTPError as e:
+            logging.warning(str(e))
+
+    citation_chain_count = db_session.query(db.CitationChain).count()
+    scraper.repec_scraper(db_session=db_session,
+                          cache=data_cache,
+                          seed_handles=[],
+                          max_links=citation_chain_count + len(frontier) + max_new_links,
+                          workers=workers,
+                          batch_size=batch_size)
+    return sum(queued)
@@ -1,24 +1,37 @@
+import html
 import json
+import re
+import time
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import dateparser
 from bs4 import BeautifulSoup
 import logging
-from sqlalchemy_utils import Ltree
-import persistqueue
+from sqlalchemy.exc import DBAPIError
 import db
-import settings
+from cache import NotCachedException
+from http_client import PermanentHTTPError
+from writer import BatchWriter
+from frontier import Frontier
+from metrics import registry as metrics
 
 
 class NoDataException(Exception):
     pass
 
 
-def get_repec_data(cache, repec_handle):
-    request = cache.request_repec(repec_handle)
-    html_output = BeautifulSoup(request, 'lxml')
+# Patterns used to pull the JSON-LD block out of RePEc pages, and the <errorstring>/<text ref=...>
+# elements out of CitEc responses, without building a parse tree. They mirror what the
+# BeautifulSoup-based parsers below find; tests.py compares the two over the cached corpus.
+JSON_LD_PATTERN = re.compile(r'<script\b[^>]*\btype\s*=\s*["\']?application/ld\+json["\']?[^>]*>(.*?)</script\s*>',
+                             re.IGNORECASE | re.DOTALL)
+CITEC_ERROR_PATTERN = re.compile(r'<errorstring(\s[^>]*)?>(.*?)</errorstring\s*>', re.IGNORECASE | re.DOTALL)
+CITEC_TEXT_PATTERN = re.compile(r'<text(\s[^>]*)?/?>', re.IGNORECASE)
+CITEC_TEXT_END_PATTERN = re.compile(r'</text\s*>', re.IGNORECASE)
+REF_ATTRIBUTE_PATTERN = re.compile(r'\bref\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+))', re.IGNORECASE)
 
-    # Extract article description JSON from HTML
-    article_json = json.loads(html_output.find("script", {"type": "application/ld+json"}).text)
+
+def extract_article(repec_handle, article_json):
     json_text = article_json["@graph"]
 
     # Search through JSON object and find the relevant information
@@ -41,9 +54,68 @@ def get_repec_data(cache, repec_handle):
     return article
 
 
-def get_citec_cites(cache, repec_handle):
-    request = cache.request_citec(repec_handle)
-    xml_output = BeautifulSoup(request, 'html.parser')
+def parse_repec_page(repec_handle, page):
+    # Extract article description JSON from HTML
+    match = JSON_LD_PATTERN.search(page)
+    if match is None:
+        # Same exception BeautifulSoup raises when find() comes back empty
+        raise AttributeError("No JSON-LD block in RePEc page for " + repec_handle)
+    return extract_article(repec_handle, json.loads(match.group(1)))
+
+
+def parse_repec_page_soup(repec_handle, page):
+    html_output = BeautifulSoup(page, 'lxml')
+
+    # Extract article description JSON from HTML
+    article_json = json.loads(html_output.find("script", {"type": "application/ld+json"}).text)
+    return extract_article(repec_handle, article_json)
+
+
+def get_repec_data(cache, repec_handle):
+    page = cache.request_repec(repec_handle)
+    with metrics.timer("parse_seconds", source="repec"):
+        return parse_repec_page(repec_handle, page)
+
+
+def check_citec_error(repec_handle, error_attributes, error_text):
+    if error_attributes is None and error_text == 'Requested document not found':
+        raise NoDataException("Requested document not found for " + repec_handle)
+    else:
+        raise Exception('CiTeC blocking our IP. Failed at: ' + repec_handle)
+
+
+def parse_citec_entries(repec_handle, response):
+    """
+    :return: A list of (citing handle, text) tuples, one per <text> element; the text is CitEc's
+    reference to the citing paper (authors, title), or '' if the element is empty
+    """
+    # Check to see if IP is being blocked; if so, raise exception
+    error_match = CITEC_ERROR_PATTERN.search(response)
+    if error_match is not None:
+        check_citec_error(repec_handle, error_match.group(1), error_match.group(2))
+
+    entries = []
+    for text_match in CITEC_TEXT_PATTERN.finditer(response):
+        # Get corresponding citec URL
+        ref_match = REF_ATTRIBUTE_PATTERN.search(text_match.group(1) or "")
+        url = None if ref_match is None else html.unescape(next(filter(None, ref_match.groups()), ""))
+        text = ""
+        if not text_match.group(0).endswith("/>"):
+            end_match = CITEC_TEXT_END_PATTERN.search(response, text_match.end())
+            if end_match is not None:
+                text = html.unescape(response[text_match.end():end_match.start()]).strip()
+        # Extract RePEC handle from URL
+        entries.append((url.split('.org/')[1], text))
+
+    return entries
+
+
+def parse_citec_response(repec_handle, response):
+    return [handle for (handle, _) in parse_citec_entries(repec_handle, response)]
+
+
+def parse_citec_response_soup(repec_handle, response):
+    xml_output = BeautifulSoup(response, 'html.parser')
 
     # Check to see if IP is being blocked; if so, raise exception
     error_string = xml_output.find_all("errorstring")
@@ -63,54 +135,108 @@ def get_citec_cites(cache, repec_handle):
     return repec_handles
 
 
+def get_citec_cites(cache, repec_handle):
+    response = cache.request_citec(repec_handle)
+    with metrics.timer("parse_seconds", source="citec"):
+        return parse_citec_response(repec_handle, response)
+
+
+def get_citec_entries(cache, repec_handle):
+    response = cache.request_citec(repec_handle)
+    with metrics.timer("parse_seconds", source="citec"):
+        return parse_citec_entries(repec_handle, response)
+
+
 # Define a namedtuple that will keep track of elements in queue. This consists of a RePec handle
 # and an int list defining a citation path to that handle (e.g. [1,10,12] for article with id=12.
 
 ArticleInfo = namedtuple("ArticleInfo", "handle citation_chain")
 
 
-def write_article(extracted_article, db_session):
-    article_entry = db.Article(handle=extracted_article["handle"],
-                               title=extracted_article["title"],
-                               year=extracted_article["year"],
-                               abstract=extracted_article["abstract"],
-                               url=extracted_article["url"])
+class SerialFetcher:
+    """
+    Fetches and parses RePEc/CitEc data one handle at a time, when the scraper asks for it.
+    """
+    def __init__(self, cache):
+        self.cache = cache
 
-    # Check if venue exists; if it doesn't, add a new venue entry
-    venue_entry = db_session.query(db.Venue).filter_by(name=extracted_article["venue"]).first()
-    if venue_entry is None:
-        venue_entry = db.Venue(name=extracted_article["venue"])
-    article_entry.venue = venue_entry
+    def prefetch(self, handle):
+        pass
 
-    # Check if author(s) exist; if so, add them to the article. If not, create new author entries
-    for author in extracted_article["authors"]:
-        author_entry = db_session.query(db.Author).filter_by(name=author).first()
-        if author_entry is None:
-            author_entry = db.Author(name=author)
-        article_entry.authors.append(author_entry)
+    def prefetch_cites(self, handle):
+        pass
 
-    # Check if keyword(s) exist; if so, add them to article. If not, create new keyword entries
-    for keyword in extracted_article["keywords"]:
-        keyword_entry = db_session.query(db.Keyword).filter_by(keyword=keyword).first()
-        if keyword_entry is None:
-            keyword_entry = db.Keyword(keyword=keyword)
-        article_entry.keywords.append(keyword_entry)
+    def discard_pending(self):
+        pass
 
-    db_session.add(article_entry)
-    db_session.commit()
-    logging.info("Committed " + str(article_entry) + " to database")
+    def repec_data(self, handle):
+        return get_repec_data(self.cache, handle)
 
+    def citec_cites(self, handle):
+        return get_citec_cites(self.cache, handle)
 
-def build_ltree(citation_list):
-    return ".".join(list(map(str, citation_list)))
+    def citec_entries(self, handle):
+        return get_citec_entries(self.cache, handle)
+
+    def close(self):
+        pass
+
+
+class ThreadedFetcher(SerialFetcher):
+    """
+    Downloads the pages of upcoming queue items in the background, with a separate thread pool
+    per host. Each host is throttled by its own limiter in DataCache, so RePEc and CitEc requests
+    overlap, while cache hits return immediately. Parsing still happens in the calling thread,
+    so database writes keep the queue order.
+    """
+    def __init__(self, cache, workers):
+        super().__init__(cache)
+        self.executors = {"repec": ThreadPoolExecutor(max_workers=workers),
+                          "citec": ThreadPoolExecutor(max_workers=workers)}
+        self.pending = dict()
+
+    def _submit(self, source, handle, request):
+        if (source, handle) not in self.pending:
+            self.pending[(source, handle)] = self.executors[source].submit(request, handle)
+
+    def _wait(self, source, handle):
+        future = self.pending.pop((source, handle), None)
+        if future is not None:
+            try:
+                future.result()
+            except Exception:
+                # The page is requested again (with retries) when it is parsed
+                logging.warning("Prefetching " + source + " data failed for " + handle)
 
+    def prefetch(self, handle):
+        self._submit("repec", handle, self.cache.request_repec)
 
-def write_citation_chain(entry_id, citation_chain_list, db_session):
-    cite_chain = db.CitationChain(id_of_citing=entry_id, citation_chain=Ltree(
-        build_ltree(citation_chain_list)))
-    db_session.add(cite_chain)
-    db_session.commit()
-    logging.info("Committted " + str(cite_chain) + " to database with chain " + str(citation_chain_list))
+    def prefetch_cites(self, handle):
+        self._submit("citec", handle, self.cache.request_citec)
+
+    def discard_pending(self):
+        """
+        Cancel the prefetches the scraper didn't use, e.g. for an article already written with another chain
+        """
+        for future in self.pending.values():
+            future.cancel()
+        self.pending = dict()
+
+    def repec_data(self, handle):
+        self._wait("repec", handle)
+        return super().repec_data(handle)
+
+    def citec_cites(self, handle):
+        self._wait("citec", handle)
+        return super().citec_cites(handle)
+
+    def citec_entries(self, handle):
+        self._wait("citec", handle)
+        return super().citec_entries(handle)
+
+    def close(self):
+        for executor in self.executors.values():
+            executor.shutdown(wait=True, cancel_futures=True)
 
 
 # Spiders RePEC and Citec from a list of seed papers
@@ -118,26 +244,44 @@ def repec_scraper(db_session,
                   cache,
                   seed_handles,
                   max_links=100,
-                  persist_at=settings.CACHE_LOCATION):
-    if not persist_at.endswith("/"):
-        persist_at = persist_at + "/"
-
-    # Initialize Queue object to store RePEC handles; fill it with seed handles.
-    repec_queue = persistqueue.UniqueQ(persist_at + "scraper_queue", auto_commit=True)
+                  workers=1,
+                  prefetch_window=32,
+                  batch_size=100,
+                  fetcher=None,
+                  focus=None,
+                  frontier=None,
+                  poll_interval=5):
+    """
+    :param workers: Number of download threads per host. With workers > 1, RePEc pages for the next
+    prefetch_window queue items are downloaded concurrently while earlier items are written. Citations are
+    only requested for the next workers items, once it is known whether the max_links budget still lasts.
+    :param prefetch_window: Number of handles taken from the frontier at a time
+    :param batch_size: Number of articles (or citation chains) written to the database per commit
+    :param fetcher: Optional fetcher to use instead of one built from cache and workers
+    (e.g. rebuild.ParsePoolFetcher)
+    :param focus: Optional focus.FocusedCrawl, to expand relevant articles first and prune irrelevant branches
+    :param frontier: Optional frontier.Frontier on db_session, e.g. one with a worker_id to crawl alongside
+    other worker processes. A worker commits after every window, so the others see what it queued, and
+    stops once the shared frontier is empty, checking every poll_interval seconds while other workers
+    still hold leases.
+    """
+    # The crawl frontier lives in the database, and is committed together with the scraped articles
+    if frontier is None:
+        frontier = Frontier(db_session)
+    shared = frontier.worker_id is not None
 
     # Step 1: Check if articles db is empty. If it is, then we need to make sure that the
     # scraping queue is empty too.
     citation_chain_count = db_session.query(db.CitationChain).count()
     citation_db_empty = citation_chain_count == 0
 
-    # Clear the shelf and queue
-    if citation_db_empty:
-        logging.warning("Citations table is empty, so I'm clearing the repec_queue shelf")
-        while not repec_queue.empty():
-            repec_queue.get(timeout=0)
+    # Clear the frontier, unless other workers may already be crawling from it
+    if citation_db_empty and not shared:
+        logging.warning("Citations table is empty, so I'm clearing the crawl frontier")
+        frontier.clear()
 
     # Initiate counter for article entries and link count
-    link_count = len(repec_queue) + citation_chain_count
+    link_count = len(frontier) + citation_chain_count
 
     # Add seed handles to the queue if they haven't been visited previously
     logging.info("Adding seed handles to queue...")
@@ -145,57 +289,170 @@ def repec_scraper(db_session,
         existing_entry = db_session.query(db.Article).filter_by(handle=seed_handle).first()
         # Because these articles are at the 'root' of the citation chain, the chain list is empty
         if existing_entry is None:
-            repec_queue.put(ArticleInfo(seed_handle, []))
+            frontier.put(ArticleInfo(seed_handle, []))
             link_count += 1
 
-    # Spider through the queue
-    while not repec_queue.empty():
-        current = repec_queue.get(timeout=0)
-        logging.info("Current queue length now: " + str(len(repec_queue)))
-        existing_entry = db_session.query(db.Article).filter_by(handle=current.handle).scalar()
-        if existing_entry is None:
-            try:
-                # Download RePEC data and add current counter value as article ID
-                logging.info("Getting RePEC data for " + current.handle)
-                article_info = get_repec_data(cache, current.handle)
-                write_article(article_info, db_session)
-                latest_article_id = db.latest_article_id(db_session)
-
-                # Add current citation chain to db
-                updated_citation_chain = current.citation_chain + [latest_article_id]
-                write_citation_chain(latest_article_id, updated_citation_chain, db_session)
-
-                # If we are below max_links, then get citec cites and add them to the queue
-                if link_count < max_links:
-                    logging.info("Getting cites for " + current.handle)
-                    cites = get_citec_cites(cache, current.handle)
-                    for handle in cites:
-                        # Second part takes current citation chain and appends current link counter onto it:
-                        # e.g., [1,2] -> [1,2,3].
-                        to_put = ArticleInfo(handle, current.citation_chain + [latest_article_id])
-                        repec_queue.put(to_put)
-                        link_count += 1
-                        logging.info("Current value of link_count : " + str(link_count))
-                        if link_count > max_links:
-                            break
-                else:
-                    logging.info("No room left in queue; skipping cites for " + current.handle)
-
-            except AttributeError:
-                logging.warning("No RePeC data for " + current.handle)
-
-            except json.decoder.JSONDecodeError:
-                logging.error("Problem decoding JSON for " + current.handle + ". Skipping this one.")
-
-            except NoDataException:
-                logging.warning("CitEc data missing for " + current.handle)
-
+    if fetcher is None:
+        if workers > 1:
+            fetcher = ThreadedFetcher(cache, workers)
         else:
-            # If the handle is already in the database, then we need to add the citation chain again.
-            # However, we need to verify that the citation chain doesn't form a cycle, as this would lead
-            # the scraper to follow an endless loop.
-            updated_citation_chain = current.citation_chain + [existing_entry.id]
-            if existing_entry.id not in current.citation_chain:
-                write_citation_chain(existing_entry.id, updated_citation_chain, db_session)
+            fetcher = SerialFetcher(cache)
+    writer = BatchWriter(db_session, batch_size=batch_size)
+    writer.remap_listeners.append(frontier.remap_ids)
+    if focus is not None:
+        writer.remap_listeners.append(focus.remap_ids)
+    writer.warm_name_caches()
+
+    database_failed = False
+    try:
+        # Spider through the frontier
+        while True:
+            if shared:
+                writer.flush()
+                db_session.commit()
+                # Other workers add to the budget too
+                link_count = len(frontier) + db_session.query(db.CitationChain).count()
+            window = frontier.take(prefetch_window)
+            if not window:
+                if shared and len(frontier) > 0:
+                    # Handles leased to other workers; they may queue more, or their leases may expire
+                    time.sleep(poll_interval)
+                    continue
+                break
+            queue_length = len(frontier)
+            metrics.set_gauge("queue_depth", queue_length)
+            logging.info("Current queue length now: " + str(queue_length))
+            window_handles = [item.handle for item in window]
+            stored_handles = {handle for (handle,) in
+                              db_session.query(db.Article.handle).filter(db.Article.handle.in_(window_handles))}
+            for item in window:
+                if item.handle not in stored_handles:
+                    fetcher.prefetch(item.handle)
+
+            cites_requested = set()
+            for (position, item) in enumerate(window):
+                for upcoming in window[position:position + max(1, workers)]:
+                    # Checked per item, as the budget may run out within the window. Cites of articles that
+                    # may be pruned are only requested once the article proves relevant
+                    if (upcoming.handle not in stored_handles and upcoming.handle not in cites_requested and
+                            link_count < max_links and
+                            (focus is None or not focus.may_prune(upcoming.citation_chains[0]))):
+                        fetcher.prefetch_cites(upcoming.handle)
+                        cites_requested.add(upcoming.handle)
+                # Keeps the window's handles from being claimed by other workers while it is slow
+                frontier.renew_leases()
+                mark = writer.mark()
+                try:
+                    # The shortest chain comes first: it is the one the article is scraped and expanded with
+                    for citation_chain in item.citation_chains:
+                        link_count = scrape_queue_item(ArticleInfo(item.handle, citation_chain),
+                                                       writer, fetcher, frontier, link_count, max_links, focus)
+                except Exception:
+                    # The item stays in the frontier, and nothing written for it is committed
+                    writer.discard(mark)
+                    raise
+                frontier.finish(item)
+                # Only between items, so an item leaves the frontier in the same commit as its writes
+                writer.flush_if_full()
+            fetcher.discard_pending()
+    except DBAPIError:
+        # The transaction is lost, and with it everything buffered since the last commit
+        database_failed = True
+        raise
+    finally:
+        fetcher.close()
+        if not database_failed:
+            writer.flush()
+            # Commits the frontier, if the writer had nothing left to commit
+            db_session.commit()
+        logging.info("Name cache statistics: " + str(writer.name_cache_stats()))
+        if focus is not None:
+            logging.info(focus.summary())
+        if metrics.enabled:
+            logging.info(metrics.summary())
+
+
+def scrape_queue_item(current, writer, fetcher, frontier, link_count, max_links, focus=None):
+    """
+    Write one dequeued article (or one more citation chain to it) and queue its citing articles
+    :param current: An ArticleInfo(handle, citation_chain)
+    :param frontier: The frontier.Frontier to queue citing articles in
+    :param focus: Optional focus.FocusedCrawl that scores the article and ranks its citing articles
+    :return: The updated link_count
+    """
+    existing_id = writer.lookup_article_id(current.handle)
+    if existing_id is None:
+        try:
+            # Download RePEC data and reserve an ID for the article
+            logging.info("Getting RePEC data for " + current.handle)
+            article_info = fetcher.repec_data(current.handle)
+            latest_article_id = writer.reserve_article_id()
+            updated_citation_chain = current.citation_chain + [latest_article_id]
+
+            score = None
+            if focus is not None:
+                score = focus.article_score(article_info)
+
+            # If we are below max_links, then get citec cites. They are fetched before anything is buffered,
+            # so a failed CitEc request leaves nothing of the item behind.
+            cites = []
+            if link_count >= max_links:
+                logging.info("No room left in queue; skipping cites for " + current.handle)
+            elif focus is not None and focus.prune(updated_citation_chain, score):
+                logging.info("Not relevant; skipping cites for " + current.handle)
             else:
-                logging.warning("Potential cycle detected at" + str(updated_citation_chain) + " Skipping " + current.handle)
\ No newline at end of file
+                logging.info("Getting cites for " + current.handle)
+                try:
+                    if focus is None:
+                        cites = [(handle, None) for handle in fetcher.citec_cites(current.handle)]
+                    else:
+                        # Best first, so the most relevant ones are queued if the budget runs out
+                        cites = focus.rank(fetcher.citec_entries(current.handle), len(updated_citation_chain),
+                                           score)
+                except NoDataException:
+                    logging.warning("CitEc data missing for " + current.handle)
+                except NotCachedException as e:
+                    logging.warning(str(e))
+                except PermanentHTTPError as e:
+                    logging.warning(str(e) + ". No cites for " + current.handle)
+
+            # Add the article and the current citation chain to db
+            writer.add_article(article_info, latest_article_id)
+            writer.add_citation_chain(latest_article_id, updated_citation_chain)
+            if focus is not None:
+                focus.record(score)
+
+            # Add the cites to the queue
+            for (handle, priority) in cites:
+                # Second part takes current citation chain and appends current link counter onto it:
+                # e.g., [1,2] -> [1,2,3].
+                to_put = ArticleInfo(handle, updated_citation_chain)
+                frontier.put(to_put, priority)
+                link_count += 1
+                logging.info("Current value of link_count : " + str(link_count))
+                if link_count > max_links:
+                    break
+
+        except AttributeError:
+            logging.warning("No RePeC data for " + current.handle)
+
+        except json.decoder.JSONDecodeError:
+            logging.error("Problem decoding JSON for " + current.handle + ". Skipping this one.")
+
+        except NotCachedException as e:
+            logging.warning(str(e))
+
+        except PermanentHTTPError as e:
+            logging.warning(str(e) + ". Skipping " + current.handle)
+
+    else:
+        # If the handle is already in the database, then we need to add the citation chain again.
+        # However, we need to verify that the citation chain doesn't form a cycle, as this would lead
+        # the scraper to follow an endless loop.
+        updated_citation_chain = current.citation_chain + [existing_id]
+        if existing_id not in current.citation_chain:
+            writer.add_citation_chain(existing_id, updated_citation_chain)
+        else:
+            logging.warning("Potential cycle detected at" + str(updated_citation_chain) + " Skipping " + current.handle)
+
+    return link_count
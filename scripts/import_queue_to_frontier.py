@@ -0,0 +1,35 @@
+# Script to move the items left in a persistqueue scraper queue (used before the crawl frontier moved into
+# the database, see frontier.Frontier) into the frontier tables, so an interrupted crawl can be resumed.
+# Usage: python scripts/import_queue_to_frontier.py [queue_directory]
+
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import persistqueue
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import db
+import settings
+from frontier import Frontier
+
+logging.basicConfig(level=logging.INFO)
+
+queue_directory = sys.argv[1] if len(sys.argv) > 1 else settings.CACHE_LOCATION + "scraper_queue"
+
+engine = create_engine(settings.SQL_URL, echo=False)
+db.migrate(engine)
+session = sessionmaker(bind=engine)()
+frontier = Frontier(session)
+
+repec_queue = persistqueue.UniqueQ(queue_directory, auto_commit=False)
+imported = 0
+while not repec_queue.empty():
+    frontier.put(repec_queue.get(timeout=0))
+    imported += 1
+session.commit()
+# The old queue is only emptied once the frontier has been committed
+repec_queue.task_done()
+print("Imported " + str(imported) + " queue items into the frontier (" + str(len(frontier)) + " handles)")
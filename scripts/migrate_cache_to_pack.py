@@ -0,0 +1,21 @@
+# Script to copy the directory-per-publisher cache into compressed pack files (see cache.PackStorage).
+# Usage: python scripts/migrate_cache_to_pack.py [cache_location]
+# Afterwards, crawl and rebuild from the packs with python scrape_RePEc.py --storage pack
+
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import cache
+import settings
+
+logging.basicConfig(level=logging.INFO)
+
+cache_location = sys.argv[1] if len(sys.argv) > 1 else settings.CACHE_LOCATION
+if not cache_location.endswith("/"):
+    cache_location = cache_location + "/"
+
+copied = cache.migrate_storage(cache.DirectoryStorage(cache_location), cache.PackStorage(cache_location))
+print("Copied " + str(copied) + " entries into " + cache_location + "repec.pack and citec.pack")
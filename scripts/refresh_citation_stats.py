@@ -0,0 +1,24 @@
+# Script to rebuild the descendant_pairs, generation_stats and article_stats tables from the citations table,
+# e.g. after chains were written outside of the scraper or the tables were created on an existing database.
+# Usage: python scripts/refresh_citation_stats.py [sqlalchemy_url]
+
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import db
+import settings
+import stats
+
+logging.basicConfig(level=logging.INFO)
+
+engine = create_engine(sys.argv[1] if len(sys.argv) > 1 else settings.SQL_URL, echo=False)
+db.migrate(engine)
+session = sessionmaker(bind=engine)()
+
+stats.refresh(session)
+print("Refreshed statistics for " + str(session.query(db.ArticleStats).count()) + " articles")
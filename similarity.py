@@ -0,0 +1,295 @@
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import analysis
+import corpus
+
+# Word vectors used by each WMD worker process, loaded by _init_worker
+_worker_vectors = None
+
+
+def _init_worker(model_path):
+    global _worker_vectors
+    import gensim
+    _worker_vectors = gensim.models.Word2Vec.load(model_path).wv
+
+
+def _wm_distances(token_pairs):
+    return [_worker_vectors.wmdistance(tokens_1, tokens_2) for (tokens_1, tokens_2) in token_pairs]
+
+
+class DistanceStore:
+    """
+    Persistent store of computed Word Mover's Distances, keyed by unordered pair of article ids
+    """
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("create table if not exists distances ("
+                                "id_1 integer not null, "
+                                "id_2 integer not null, "
+                                "wmd real not null, "
+                                "primary key (id_1, id_2))")
+
+    def get_many(self, pairs):
+        """
+        :param pairs: A list of (id, id) tuples
+        :return: A dict of (min id, max id) -> distance for the pairs that are stored
+        """
+        found = dict()
+        for (id_1, id_2) in pairs:
+            key = (min(id_1, id_2), max(id_1, id_2))
+            row = self.connection.execute("select wmd from distances where id_1 = ? and id_2 = ?", key).fetchone()
+            if row is not None:
+                found[key] = row[0]
+        return found
+
+    def put_many(self, distances):
+        """
+        :param distances: A dict of (id, id) -> distance
+        """
+        self.connection.executemany("insert or replace into distances values (?, ?, ?)",
+                                    [(min(key), max(key), float(value)) for (key, value) in distances.items()])
+        self.connection.commit()
+
+
+class SimilarityEngine:
+    """
+    Compares abstracts with a phrase Word2Vec model. Candidates are first ranked by the cosine similarity of
+    their mean word vectors, computed as one matrix product; the exact Word Mover's Distance is only
+    computed for the top-k survivors, optionally across a process pool.
+
+    Phrase-processed token lists are cached by article id, and computed distances can be persisted in a
+    DistanceStore so they are never computed twice.
+    """
+    def __init__(self, phrases, model, model_path=None, distance_store=None):
+        """
+        :param phrases: A gensim Phrases/Phraser model
+        :param model: A gensim Word2Vec model trained on phrase-processed abstracts
+        :param model_path: Path the model was saved to; needed to compute WMD in worker processes
+        :param distance_store: Optional DistanceStore
+        """
+        self.phrases = phrases
+        self.model = model
+        self.model_path = model_path
+        self.distance_store = distance_store
+        self.token_cache = dict()
+
+    def tokens(self, article_id, abstract, cache=True):
+        """
+        :param cache: If False, neither read nor fill the token cache
+        :return: The phrase-processed tokens of an abstract, cached by article id
+        """
+        tokens = self.token_cache.get(article_id) if cache else None
+        if tokens is None:
+            import gensim
+            tokens = self.phrases[gensim.utils.simple_preprocess(abstract or "")]
+            if cache:
+                self.token_cache[article_id] = tokens
+        return tokens
+
+    def mean_vectors(self, article_ids, abstracts, cache=True):
+        """
+        :param cache: Passed on to tokens
+        :return: An (n_articles x vector_size) matrix of unit-length mean word vectors; rows of articles with
+        no known words are zero
+        """
+        wv = self.model.wv
+        matrix = np.zeros((len(article_ids), wv.vector_size), dtype=np.float32)
+        for row, (article_id, abstract) in enumerate(zip(article_ids, abstracts)):
+            indices = [wv.key_to_index[token] for token in self.tokens(article_id, abstract, cache)
+                       if token in wv.key_to_index]
+            if indices:
+                matrix[row] = wv.vectors[indices].mean(axis=0)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms > 0, norms, 1)
+
+    def wm_distances(self, pairs, abstracts, workers=None, chunk_size=64):
+        """
+        Compute (or fetch from the distance store) the Word Mover's Distance for pairs of articles
+        :param pairs: A list of (id, id) tuples
+        :param abstracts: A dict of article id -> abstract for every id in pairs
+        :param workers: Number of worker processes; if None (or no model_path is set), run in this process
+        :return: A dict of (min id, max id) -> distance
+        """
+        keys = list(dict.fromkeys((min(pair), max(pair)) for pair in pairs))
+        distances = self.distance_store.get_many(keys) if self.distance_store is not None else dict()
+        missing = [key for key in keys if key not in distances]
+        token_pairs = [(self.tokens(id_1, abstracts[id_1]), self.tokens(id_2, abstracts[id_2])) for (id_1, id_2) in missing]
+
+        if workers is not None and self.model_path is not None and len(missing) > chunk_size:
+            chunks = [token_pairs[start:start + chunk_size] for start in range(0, len(token_pairs), chunk_size)]
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self.model_path,)) as executor:
+                computed = [distance for chunk in executor.map(_wm_distances, chunks) for distance in chunk]
+        else:
+            computed = [self.model.wv.wmdistance(tokens_1, tokens_2) for (tokens_1, tokens_2) in token_pairs]
+
+        new_distances = dict(zip(missing, computed))
+        if self.distance_store is not None and new_distances:
+            self.distance_store.put_many(new_distances)
+        distances.update(new_distances)
+        return distances
+
+    def rank(self, article, article_collection, top_k=50, workers=None):
+        """
+        Rank the articles of a collection by similarity to one article
+        :param article: An Article object (returned by a lookup function)
+        :param article_collection: An ArticleCollection object with an Abstract column
+        :param top_k: Number of articles (by mean-vector cosine) to compute the exact WMD for
+        :param workers: Number of worker processes for WMD (see wm_distances)
+        :return: A DataFrame with columns ID, Handle, Cosine and WMD, sorted by WMD
+        """
+        data = article_collection.articles_df
+        data = data[data.ID != article.id]
+        ids = data.ID.to_list()
+        candidates = self.mean_vectors(ids, data.Abstract.to_list())
+        seed = self.mean_vectors([article.id], [article.abstract])[0]
+        cosines = candidates @ seed
+
+        survivors = np.argsort(-cosines)[:top_k]
+        abstracts = dict(zip(ids, data.Abstract))
+        abstracts[article.id] = article.abstract
+        distances = self.wm_distances([(article.id, ids[i]) for i in survivors], abstracts, workers)
+        ranked = pd.DataFrame({"ID": [ids[i] for i in survivors],
+                               "Handle": data.Handle.to_numpy()[survivors],
+                               "Cosine": cosines[survivors],
+                               "WMD": [distances[(min(article.id, ids[i]), max(article.id, ids[i]))] for i in survivors]})
+        return ranked.sort_values("WMD").reset_index(drop=True)
+
+    def pairwise(self, article_collection, top_k=10, workers=None):
+        """
+        Compare every article of a collection with its top_k nearest neighbours (by mean-vector cosine)
+        :return: A DataFrame with columns ID_1, ID_2, Cosine and WMD, one row per unordered pair
+        """
+        data = article_collection.articles_df
+        ids = data.ID.to_list()
+        vectors = self.mean_vectors(ids, data.Abstract.to_list())
+        cosines = vectors @ vectors.T
+        np.fill_diagonal(cosines, -np.inf)
+        neighbours = np.argsort(-cosines, axis=1)[:, :min(top_k, len(ids) - 1)]
+        pairs = {(min(ids[row], ids[column]), max(ids[row], ids[column])): cosines[row, column]
+                 for row in range(len(ids)) for column in neighbours[row]}
+        distances = self.wm_distances(list(pairs), dict(zip(ids, data.Abstract)), workers)
+        return pd.DataFrame([{"ID_1": id_1, "ID_2": id_2, "Cosine": cosine, "WMD": distances[(id_1, id_2)]}
+                             for ((id_1, id_2), cosine) in pairs.items()])
+
+
+class EmbeddingIndex:
+    """
+    Nearest-neighbour index over the unit mean-vector embedding of every abstract in the database.
+    Queries are exact: the query vector is multiplied against the embedding matrix in blocks, keeping
+    the running top k, so memory use is bounded by the block size.
+
+    The index is saved next to the model as <model_path>.index.vectors.npy and .ids.npy, and update()
+    appends articles that aren't indexed yet.
+    """
+    def __init__(self, engine, vectors=None, article_ids=None):
+        """
+        :param engine: A SimilarityEngine, whose model provides the word vectors
+        """
+        self.engine = engine
+        self.vectors = np.zeros((0, engine.model.wv.vector_size), dtype=np.float32) if vectors is None else vectors
+        self.article_ids = np.zeros(0, dtype=np.int64) if article_ids is None else article_ids
+        self.positions = {int(id): position for (position, id) in enumerate(self.article_ids)}
+
+    def __len__(self):
+        return len(self.article_ids)
+
+    @staticmethod
+    def default_path(model_path):
+        return model_path + ".index"
+
+    @classmethod
+    def load(cls, engine, path):
+        """
+        :param path: Path prefix the index was saved under (see default_path)
+        """
+        return cls(engine,
+                   np.load(path + ".vectors.npy", mmap_mode="r"),
+                   np.load(path + ".ids.npy"))
+
+    def save(self, path):
+        np.save(path + ".vectors.npy", np.asarray(self.vectors))
+        np.save(path + ".ids.npy", self.article_ids)
+
+    def update(self, session_object, batch_size=10000):
+        """
+        Embed and append the articles that aren't indexed yet
+        :return: Number of articles added
+        """
+        ids = []
+        blocks = [np.asarray(self.vectors)]
+        for batch in corpus.unseen_articles(session_object, self.article_ids, batch_size=batch_size):
+            # Bulk embedding goes past the token cache, which would otherwise end up holding the whole corpus
+            blocks.append(self.engine.mean_vectors([id for (id, _) in batch], [abstract for (_, abstract) in batch],
+                                                   cache=False))
+            ids += [id for (id, _) in batch]
+        if not ids:
+            return 0
+        start = len(self.article_ids)
+        self.vectors = np.concatenate(blocks)
+        self.article_ids = np.concatenate([self.article_ids, np.asarray(ids, dtype=np.int64)])
+        self.positions.update({id: start + offset for (offset, id) in enumerate(ids)})
+        return len(ids)
+
+    def vector(self, article):
+        """
+        :param article: An Article object
+        :return: The article's embedding, computed on the fly if the article isn't indexed
+        """
+        position = self.positions.get(article.id)
+        if position is not None:
+            return np.asarray(self.vectors[position])
+        return self.engine.mean_vectors([article.id], [article.abstract])[0]
+
+    def nearest(self, vector, k=50, exclude=(), block_size=65536):
+        """
+        :param vector: A unit-length query vector
+        :param exclude: Article ids to leave out of the results
+        :return: (article ids, cosine similarities), most similar first
+        """
+        best_ids = np.zeros(0, dtype=np.int64)
+        best_scores = np.zeros(0, dtype=np.float32)
+        exclude = np.asarray(list(exclude), dtype=np.int64)
+        for start in range(0, len(self.article_ids), block_size):
+            scores = np.asarray(self.vectors[start:start + block_size]) @ vector
+            ids = self.article_ids[start:start + block_size]
+            keep = ~np.isin(ids, exclude)
+            scores = np.concatenate([best_scores, scores[keep]])
+            ids = np.concatenate([best_ids, ids[keep]])
+            top = np.argpartition(-scores, k)[:k] if len(scores) > k else np.arange(len(scores))
+            best_ids, best_scores = ids[top], scores[top]
+        order = np.argsort(-best_scores)
+        return best_ids[order], best_scores[order]
+
+
+def lookup_similar(repec_handle, session_object, index, k=50):
+    """
+    Find the articles whose abstracts are most similar to that of an article
+    :param repec_handle: A string containing the Article's RePEC handle
+    :param session_object: A SQLAlchemy session object
+    :param index: An EmbeddingIndex object
+    :param k: Number of articles to return
+    :return: An ArticleCollection object, most similar article first
+    """
+    article = analysis.lookup_by_handle(repec_handle, session_object)
+    if article is None:
+        raise ValueError("No article with handle " + repec_handle)
+    ids, _ = index.nearest(index.vector(article), k, exclude=[article.id])
+    return analysis.get_articles(ids, session_object)
+
+
+def load_engine(phrases_path, model_path, distances_path=None):
+    """
+    Load a SimilarityEngine from saved gensim models
+    :param phrases_path: Path of a saved Phrases model
+    :param model_path: Path of a saved phrase Word2Vec model
+    :param distances_path: Optional path of a SQLite file to persist distances in
+    :return: A SimilarityEngine object
+    """
+    import gensim
+    phrases = gensim.models.Phrases.load(phrases_path)
+    model = gensim.models.Word2Vec.load(model_path)
+    distance_store = DistanceStore(distances_path) if distances_path is not None else None
+    return SimilarityEngine(phrases, model, model_path=os.path.abspath(model_path), distance_store=distance_store)
@@ -0,0 +1,142 @@
+from collections import defaultdict
+from sqlalchemy import func, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql.expression import text
+import db
+
+# Maximum number of rows (or keys) per statement, to stay below Postgres's limit of 65535 parameters
+WRITE_CHUNK_SIZE = 5000
+
+# Every (ancestor, descendant, depth) of every row in the citations table, for the full refresh
+CHAIN_PAIRS_SQL = ("select ltree2text(subpath(citations.citation_chain, i, 1))::bigint as ancestor_id, "
+                   "citations.id_of_citing as descendant_id, "
+                   "nlevel(citations.citation_chain) - 1 - i as depth "
+                   "from citations, generate_series(0, nlevel(citations.citation_chain) - 2) as i")
+
+
+def chain_pairs(citation_chain_list):
+    """
+    :param citation_chain_list: A citation chain, e.g. [1, 10, 12]
+    :return: A list of (ancestor id, descendant id, depth) tuples, e.g. [(1, 12, 2), (10, 12, 1)]
+    """
+    descendant = citation_chain_list[-1]
+    return [(ancestor, descendant, len(citation_chain_list) - 1 - position)
+            for (position, ancestor) in enumerate(citation_chain_list[:-1])]
+
+
+def chunks(rows, size=None):
+    """
+    :param rows: A list
+    :param size: Maximum number of rows per slice; defaults to WRITE_CHUNK_SIZE
+    :return: A generator of consecutive slices of at most size rows
+    """
+    size = WRITE_CHUNK_SIZE if size is None else size
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def record_chains(db_session, citation_chain_lists, years=None):
+    """
+    Update the statistics tables for citation chains that have just been inserted. Run it in the same
+    transaction as the inserts, and only for chains that were actually inserted (not skipped as duplicates).
+    :param db_session: A SQLAlchemy session object
+    :param citation_chain_lists: A list of citation chains
+    :param years: Optional dict of article id -> year, for articles not yet visible to queries
+    """
+    pairs = [pair for chain in citation_chain_lists for pair in chain_pairs(chain)]
+    if not pairs:
+        return
+    years = dict() if years is None else dict(years)
+    unknown_years = sorted({descendant for (_, descendant, _) in pairs if descendant not in years})
+    for ids in chunks(unknown_years):
+        years.update(db_session.query(db.Article.id, db.Article.year).filter(db.Article.id.in_(ids)))
+
+    # Every statement below is split into chunks: a batch of deep chains has many pairs
+    pair_table = db.DescendantPair.__table__
+    ancestor_descendant = sorted({(ancestor, descendant) for (ancestor, descendant, _) in pairs})
+    known = set()
+    for keys in chunks(ancestor_descendant):
+        known.update(db_session.query(db.DescendantPair.ancestor_id, db.DescendantPair.descendant_id)
+                     .filter(tuple_(db.DescendantPair.ancestor_id, db.DescendantPair.descendant_id).in_(keys))
+                     .distinct())
+    new_at_depth = set()
+    pair_rows = [{"ancestor_id": ancestor, "descendant_id": descendant, "depth": depth}
+                 for (ancestor, descendant, depth) in sorted(set(pairs))]
+    for rows in chunks(pair_rows):
+        new_at_depth.update(db_session.execute(insert(pair_table)
+                                               .values(rows)
+                                               .on_conflict_do_nothing()
+                                               .returning(pair_table.c.ancestor_id, pair_table.c.descendant_id,
+                                                          pair_table.c.depth)))
+
+    generations = defaultdict(lambda: [0, 0, None, None])
+    articles = defaultdict(lambda: [0, 0, 0, None, None])
+    for (ancestor, descendant, depth) in pairs:
+        year = years.get(descendant)
+        generation = generations[(ancestor, depth)]
+        article = articles[ancestor]
+        generation[0] += 1
+        article[0] += 1
+        if (ancestor, descendant, depth) in new_at_depth:
+            generation[1] += 1
+            new_at_depth.discard((ancestor, descendant, depth))
+        if (ancestor, descendant) not in known:
+            article[1] += 1
+            known.add((ancestor, descendant))
+        article[2] = max(article[2], depth)
+        for stats, first, last in ((generation, 2, 3), (article, 3, 4)):
+            if year is not None:
+                stats[first] = year if stats[first] is None else min(stats[first], year)
+                stats[last] = year if stats[last] is None else max(stats[last], year)
+
+    # Rows are written in key order, so that concurrent scraper workers lock them in the same order
+    generation_table = db.GenerationStats.__table__
+    generation_rows = [{"article_id": ancestor, "depth": depth, "paths": paths, "descendants": descendants,
+                        "first_year": first_year, "last_year": last_year}
+                       for ((ancestor, depth), (paths, descendants, first_year, last_year))
+                       in sorted(generations.items())]
+    for rows in chunks(generation_rows):
+        statement = insert(generation_table).values(rows)
+        db_session.execute(statement.on_conflict_do_update(
+            index_elements=["article_id", "depth"],
+            set_={"paths": generation_table.c.paths + statement.excluded.paths,
+                  "descendants": generation_table.c.descendants + statement.excluded.descendants,
+                  "first_year": func.least(generation_table.c.first_year, statement.excluded.first_year),
+                  "last_year": func.greatest(generation_table.c.last_year, statement.excluded.last_year)}))
+
+    article_table = db.ArticleStats.__table__
+    article_rows = [{"article_id": ancestor, "paths": paths, "descendants": descendants, "max_depth": max_depth,
+                     "first_year": first_year, "last_year": last_year}
+                    for (ancestor, (paths, descendants, max_depth, first_year, last_year)) in sorted(articles.items())]
+    for rows in chunks(article_rows):
+        statement = insert(article_table).values(rows)
+        db_session.execute(statement.on_conflict_do_update(
+            index_elements=["article_id"],
+            set_={"paths": article_table.c.paths + statement.excluded.paths,
+                  "descendants": article_table.c.descendants + statement.excluded.descendants,
+                  "max_depth": func.greatest(article_table.c.max_depth, statement.excluded.max_depth),
+                  "first_year": func.least(article_table.c.first_year, statement.excluded.first_year),
+                  "last_year": func.greatest(article_table.c.last_year, statement.excluded.last_year)}))
+
+
+def refresh(db_session):
+    """
+    Rebuild the statistics tables from scratch from the citations table
+    :param db_session: A SQLAlchemy session object
+    """
+    db_session.execute(text("truncate descendant_pairs, generation_stats, article_stats;"))
+    db_session.execute(text("insert into descendant_pairs (ancestor_id, descendant_id, depth) "
+                            "select distinct ancestor_id, descendant_id, depth from (" + CHAIN_PAIRS_SQL + ") as pairs;"))
+    db_session.execute(text("insert into generation_stats (article_id, depth, paths, descendants, first_year, last_year) "
+                            "select pairs.ancestor_id, pairs.depth, count(*), count(distinct pairs.descendant_id), "
+                            "min(articles.year), max(articles.year) "
+                            "from (" + CHAIN_PAIRS_SQL + ") as pairs "
+                            "left join articles on pairs.descendant_id = articles.id "
+                            "group by pairs.ancestor_id, pairs.depth;"))
+    db_session.execute(text("insert into article_stats (article_id, paths, descendants, max_depth, first_year, last_year) "
+                            "select pairs.ancestor_id, count(*), count(distinct pairs.descendant_id), max(pairs.depth), "
+                            "min(articles.year), max(articles.year) "
+                            "from (" + CHAIN_PAIRS_SQL + ") as pairs "
+                            "left join articles on pairs.descendant_id = articles.id "
+                            "group by pairs.ancestor_id;"))
+    db_session.commit()
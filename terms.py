@@ -0,0 +1,94 @@
+import re
+import numpy as np
+
+RATES_TERMS = ["interest rate model", "libor", "euribor", "term structure",
+               "yield curve", "zero coupon", "discount curve", "bond",
+               "treasury", "gilt", "bund", "short rate", "eonia", "sonia",
+               "fed funds", "convexity", "duration", "maturity", "maturities",
+               "caplet", "cap", "swaption", "term premia", "term premium",
+               "forward rate", "yield", "cms", "market price of risk"]
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    """
+    Split text into lowercase alphanumeric tokens; punctuation and whitespace are separators
+    :param text: A string (None and NaN give no tokens)
+    :return: A list of strings
+    """
+    if not isinstance(text, str):
+        return []
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class TermMatcher:
+    """
+    Counts occurrences of a list of (possibly multi-word) terms in text. Terms match whole tokens, so
+    'cap' matches "Cap." at the start of a sentence or "cap," before a comma, but not "capital". With
+    prefix=True, the last word of each term also matches longer words (e.g. 'bond' matches "bonds").
+
+    Texts are converted once into arrays of vocabulary ids, cached by key (e.g. article ID), and
+    every term is then matched over the whole batch with NumPy lookups.
+    """
+    def __init__(self, terms=RATES_TERMS, prefix=False):
+        self.terms = list(terms)
+        self.prefix = prefix
+        self.term_tokens = [tuple(tokenize(term)) for term in self.terms]
+        self.vocabulary = dict()
+        self.tokenized = dict()
+
+    def token_ids(self, text, key=None):
+        """
+        :param key: Optional cache key; if given, the token ids are cached under it
+        :return: An array of vocabulary ids, one per token
+        """
+        if key is not None and key in self.tokenized:
+            return self.tokenized[key]
+        vocabulary = self.vocabulary
+        ids = np.fromiter((vocabulary.setdefault(token, len(vocabulary)) for token in tokenize(text)),
+                          dtype=np.int32)
+        if key is not None:
+            self.tokenized[key] = ids
+        return ids
+
+    def _word_lookup(self, word, is_last):
+        # Boolean array over the vocabulary: which token ids match this word of a term
+        lookup = np.zeros(len(self.vocabulary), dtype=bool)
+        if self.prefix and is_last:
+            lookup[[id for (token, id) in self.vocabulary.items() if token.startswith(word)]] = True
+        elif word in self.vocabulary:
+            lookup[self.vocabulary[word]] = True
+        return lookup
+
+    def count_matrix(self, texts, keys=None):
+        """
+        :param texts: An iterable of strings
+        :param keys: Optional iterable of cache keys, one per text
+        :return: An (n_texts x n_terms) array of term counts
+        """
+        texts = list(texts)
+        keys = [None] * len(texts) if keys is None else list(keys)
+        documents = [self.token_ids(text, key) for (text, key) in zip(texts, keys)]
+        matrix = np.zeros((len(texts), len(self.terms)), dtype=np.int32)
+        if not documents:
+            return matrix
+
+        ids = np.concatenate(documents)
+        document_index = np.repeat(np.arange(len(documents)), [len(document) for document in documents])
+        for (column, words) in enumerate(self.term_tokens):
+            n_starts = len(ids) - len(words) + 1
+            if not words or n_starts <= 0:
+                continue
+            # A term starts at position p if every word matches at p + offset and the match stays in one text
+            matches = document_index[:n_starts] == document_index[len(words) - 1:]
+            for (offset, word) in enumerate(words):
+                matches &= self._word_lookup(word, offset == len(words) - 1)[ids[offset:offset + n_starts]]
+            matrix[:, column] = np.bincount(document_index[:n_starts][matches], minlength=len(documents))
+        return matrix
+
+    def count(self, text, key=None):
+        """
+        :return: An array with the number of occurrences of each term in one text
+        """
+        return self.count_matrix([text], [key])[0]
@@ -1,2 +1,893 @@
+import collections
+import importlib.util
 import unittest
+import unittest.mock
+import os
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+import requests
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import operators
+import analysis
+import cache
+import corpus
+import db
+import focus
+import frontier
+import graph
+import http_client
+import metrics
+import rebuild
+import refresh
+import scraper
+import settings
+import similarity
+import stats
+import terms
+import writer
 
+REPEC_PAGE = """<html><head><title>Bond Pricing</title>
+<script type="application/ld+json">
+{"@context": "https://schema.org", "@graph": [
+ {"@id": "#periodical", "@type": "Periodical", "name": " Journal of Financial Economics "},
+ {"@id": "#number", "@type": "PublicationIssue", "datePublished": "1977-11"},
+ {"@id": "#article", "@type": "ScholarlyArticle", "name": "An equilibrium characterization of the term structure",
+  "author": "Vasicek, Oldrich & Someone, Else", "url": "https://ideas.repec.org/a/eee/jfinec/v5y1977i2p177-188.html",
+  "description": "The paper derives a general form of the term structure of interest rates.",
+  "keywords": "term structure; Bond Pricing"}]}
+</script></head><body><script>var x = "<script>";</script></body></html>"""
+
+CITEC_RESPONSE = """<?xml version="1.0" encoding="UTF-8"?>
+<citedBy><text ref="http://citec.repec.org/RePEc:eee:jfinec:v:6:y:1978:i:1:p:59-69">Dothan</text>
+<text ref='https://citec.repec.org/RePEc:bla:jfinan:v:41:y:1986:i:5:p:1011-29?a=1&amp;b=2'>Ho, Lee</text>
+</citedBy>"""
+
+CITEC_NOT_FOUND = "<citedBy><errorString>Requested document not found</errorString></citedBy>"
+
+CITEC_BLOCKED = "<citedBy><errorString>Too many requests from your IP</errorString></citedBy>"
+
+
+def parse_outcome(parser, handle, text):
+    """
+    Run a parser and return either its output or the type of exception it raised
+    """
+    try:
+        return parser(handle, text)
+    except Exception as e:
+        return type(e)
+
+
+class TestParsers(unittest.TestCase):
+    def test_repec_page(self):
+        handle = "RePEc:eee:jfinec:v:5:y:1977:i:2:p:177-188"
+        article = scraper.parse_repec_page(handle, REPEC_PAGE)
+        self.assertEqual(article, scraper.parse_repec_page_soup(handle, REPEC_PAGE))
+        self.assertEqual(article["venue"], "journal of financial economics")
+        self.assertEqual(article["year"], 1977)
+        self.assertEqual(article["authors"], ["vasicek, oldrich", "someone, else"])
+
+    def test_repec_page_without_json_ld(self):
+        with self.assertRaises(AttributeError):
+            scraper.parse_repec_page("RePEc:x:y", "<html><body>Not found</body></html>")
+
+    def test_citec_response(self):
+        handle = "RePEc:eee:jfinec:v:5:y:1977:i:2:p:177-188"
+        cites = scraper.parse_citec_response(handle, CITEC_RESPONSE)
+        self.assertEqual(cites, scraper.parse_citec_response_soup(handle, CITEC_RESPONSE))
+        self.assertEqual(cites, ["RePEc:eee:jfinec:v:6:y:1978:i:1:p:59-69",
+                                 "RePEc:bla:jfinan:v:41:y:1986:i:5:p:1011-29?a=1&b=2"])
+        self.assertEqual(scraper.parse_citec_entries(handle, CITEC_RESPONSE),
+                         [("RePEc:eee:jfinec:v:6:y:1978:i:1:p:59-69", "Dothan"),
+                          ("RePEc:bla:jfinan:v:41:y:1986:i:5:p:1011-29?a=1&b=2", "Ho, Lee")])
+
+    def test_citec_errors(self):
+        with self.assertRaises(scraper.NoDataException):
+            scraper.parse_citec_response("RePEc:x:y", CITEC_NOT_FOUND)
+        self.assertEqual(parse_outcome(scraper.parse_citec_response, "RePEc:x:y", CITEC_BLOCKED),
+                         parse_outcome(scraper.parse_citec_response_soup, "RePEc:x:y", CITEC_BLOCKED))
+
+
+class TestHttpClient(unittest.TestCase):
+    def response(self, status_code, text="", headers=None):
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = text.encode("utf-8")
+        response.headers.update(headers or {})
+        return response
+
+    def test_classify(self):
+        self.assertEqual(http_client.classify(self.response(200, CITEC_RESPONSE), http_client.CITEC_BLOCK_PATTERN),
+                         http_client.OK)
+        self.assertEqual(http_client.classify(self.response(200, CITEC_NOT_FOUND), http_client.CITEC_BLOCK_PATTERN),
+                         http_client.OK)
+        self.assertEqual(http_client.classify(self.response(200, CITEC_BLOCKED), http_client.CITEC_BLOCK_PATTERN),
+                         http_client.BLOCKED)
+        # Tags and messages in another case
+        self.assertEqual(http_client.classify(self.response(200, CITEC_BLOCKED.lower()),
+                                              http_client.CITEC_BLOCK_PATTERN),
+                         http_client.BLOCKED)
+        self.assertEqual(http_client.classify(self.response(200, CITEC_NOT_FOUND.upper()),
+                                              http_client.CITEC_BLOCK_PATTERN),
+                         http_client.OK)
+        self.assertEqual(http_client.classify(self.response(304)), http_client.NOT_MODIFIED)
+        self.assertEqual(http_client.classify(self.response(410)), http_client.PERMANENT)
+        self.assertEqual(http_client.classify(self.response(429)), http_client.THROTTLED)
+        self.assertEqual(http_client.classify(self.response(503)), http_client.TRANSIENT)
+
+    def test_retry_after(self):
+        self.assertEqual(http_client.retry_after(self.response(429, headers={"Retry-After": "120"})), 120)
+        self.assertIsNone(http_client.retry_after(self.response(429)))
+
+
+class TestMetrics(unittest.TestCase):
+    def test_disabled_metrics_record_nothing(self):
+        registry = metrics.Metrics()
+        registry.inc("cache_hits", source="repec")
+        with registry.timer("fetch_seconds", host="ideas.repec.org"):
+            pass
+        self.assertEqual(registry.snapshot()["counters"], [])
+        self.assertEqual(registry.snapshot()["histograms"], [])
+
+    def test_prometheus_text(self):
+        registry = metrics.Metrics(enabled=True)
+        registry.inc("cache_hits", source="repec")
+        registry.inc("cache_hits", source="repec")
+        registry.observe("fetch_seconds", 0.2, host="ideas.repec.org")
+        text = registry.prometheus_text()
+        self.assertIn('quantcites_cache_hits_total{source="repec"} 2', text)
+        self.assertIn('quantcites_fetch_seconds_bucket{host="ideas.repec.org",le="0.25"} 1', text)
+        self.assertIn('quantcites_fetch_seconds_bucket{host="ideas.repec.org",le="0.1"} 0', text)
+        self.assertIn('quantcites_fetch_seconds_count{host="ideas.repec.org"} 1', text)
+
+
+class TestRefresh(unittest.TestCase):
+    def test_new_citations(self):
+        handle = "RePEc:eee:jfinec:v:5:y:1977:i:2:p:177-188"
+        cites = scraper.parse_citec_response(handle, CITEC_RESPONSE)
+        self.assertEqual(refresh.new_citations(handle, CITEC_RESPONSE, CITEC_RESPONSE), [])
+        self.assertEqual(refresh.new_citations(handle, None, CITEC_RESPONSE), cites)
+        self.assertEqual(refresh.new_citations(handle, CITEC_NOT_FOUND, CITEC_RESPONSE), cites)
+        self.assertEqual(refresh.new_citations(handle, CITEC_BLOCKED, CITEC_RESPONSE), cites)
+        self.assertEqual(refresh.new_citations(handle, CITEC_RESPONSE, CITEC_NOT_FOUND), [])
+
+
+class TestFrontier(unittest.TestCase):
+    def test_put_aggregates_chains_per_handle(self):
+        queue = frontier.Frontier(Session())
+        queue.put(scraper.ArticleInfo("RePEc:x:y", [1, 2, 3]))
+        queue.put(scraper.ArticleInfo("RePEc:x:y", [1, 4]))
+        queue.put(scraper.ArticleInfo("RePEc:x:y", [1, 4]))
+        queue.put(scraper.ArticleInfo("RePEc:x:z", []), priority=5)
+        self.assertEqual(queue.pending, {"RePEc:x:y": [2, 2, {"1.2.3", "1.4"}], "RePEc:x:z": [5, 0, {""}]})
+
+    def test_claim_statement(self):
+        queue = frontier.Frontier(Session(), worker_id="worker-1", lease_seconds=60)
+        sql = str(queue.claim_statement(10).compile(dialect=postgresql.dialect()))
+        self.assertIn("FOR UPDATE SKIP LOCKED", sql)
+        self.assertIn("frontier.lease_expires IS NULL OR frontier.lease_expires < clock_timestamp()", sql)
+        self.assertIn("RETURNING frontier.handle, frontier.priority, frontier.id", sql)
+
+    def test_remap_ids(self):
+        queue = frontier.Frontier(Session())
+        queue.put(scraper.ArticleInfo("RePEc:x:y", [1, 2, 3]))
+        queue.put(scraper.ArticleInfo("RePEc:x:y", [1, 4]))
+        queue.remap_ids({3: 7})
+        self.assertEqual(queue.pending["RePEc:x:y"][2], {"1.2.7", "1.4"})
+
+    def test_renew_leases_only_in_shared_mode(self):
+        self.assertEqual(frontier.Frontier(Session()).renew_leases(), 0)
+
+    def test_parse_chain(self):
+        self.assertEqual(frontier.parse_chain("1.2.3"), [1, 2, 3])
+        self.assertEqual(frontier.parse_chain(""), [])
+
+
+class TestFocusedCrawl(unittest.TestCase):
+    def test_article_score(self):
+        crawl = focus.FocusedCrawl()
+        article = scraper.parse_repec_page("RePEc:eee:jfinec:v:5:y:1977:i:2:p:177-188", REPEC_PAGE)
+        # 'term structure' in the title, abstract and keywords, 'bond' in the keywords
+        self.assertEqual(crawl.article_score(article), 4)
+        crawl.record(4)
+        crawl.record(0)
+        self.assertEqual(crawl.relevant_share(), 0.5)
+
+    def test_rank_and_prune(self):
+        crawl = focus.FocusedCrawl(prune_depth=2)
+        ranked = crawl.rank([("RePEc:x:a", "Equity premia"), ("RePEc:x:b", "A LIBOR market model")], 3, 0)
+        self.assertEqual(ranked, [("RePEc:x:b", 1.5), ("RePEc:x:a", 3.0)])
+        # Two irrelevant articles in a row are still expanded, the third isn't
+        self.assertFalse(crawl.prune([1], 0))
+        self.assertFalse(crawl.prune([1, 2], 0))
+        self.assertTrue(crawl.may_prune([1, 2]))
+        self.assertTrue(crawl.prune([1, 2, 3], 0))
+        self.assertFalse(crawl.prune([1, 2, 4], 2))
+        self.assertFalse(crawl.may_prune([1, 2, 4]))
+        self.assertEqual(crawl.pruned, 1)
+
+
+class OfflineWriter(writer.BatchWriter):
+    """
+    BatchWriter that treats every handle as new, and has article ids reserved up front
+    """
+    def __init__(self, article_ids):
+        super().__init__(Session())
+        self.reserved_ids = list(article_ids)
+
+    def lookup_article_id(self, handle):
+        return self.pending_ids.get(handle)
+
+
+class StaticFetcher(scraper.SerialFetcher):
+    def __init__(self, citec_error=None):
+        super().__init__(None)
+        self.citec_error = citec_error
+
+    def repec_data(self, handle):
+        return scraper.parse_repec_page(handle, REPEC_PAGE)
+
+    def citec_cites(self, handle):
+        if self.citec_error is not None:
+            raise self.citec_error
+        return scraper.parse_citec_response(handle, CITEC_RESPONSE)
+
+
+class TestScrapeQueueItem(unittest.TestCase):
+    handle = "RePEc:eee:jfinec:v:5:y:1977:i:2:p:177-188"
+
+    def test_item_is_buffered_with_its_cites(self):
+        batch_writer = OfflineWriter([7])
+        queue = frontier.Frontier(Session())
+        link_count = scraper.scrape_queue_item(scraper.ArticleInfo(self.handle, [1]), batch_writer, StaticFetcher(),
+                                               queue, 0, 10)
+        self.assertEqual(link_count, 2)
+        self.assertEqual(batch_writer.chains, [(7, [1, 7])])
+        self.assertEqual([chains for (_, _, chains) in queue.pending.values()], [{"1.7"}, {"1.7"}])
+
+    def test_failed_cites_leave_nothing_buffered(self):
+        batch_writer = OfflineWriter([7])
+        queue = frontier.Frontier(Session())
+        with self.assertRaises(http_client.BlockedError):
+            scraper.scrape_queue_item(scraper.ArticleInfo(self.handle, [1]), batch_writer,
+                                      StaticFetcher(http_client.BlockedError("blocked", 403)), queue, 0, 10)
+        self.assertEqual(len(batch_writer), 0)
+        self.assertEqual(queue.pending, {})
+
+    def test_missing_cites_still_write_the_article(self):
+        batch_writer = OfflineWriter([7])
+        scraper.scrape_queue_item(scraper.ArticleInfo(self.handle, []), batch_writer,
+                                  StaticFetcher(scraper.NoDataException("none")), frontier.Frontier(Session()), 0, 10)
+        self.assertEqual(batch_writer.pending_ids, {self.handle: 7})
+
+    def test_discard(self):
+        batch_writer = OfflineWriter([7, 8])
+        batch_writer.add_article({"handle": "RePEc:x:a"})
+        mark = batch_writer.mark()
+        batch_writer.add_article({"handle": "RePEc:x:b"})
+        batch_writer.add_citation_chain(8, [8])
+        batch_writer.discard(mark)
+        self.assertEqual(batch_writer.articles, [(7, {"handle": "RePEc:x:a"})])
+        self.assertEqual(batch_writer.chains, [])
+        self.assertEqual(batch_writer.pending_ids, {"RePEc:x:a": 7})
+
+
+class TestTermMatcher(unittest.TestCase):
+    def counts(self, matcher, text):
+        return dict(zip(matcher.terms, matcher.count(text).tolist()))
+
+    def test_terms_at_the_edges_of_text(self):
+        matcher = terms.TermMatcher(["cap", "bond"])
+        self.assertEqual(self.counts(matcher, "Cap and bond"), {"cap": 1, "bond": 1})
+        self.assertEqual(self.counts(matcher, "bond"), {"cap": 0, "bond": 1})
+        self.assertEqual(self.counts(matcher, ""), {"cap": 0, "bond": 0})
+
+    def test_terms_next_to_punctuation(self):
+        matcher = terms.TermMatcher(["cap", "bond"])
+        self.assertEqual(self.counts(matcher, "Cap. A (bond), a cap; bond-cap"), {"cap": 3, "bond": 2})
+        # Whole tokens only
+        self.assertEqual(self.counts(matcher, "capital bonds"), {"cap": 0, "bond": 0})
+
+    def test_multi_word_terms(self):
+        matcher = terms.TermMatcher(["term structure", "market price of risk", "term"])
+        text = "Term structure. The term-structure and the market price of risk; term"
+        self.assertEqual(self.counts(matcher, text),
+                         {"term structure": 2, "market price of risk": 1, "term": 3})
+
+    def test_matches_stay_within_one_text(self):
+        matcher = terms.TermMatcher(["term structure"])
+        self.assertEqual(matcher.count_matrix(["a term", "structure b", "term structure"]).tolist(), [[0], [0], [1]])
+
+    def test_prefix_mode(self):
+        matcher = terms.TermMatcher(["bond", "yield curve"], prefix=True)
+        self.assertEqual(self.counts(matcher, "Bonds, bond and yield curves"), {"bond": 2, "yield curve": 1})
+        # Only the last word of a term may be longer, and only at its end
+        self.assertEqual(self.counts(matcher, "yields curve, abond"), {"bond": 0, "yield curve": 0})
+
+    def test_cached_token_ids(self):
+        matcher = terms.TermMatcher(["bond"])
+        self.assertEqual(matcher.count_matrix(["a bond", "no"], keys=[1, 2]).tolist(), [[1], [0]])
+        # Cached by key, so the text is not read again
+        self.assertEqual(matcher.count(None, key=1).tolist(), [1])
+
+
+def article_collection(rows):
+    """
+    :param rows: A list of (id, title) tuples
+    """
+    return analysis.ArticleCollection(pd.DataFrame(
+        [[id, "RePEc:x:" + str(id), title, 2000, "Author", "Venue", "", "Abstract " + str(id), "bond"]
+         for (id, title) in rows], columns=analysis.ARTICLE_COLUMNS))
+
+
+def old_combine(article_collections, handles_set=None):
+    # combine before it was built on ids and row positions
+    new = pd.concat([collection.articles_df for collection in article_collections]) \
+        .drop_duplicates(subset=["Handle"]).reset_index(drop=True)
+    if handles_set is not None:
+        new = new[new['Handle'].isin(list(handles_set))].reset_index(drop=True)
+    return new
+
+
+class TestSetOperations(unittest.TestCase):
+    def setUp(self):
+        # Id 3 occurs twice in the first collection
+        self.first = article_collection([(1, "a"), (2, "b"), (3, "c"), (3, "c again")])
+        self.second = article_collection([(3, "c elsewhere"), (4, "d")])
+        self.empty = article_collection([])
+
+    def test_set_operations_on_ids(self):
+        collections = [self.first, self.second]
+        self.assertEqual(analysis.intersect_ids(collections).tolist(), [3])
+        self.assertEqual(analysis.union_ids(collections).tolist(), [1, 2, 3, 4])
+        self.assertEqual(analysis.difference_ids(collections).tolist(), [1, 2])
+        self.assertEqual(analysis.intersect_handles(collections), {"RePEc:x:3"})
+        self.assertEqual(analysis.difference_handles(collections), {"RePEc:x:1", "RePEc:x:2"})
+
+    def test_set_operations_with_empty_collections(self):
+        self.assertEqual(analysis.intersect_ids([self.first, self.empty]).tolist(), [])
+        self.assertEqual(analysis.union_ids([self.empty, self.first]).tolist(), [1, 2, 3])
+        self.assertEqual(analysis.difference_ids([self.empty, self.first]).tolist(), [])
+        self.assertEqual(analysis.difference_ids([self.first, self.empty]).tolist(), [1, 2, 3])
+        self.assertEqual(len(analysis.combine([self.empty, self.empty])), 0)
+        self.assertEqual(len(analysis.combine([])), 0)
+
+    def test_shared_handles_percent_counts_duplicates_once(self):
+        self.assertEqual(analysis.shared_handles_percent([self.first, self.second]), 0.25)
+        self.assertEqual(analysis.shared_handles_percent([self.first, self.first]), 1.0)
+
+    def test_combine_keeps_the_first_row_of_each_id(self):
+        combined = analysis.combine([self.first, self.second])
+        self.assertEqual(combined.column("ID").tolist(), [1, 2, 3, 4])
+        self.assertEqual(combined.column("Title").tolist(), ["a", "b", "c", "d"])
+        pd.testing.assert_frame_equal(combined.articles_df, old_combine([self.first, self.second]))
+
+    def test_combine_filters(self):
+        collections = [self.first, self.second]
+        by_handle = analysis.combine(collections, handles_set={"RePEc:x:3", "RePEc:x:4", "RePEc:x:9"})
+        pd.testing.assert_frame_equal(by_handle.articles_df,
+                                      old_combine(collections, {"RePEc:x:3", "RePEc:x:4", "RePEc:x:9"}))
+        by_id = analysis.combine(collections, ids=analysis.intersect_ids(collections))
+        self.assertEqual(by_id.column("Title").tolist(), ["c"])
+
+    def test_collections_from_rows(self):
+        # Collections built by combine, before and after their DataFrame is built, behave as eager ones
+        for materialize in (False, True):
+            combined = analysis.combine([self.second, self.first])
+            if materialize:
+                combined.articles_df
+            self.assertEqual(len(combined), 4)
+            self.assertEqual(combined.ids.tolist(), [1, 2, 3, 4])
+            self.assertEqual(analysis.difference_ids([combined, self.second]).tolist(), [1, 2])
+            recombined = analysis.combine([combined, self.first], handles_set={"RePEc:x:1", "RePEc:x:3"})
+            pd.testing.assert_frame_equal(recombined.articles_df,
+                                          old_combine([combined, self.first], {"RePEc:x:1", "RePEc:x:3"}))
+            self.assertEqual(analysis.shared_handles_percent([combined, self.first]), 0.75)
+
+
+class HeavyColumnsSession:
+    """
+    Stands in for a session in LazyArticleCollection, answering heavy-column queries from a DataFrame
+    """
+    def __init__(self, df):
+        self.heavy = df.set_index("ID")[analysis.HEAVY_COLUMNS]
+        self.queries = 0
+
+    def execute(self, statement, params):
+        self.queries += 1
+        return [(id,) + tuple(self.heavy.loc[id]) for id in params["ids"]]
+
+
+class TestLazyArticleCollection(unittest.TestCase):
+    def test_lazy_collection_matches_eager_one(self):
+        eager = article_collection([(3, "c"), (1, "a"), (2, "b"), (1, "a again")])
+        other = article_collection([(2, "b elsewhere"), (5, "e")])
+        session = HeavyColumnsSession(eager.articles_df.drop_duplicates(subset=["ID"]))
+        lazy = analysis.LazyArticleCollection(eager.articles_df[analysis.LIGHT_COLUMNS], session, batch_size=2)
+
+        self.assertEqual(len(lazy), len(eager))
+        self.assertEqual(analysis.union_ids([lazy, other]).tolist(), analysis.union_ids([eager, other]).tolist())
+        combined_lazy = analysis.combine([lazy, other])
+        combined_eager = analysis.combine([eager, other])
+        self.assertEqual(len(combined_lazy), len(combined_eager))
+        self.assertEqual(session.queries, 0)
+
+        pd.testing.assert_frame_equal(combined_lazy.articles_df, combined_eager.articles_df)
+        with tempfile.TemporaryDirectory() as directory:
+            lazy.to_csv(os.path.join(directory, "lazy.csv"))
+            eager.to_csv(os.path.join(directory, "eager.csv"))
+            with open(os.path.join(directory, "lazy.csv")) as lazy_file, \
+                    open(os.path.join(directory, "eager.csv")) as eager_file:
+                self.assertEqual(lazy_file.read(), eager_file.read())
+        # Three distinct ids in batches of two, each fetched once
+        self.assertEqual(session.queries, 2)
+
+
+class ArticleSession:
+    """
+    Stands in for a session in corpus.unseen_articles, answering queries on db.Article from a dict of
+    article id -> abstract
+    """
+    def __init__(self, abstracts):
+        self.abstracts = abstracts
+
+    def query(self, *columns):
+        return ArticleQuery(self.abstracts, [column.key for column in columns])
+
+
+class ArticleQuery:
+    def __init__(self, abstracts, keys):
+        self.rows = [{"id": id, "abstract": abstract} for (id, abstract) in sorted(abstracts.items())]
+        self.keys = keys
+
+    def filter(self, *criteria):
+        for criterion in criteria:
+            key, value = criterion.left.key, criterion.right.value
+            if criterion.operator is operators.in_op:
+                self.rows = [row for row in self.rows if row[key] in value]
+            else:
+                # Comparisons with NULL are never true in SQL
+                self.rows = [row for row in self.rows if row[key] is not None and criterion.operator(row[key], value)]
+        return self
+
+    def order_by(self, *columns):
+        return self
+
+    def yield_per(self, count):
+        return self
+
+    def __iter__(self):
+        return iter([tuple(row[key] for key in self.keys) for row in self.rows])
+
+    def all(self):
+        return list(self)
+
+
+class TestTokenCorpus(unittest.TestCase):
+    def test_abstracts_are_tokenized_once(self):
+        tokenized = []
+
+        def tokenizer(text):
+            tokenized.append(text)
+            return text.split()
+
+        abstracts = {1: "a b", 3: "b c", 4: "", 5: None, 6: corpus.NO_ABSTRACT}
+        with tempfile.TemporaryDirectory() as directory:
+            token_corpus = corpus.TokenCorpus(directory, tokenizer)
+            self.assertEqual(token_corpus.update(ArticleSession(abstracts), batch_size=1), 2)
+            # An article committed later with a lower id than those already in the corpus
+            abstracts[2] = "c d"
+            self.assertEqual(token_corpus.update(ArticleSession(abstracts)), 1)
+            self.assertEqual(token_corpus.update(ArticleSession(abstracts)), 0)
+            self.assertEqual(tokenized, ["a b", "b c", "c d"])
+
+            reopened = corpus.TokenCorpus(directory, tokenizer)
+            self.assertEqual(list(reopened), [["a", "b"], ["b", "c"], ["c", "d"]])
+            self.assertEqual(reopened.article_ids.tolist(), [1, 3, 2])
+            self.assertEqual(reopened.vocabulary, ["a", "b", "c", "d"])
+            self.assertEqual(reopened.token_ids(2).tolist(), [2, 3])
+            self.assertEqual(len(tokenized), 3)
+
+
+class NoPhrases:
+    def __getitem__(self, tokens):
+        return tokens
+
+
+class ToyModel:
+    """
+    Stands in for a Word2Vec model, with the given word vectors
+    """
+    def __init__(self, word_vectors):
+        import gensim
+        self.wv = gensim.models.KeyedVectors(len(next(iter(word_vectors.values()))))
+        self.wv.add_vectors(list(word_vectors), np.array(list(word_vectors.values()), dtype=np.float32))
+
+
+def toy_engine(distance_store=None):
+    return similarity.SimilarityEngine(NoPhrases(), ToyModel({"rate": [1.0, 0.0], "yield": [0.9, 0.1],
+                                                              "bond": [0.95, 0.05], "option": [0.5, 0.5],
+                                                              "stock": [0.1, 0.9], "equity": [0.0, 1.0]}),
+                                       distance_store=distance_store)
+
+
+@unittest.skipUnless(importlib.util.find_spec("gensim") is not None, "gensim is not installed")
+class TestEmbeddingIndex(unittest.TestCase):
+    def test_update_adds_unseen_ids(self):
+        abstracts = {1: "rate bond", 3: "equity stock"}
+        engine = toy_engine()
+        index = similarity.EmbeddingIndex(engine)
+        self.assertEqual(index.update(ArticleSession(abstracts)), 2)
+        # Committed later with a lower id than those already indexed
+        abstracts[2] = "yield yield"
+        abstracts[4] = "stock option"
+        self.assertEqual(index.update(ArticleSession(abstracts), batch_size=1), 2)
+        self.assertEqual(index.update(ArticleSession(abstracts)), 0)
+        self.assertEqual(index.article_ids.tolist(), [1, 3, 2, 4])
+        self.assertEqual(index.positions, {1: 0, 3: 1, 2: 2, 4: 3})
+        # Bulk embedding leaves the token cache alone
+        self.assertEqual(engine.token_cache, dict())
+
+        article = collections.namedtuple("Article", "id abstract")
+        np.testing.assert_allclose(index.vector(article(2, abstracts[2])), engine.mean_vectors([2], ["yield"])[0])
+        ids, scores = index.nearest(index.vector(article(2, abstracts[2])), k=2, exclude=[2])
+        self.assertEqual(ids.tolist(), [1, 4])
+        # Articles that aren't indexed are embedded on the fly
+        np.testing.assert_allclose(index.vector(article(9, "equity")), [0.0, 1.0])
+
+
+@unittest.skipUnless(importlib.util.find_spec("gensim") is not None, "gensim is not installed")
+class TestSimilarityEngine(unittest.TestCase):
+    article = collections.namedtuple("Article", "id abstract")(1, "rate yield bond")
+    abstracts = {2: "rate bond", 3: "yield yield rate", 4: "equity stock", 5: "stock option", 6: "option rate",
+                 7: "bond bond yield", 8: "equity"}
+
+    def collection(self):
+        return analysis.ArticleCollection(pd.DataFrame({"ID": list(self.abstracts),
+                                                        "Handle": ["RePEc:x:" + str(id) for id in self.abstracts],
+                                                        "Abstract": list(self.abstracts.values())}))
+
+    def test_prefiltered_ranking_matches_brute_force(self):
+        engine = toy_engine()
+        brute_force = sorted((engine.model.wv.wmdistance(engine.tokens(self.article.id, self.article.abstract),
+                                                         engine.tokens(id, abstract)), id)
+                             for (id, abstract) in self.abstracts.items())
+        ranked = engine.rank(self.article, self.collection(), top_k=3)
+        self.assertEqual(ranked.ID.to_list(), [id for (_, id) in brute_force[:3]])
+        np.testing.assert_allclose(ranked.WMD, [distance for (distance, _) in brute_force[:3]])
+        # Without a prefilter, the ranking is the brute-force one
+        self.assertEqual(engine.rank(self.article, self.collection(), top_k=len(self.abstracts)).ID.to_list(),
+                         [id for (_, id) in brute_force])
+
+    def test_distances_are_stored(self):
+        store = similarity.DistanceStore(":memory:")
+        engine = toy_engine(store)
+        abstracts = dict(self.abstracts)
+        abstracts[1] = self.article.abstract
+        distances = engine.wm_distances([(2, 1), (1, 3), (3, 1)], abstracts)
+        self.assertEqual(sorted(distances), [(1, 2), (1, 3)])
+        self.assertEqual(store.get_many([(1, 2), (3, 1), (1, 4)]), distances)
+        # Stored distances aren't computed again
+        with unittest.mock.patch.object(engine.model.wv, "wmdistance") as wmdistance:
+            self.assertEqual(engine.wm_distances([(1, 2)], abstracts), {(1, 2): distances[(1, 2)]})
+        wmdistance.assert_not_called()
+
+    def test_pairwise(self):
+        engine = toy_engine()
+        pairs = engine.pairwise(self.collection(), top_k=1)
+        self.assertTrue((pairs.ID_1 < pairs.ID_2).all())
+        # Every article is paired with its nearest neighbour by mean-vector cosine
+        self.assertEqual(set(pairs.ID_1) | set(pairs.ID_2), set(self.abstracts))
+
+
+class TestParsePoolFetcher(unittest.TestCase):
+    handle = "RePEc:eee:jfinec:v:5:y:1977:i:2:p:177-188"
+
+    def test_parses_cached_pages_in_worker_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for storage_class in (cache.DirectoryStorage, cache.PackStorage):
+                storage = storage_class(directory)
+                storage.write("repec", self.handle, REPEC_PAGE)
+                storage.write("citec", self.handle, CITEC_RESPONSE)
+                fetcher = rebuild.ParsePoolFetcher(directory + "/", storage_class, processes=1)
+                try:
+                    fetcher.prefetch(self.handle)
+                    fetcher.prefetch_cites(self.handle)
+                    self.assertEqual(fetcher.repec_data(self.handle), scraper.parse_repec_page(self.handle, REPEC_PAGE))
+                    self.assertEqual(fetcher.citec_cites(self.handle),
+                                     scraper.parse_citec_response(self.handle, CITEC_RESPONSE))
+                    self.assertEqual(fetcher.pending, {})
+                    # Exceptions raised while parsing reach the scraper
+                    with self.assertRaises(cache.NotCachedException):
+                        fetcher.repec_data("RePEc:eee:jfinec:v:6:y:1978:i:1:p:1-2")
+                    fetcher.prefetch("RePEc:eee:jfinec:v:6:y:1978:i:1:p:1-2")
+                    fetcher.discard_pending()
+                    self.assertEqual(fetcher.pending, {})
+                finally:
+                    fetcher.close()
+
+
+class TestThreadedFetcher(unittest.TestCase):
+    def test_discard_pending_drops_unused_prefetches(self):
+        class SlowCache:
+            def __init__(self):
+                self.release = threading.Event()
+
+            def request_repec(self, handle):
+                self.release.wait(5)
+
+        slow_cache = SlowCache()
+        fetcher = scraper.ThreadedFetcher(slow_cache, 1)
+        fetcher.prefetch("RePEc:x:1")
+        fetcher.prefetch("RePEc:x:2")
+        queued = fetcher.pending[("repec", "RePEc:x:2")]
+        fetcher.discard_pending()
+        slow_cache.release.set()
+        fetcher.close()
+        self.assertEqual(fetcher.pending, {})
+        self.assertTrue(queued.cancelled())
+
+
+class TestNameCache(unittest.TestCase):
+    def test_least_recently_used_names_are_evicted(self):
+        name_cache = writer.NameCache(maxsize=2)
+        name_cache.put("a", 1)
+        name_cache.put("b", 2)
+        self.assertEqual(name_cache.get("a"), 1)
+        name_cache.put("c", 3)
+        self.assertIsNone(name_cache.get("b"))
+        self.assertEqual((name_cache.get("a"), name_cache.get("c")), (1, 3))
+        self.assertEqual(len(name_cache), 2)
+        self.assertEqual(name_cache.stats()["hits"], 3)
+        self.assertEqual(name_cache.stats()["misses"], 1)
+
+    def test_rollback_drops_uncommitted_ids(self):
+        name_cache = writer.NameCache()
+        name_cache.put("committed", 1)
+        name_cache.put("earlier", 2, committed=False)
+        name_cache.commit()
+        name_cache.put("inserted", 3, committed=False)
+        name_cache.rollback()
+        self.assertEqual(name_cache.get("committed"), 1)
+        self.assertEqual(name_cache.get("earlier"), 2)
+        self.assertIsNone(name_cache.get("inserted"))
+
+    def test_evicted_uncommitted_ids_are_forgotten(self):
+        name_cache = writer.NameCache(maxsize=1)
+        name_cache.put("inserted", 1, committed=False)
+        name_cache.put("committed", 2)
+        name_cache.rollback()
+        self.assertEqual(name_cache.uncommitted, set())
+        self.assertEqual(name_cache.get("committed"), 2)
+
+
+class TestCitationStats(unittest.TestCase):
+    def test_chain_pairs(self):
+        self.assertEqual(stats.chain_pairs([1, 10, 12]), [(1, 12, 2), (10, 12, 1)])
+        self.assertEqual(stats.chain_pairs([1]), [])
+
+    def test_record_chains_in_chunks(self):
+        class RowCountingSession:
+            def __init__(self):
+                self.rows = []
+                self.queries = 0
+
+            def query(self, *columns):
+                self.queries += 1
+                return self
+
+            def filter(self, *criteria):
+                return self
+
+            def distinct(self):
+                return self
+
+            def __iter__(self):
+                return iter([])
+
+            def execute(self, statement):
+                self.rows.append((statement.table.name, len(statement._multi_values[0])))
+                return []
+
+        session = RowCountingSession()
+        with unittest.mock.patch.object(stats, "WRITE_CHUNK_SIZE", 2):
+            # 5 pairs, 5 (ancestor, depth) generations and 3 ancestors; years of descendants 4 and 5 are unknown
+            stats.record_chains(session, [[1, 2, 3, 4], [1, 2, 5]], years={3: 2000, 2: 1999})
+        self.assertEqual(session.rows, [("descendant_pairs", 2), ("descendant_pairs", 2), ("descendant_pairs", 1),
+                                        ("generation_stats", 2), ("generation_stats", 2), ("generation_stats", 1),
+                                        ("article_stats", 2), ("article_stats", 1)])
+        # One query for the two unknown years, three for the five (ancestor, descendant) keys
+        self.assertEqual(session.queries, 4)
+
+
+class TestCitationGraph(unittest.TestCase):
+    def setUp(self):
+        # 2 and 3 cite 1, 4 cites 2 and 3, 5 cites 4; 9 has no citations
+        self.graph = graph.CitationGraph.from_edges([2, 3, 4, 4, 5], [1, 1, 2, 3, 4],
+                                                    [(1, "a"), (2, "b"), (3, "c"), (4, "d"), (5, "e"), (9, "z")])
+
+    def test_traversal(self):
+        self.assertEqual(list(self.graph.bfs(0)), [0, 1, 1, 2, 3, -1])
+        self.assertEqual(list(self.graph.k_hop(0, 2)), [1, 2, 3])
+        self.assertEqual(self.graph.shortest_path(0, 4), [0, 1, 3, 4])
+        self.assertIsNone(self.graph.shortest_path(4, 0))
+        self.assertEqual(list(self.graph.common_ancestors(1, 2)), [0])
+
+    def test_lookups(self):
+        self.assertEqual(list(self.graph.index_of([1, 9])), [0, 5])
+        self.assertEqual(self.graph.handles([4, 5]), ["e", "z"])
+        self.assertEqual(self.graph.index_of_handle("c"), 2)
+        with self.assertRaises(KeyError):
+            self.graph.index_of(7)
+
+    def test_rankings(self):
+        nodes, counts = self.graph.co_citations(1)
+        self.assertEqual([list(nodes), list(counts)], [[2], [1]])
+        rank = self.graph.pagerank()
+        self.assertAlmostEqual(rank.sum(), 1.0)
+        self.assertEqual(rank.argmax(), 0)
+
+
+class StatementSession:
+    """
+    Stands in for a session, recording the SQL it is asked to execute
+    """
+    def __init__(self):
+        self.statements = []
+        self.commits = 0
+
+    def execute(self, statement, params=None):
+        self.statements.append(str(statement))
+
+    def commit(self):
+        self.commits += 1
+
+
+class TestCitationEdges(unittest.TestCase):
+    def test_citation_edge_from_chain(self):
+        self.assertEqual(db.citation_edge_from_chain([1, 10, 12]), (12, 10))
+        self.assertEqual(db.citation_edge_from_chain([1, 10]), (10, 1))
+        self.assertIsNone(db.citation_edge_from_chain([1]))
+        self.assertIsNone(db.citation_edge_from_chain([]))
+
+    def test_backfill_citation_edges(self):
+        session = StatementSession()
+        db.backfill_citation_edges(session)
+        self.assertEqual(session.commits, 1)
+        # The last label of each chain cites the one before it, as in citation_edge_from_chain
+        self.assertIn("insert into citation_edges (citing_id, cited_id) "
+                      "select distinct ltree2text(subpath(citation_chain, -1))::bigint, "
+                      "ltree2text(subpath(citation_chain, -2, 1))::bigint", session.statements[0])
+        self.assertIn("nlevel(citation_chain) > 1", session.statements[0])
+
+
+class RecordingClient:
+    """
+    Stands in for http_client.HttpClient, answering every request with the same text
+    """
+    def __init__(self, text):
+        self.text = text
+        self.urls = []
+
+    def get(self, url, headers=None, limiter=None, block_pattern=None):
+        self.urls.append(url)
+        response = requests.Response()
+        response.status_code = 200
+        response.encoding = "utf-8"
+        response._content = self.text.encode("utf-8")
+        return response
+
+
+class TestDataCache(unittest.TestCase):
+    # A handle with a '/', which is stored under a file name with '_' instead
+    handle = "RePEc:nbr:nberwo:1234/5"
+
+    def test_downloaded_pages_are_found_again(self):
+        with tempfile.TemporaryDirectory() as directory:
+            client = RecordingClient(REPEC_PAGE)
+            data_cache = cache.DataCache(directory, client=client)
+            self.assertEqual(data_cache.request_repec(self.handle), REPEC_PAGE)
+            self.assertEqual(data_cache.request_repec(self.handle), REPEC_PAGE)
+            self.assertEqual(len(client.urls), 1)
+            # In a later run, from the persisted index, and from an index rebuilt from the cache directory
+            self.assertEqual(cache.DataCache(directory, offline=True).request_repec(self.handle), REPEC_PAGE)
+            os.remove(os.path.join(directory, "cache_index.sqlite"))
+            self.assertEqual(cache.DataCache(directory, offline=True).request_repec(self.handle), REPEC_PAGE)
+            with self.assertRaises(cache.NotCachedException):
+                cache.DataCache(directory, offline=True).request_repec("RePEc:nbr:nberwo:1234_5x")
+
+
+class TestCacheStorage(unittest.TestCase):
+    entries = {("repec", "RePEc:eee:jfinec:v:5:y:1977:i:2:p:177-188"): REPEC_PAGE,
+               ("repec", "RePEc:nbr:nberwo:1234_5"): "<html>Zürich, 5 % — ünïcode</html>",
+               ("citec", "RePEc:eee:jfinec:v:5:y:1977:i:2:p:177-188"): CITEC_RESPONSE}
+
+    def write_entries(self, storage):
+        for ((source, name), text) in self.entries.items():
+            storage.write(source, name, text)
+
+    def assert_entries(self, storage):
+        for ((source, name), text) in self.entries.items():
+            self.assertEqual(storage.read(source, name), text)
+        self.assertEqual(sorted(storage.names("repec")),
+                         sorted(name for (source, name) in self.entries if source == "repec"))
+
+    def test_pack_storage_round_trip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            storage = cache.PackStorage(directory + "/")
+            self.write_entries(storage)
+            self.assert_entries(storage)
+            self.assertIsNone(storage.read("repec", "RePEc:x:missing"))
+            # A rewritten entry reads as its newest copy, also after reopening the pack
+            storage.write("citec", "RePEc:eee:jfinec:v:5:y:1977:i:2:p:177-188", CITEC_NOT_FOUND)
+            reopened = cache.PackStorage(directory + "/")
+            self.assertEqual(reopened.read("citec", "RePEc:eee:jfinec:v:5:y:1977:i:2:p:177-188"), CITEC_NOT_FOUND)
+            self.assertEqual(reopened.read("repec", "RePEc:nbr:nberwo:1234_5"),
+                             self.entries[("repec", "RePEc:nbr:nberwo:1234_5")])
+
+    def test_migrate_directory_to_pack(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.write_entries(cache.DirectoryStorage(directory + "/"))
+            pack_storage = cache.PackStorage(directory + "/")
+            self.assertEqual(cache.migrate_storage(cache.DirectoryStorage(directory + "/"), pack_storage),
+                             len(self.entries))
+            self.assert_entries(pack_storage)
+            # As scrape_RePEc.py --storage pack opens it
+            data_cache = cache.DataCache(directory, storage=cache.STORAGE_CLASSES["pack"](directory), offline=True)
+            self.assertEqual(data_cache.request_repec("RePEc:nbr:nberwo:1234/5"),
+                             self.entries[("repec", "RePEc:nbr:nberwo:1234_5")])
+
+
+class TestRefreshInterrupted(unittest.TestCase):
+    handles = ["RePEc:eee:jfinec:v:5:y:1977:i:2:p:177-188", "RePEc:eee:jfinec:v:6:y:1978:i:1:p:1-2"]
+
+    def test_interrupted_refresh_keeps_the_old_list(self):
+        cites = scraper.parse_citec_response(self.handles[0], CITEC_RESPONSE)
+        with tempfile.TemporaryDirectory() as directory:
+            data_cache = cache.DataCache(directory, client=RecordingClient(CITEC_RESPONSE))
+            for handle in self.handles:
+                data_cache.storage.write("citec", handle, CITEC_NOT_FOUND)
+            queued = []
+
+            def store(handle, old_text, new_text):
+                if handle == self.handles[1]:
+                    # e.g. the frontier commit failed, or the run was interrupted
+                    raise http_client.BlockedError("blocked", 403)
+                queued.append((handle, refresh.new_citations(handle, old_text, new_text)))
+
+            data_cache.refresh_citec(self.handles[0], before_store=lambda old, new: store(self.handles[0], old, new))
+            with self.assertRaises(http_client.BlockedError):
+                data_cache.refresh_citec(self.handles[1], before_store=lambda old, new: store(self.handles[1], old, new))
+            self.assertEqual(queued, [(self.handles[0], cites)])
+            self.assertEqual(data_cache.storage.read("citec", self.handles[1]), CITEC_NOT_FOUND)
+            self.assertIsNone(data_cache.fetch_log.lookup("citec", self.handles[1]))
+
+            # The next run skips the refreshed handle, and still finds the new citations of the other one
+            self.assertIsNone(data_cache.refresh_citec(self.handles[0]))
+            self.assertEqual(refresh.new_citations(self.handles[1], *data_cache.refresh_citec(self.handles[1])), cites)
+
+
+@unittest.skipUnless(os.path.exists(settings.CACHE_LOCATION), "No local cache to compare parsers on")
+class TestParsersOnCache(unittest.TestCase):
+    """
+    Differential test: the regex parsers must agree with the BeautifulSoup parsers on every cached page
+    """
+    def compare_source(self, source, parser, soup_parser):
+        storage = cache.DataCache().storage
+        for name in storage.names(source):
+            text = storage.read(source, name)
+            handle = name.replace("_", "/")
+            self.assertEqual(parse_outcome(parser, handle, text), parse_outcome(soup_parser, handle, text),
+                             msg=source + " entry " + name)
+
+    def test_repec_pages(self):
+        self.compare_source("repec", scraper.parse_repec_page, scraper.parse_repec_page_soup)
+
+    def test_citec_responses(self):
+        self.compare_source("citec", scraper.parse_citec_response, scraper.parse_citec_response_soup)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+import logging
+import os
+import socket
+import time
+from urllib.parse import urlsplit
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql import func, text
+import cache
+import db
+import scraper
+import settings
+from frontier import Frontier
+
+# Reserve the next request slot of a host, and return how many seconds there are until it
+RESERVE_SQL = text("update host_rate_limits "
+                   "set next_request_at = greatest(next_request_at, clock_timestamp()) + "
+                   "seconds_between_requests * interval '1 second' "
+                   "where host = :host "
+                   "returning extract(epoch from next_request_at - seconds_between_requests * interval '1 second' "
+                   "- clock_timestamp())")
+
+# Longest sleep between two calls of a DatabaseRateLimiter's heartbeats
+HEARTBEAT_SECONDS = 30
+
+# SQLSTATE codes of transactions Postgres aborted because of concurrent ones: deadlock, serialization failure
+RETRYABLE_SQLSTATES = {"40P01", "40001"}
+
+PAUSE_SQL = text("update host_rate_limits "
+                 "set next_request_at = greatest(next_request_at, clock_timestamp() + :seconds * interval '1 second') "
+                 "where host = :host")
+
+
+class DatabaseRateLimiter:
+    """
+    Rate limit for one upstream host, shared by every worker process through its row in host_rate_limits.
+    acquire() reserves the host's next free request slot with a single UPDATE and sleeps until it comes,
+    so all workers together make at most one request every seconds_between_requests seconds; pause()
+    holds back the host for every worker. Times come from the database clock, so the clocks of the
+    machines running the workers needn't agree. Same interface as cache.RateLimiter.
+
+    Waits can be long (e.g. a 15 minute block back-off), so they are slept in slices, calling every function
+    in heartbeats in between; run_worker uses this to renew the worker's frontier leases.
+    """
+    def __init__(self, engine, host, seconds_between_requests):
+        """
+        :param engine: A SQLAlchemy engine; every acquire() is a short transaction on a connection of its own
+        :param host: Key of the host's row, e.g. ideas.repec.org
+        :param seconds_between_requests: Stored in the host's row; the last worker to start sets it
+        """
+        self.engine = engine
+        self.host = host
+        self.seconds_between_requests = seconds_between_requests
+        self.heartbeats = []
+        rate_table = db.HostRateLimit.__table__
+        statement = insert(rate_table).values(host=host, seconds_between_requests=seconds_between_requests,
+                                              next_request_at=func.clock_timestamp())
+        with engine.begin() as connection:
+            connection.execute(statement.on_conflict_do_update(
+                index_elements=["host"],
+                set_={"seconds_between_requests": statement.excluded.seconds_between_requests}))
+
+    def acquire(self):
+        """
+        Block until this worker's request slot for the host comes
+        :return: Number of seconds spent waiting
+        """
+        with self.engine.begin() as connection:
+            delay = connection.execute(RESERVE_SQL, {"host": self.host}).scalar()
+        delay = max(0.0, float(delay))
+        self.sleep(delay)
+        return delay
+
+    def sleep(self, seconds):
+        """
+        Sleep, calling the heartbeats at least every HEARTBEAT_SECONDS
+        """
+        end = time.monotonic() + seconds
+        while True:
+            for heartbeat in self.heartbeats:
+                heartbeat()
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, HEARTBEAT_SECONDS))
+
+    def pause(self, seconds):
+        """
+        Hold back every worker's requests to the host for the given number of seconds, e.g. after a 429 response
+        """
+        with self.engine.begin() as connection:
+            connection.execute(PAUSE_SQL, {"host": self.host, "seconds": seconds})
+
+
+def default_worker_id():
+    return socket.gethostname() + ":" + str(os.getpid())
+
+
+def database_limiters(engine, repec_base_url=cache.REPEC_BASE_URL, citec_base_url=cache.CITEC_BASE_URL,
+                      seconds_between_requests=None):
+    """
+    :param seconds_between_requests: Optional wait for both hosts, instead of the ones in settings
+    :return: (RePEc limiter, CitEc limiter), both DatabaseRateLimiter objects keyed by host name. If both
+    sources are served by the same host (e.g. a stand-in server), they share one limiter with the longer wait.
+    """
+    repec_wait = settings.REPEC_WAIT_BETWEEN_REQUESTS if seconds_between_requests is None else seconds_between_requests
+    citec_wait = settings.CITEC_WAIT_BETWEEN_REQUESTS if seconds_between_requests is None else seconds_between_requests
+    repec_host = urlsplit(repec_base_url).netloc
+    citec_host = urlsplit(citec_base_url).netloc
+    if repec_host == citec_host:
+        limiter = DatabaseRateLimiter(engine, repec_host, max(repec_wait, citec_wait))
+        return limiter, limiter
+    return DatabaseRateLimiter(engine, repec_host, repec_wait), DatabaseRateLimiter(engine, citec_host, citec_wait)
+
+
+def run_worker(engine,
+               seed_handles,
+               max_links=100,
+               worker_id=None,
+               lease_seconds=600,
+               cache_location=settings.CACHE_LOCATION,
+               repec_base_url=cache.REPEC_BASE_URL,
+               citec_base_url=cache.CITEC_BASE_URL,
+               seconds_between_requests=None,
+               workers=2,
+               poll_interval=5,
+               focus=None,
+               storage_class=None):
+    """
+    Crawl as one of several worker processes, on this machine or others, sharing the database's frontier and
+    per-host rate limits. Each worker keeps its own cache (workers on one machine may share a cache directory).
+    Start as many as needed, once the database is migrated (db.migrate); each stops when the frontier is
+    empty. If Postgres aborts a worker's transaction because of a deadlock with another worker, the worker
+    starts over from its last commit. Workers write the citation statistics concurrently, so run
+    scripts/refresh_citation_stats.py once they are done.
+    :param engine: A SQLAlchemy engine for the shared database
+    :param worker_id: Name of this worker in frontier leases; defaults to host name and process id
+    :param lease_seconds: How long handles taken by this worker are kept from the others; after a crash,
+    its handles are claimed again once their leases expire
+    :param seconds_between_requests: Optional wait between requests to each host, across all workers,
+    instead of the ones in settings
+    :param workers: Number of download threads per host within this worker
+    :param focus: Optional focus.FocusedCrawl (see scraper.repec_scraper)
+    :param storage_class: Optional cache storage backend class (e.g. cache.PackStorage)
+    """
+    worker_id = default_worker_id() if worker_id is None else worker_id
+    repec_limiter, citec_limiter = database_limiters(engine, repec_base_url, citec_base_url,
+                                                     seconds_between_requests)
+    storage = None if storage_class is None else storage_class(cache_location)
+    data_cache = cache.DataCache(cache_location, storage=storage, repec_base_url=repec_base_url,
+                                 citec_base_url=citec_base_url, repec_limiter=repec_limiter, citec_limiter=citec_limiter)
+    Session = sessionmaker(bind=engine)
+    logging.info("Worker " + worker_id + " starting")
+    while True:
+        db_session = Session()
+        frontier = Frontier(db_session, worker_id, lease_seconds)
+        for limiter in {repec_limiter, citec_limiter}:
+            limiter.heartbeats = [frontier.renew_leases]
+        released = frontier.release_leases()
+        if released:
+            logging.warning("Released " + str(released) + " handles still leased to " + worker_id)
+        try:
+            scraper.repec_scraper(db_session, data_cache, seed_handles,
+                                  max_links=max_links,
+                                  workers=workers,
+                                  focus=focus,
+                                  frontier=frontier,
+                                  poll_interval=poll_interval)
+            break
+        except DBAPIError as e:
+            if getattr(e.orig, "pgcode", None) not in RETRYABLE_SQLSTATES:
+                raise
+            logging.warning("Worker " + worker_id + " was aborted by the database (" + str(e.orig).strip() +
+                            "); starting over from its last commit")
+            db_session.rollback()
+        finally:
+            db_session.close()
+    logging.info("Worker " + worker_id + " finished")
@@ -0,0 +1,308 @@
+import logging
+from collections import OrderedDict
+from sqlalchemy import event, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql.expression import text
+import db
+import stats
+from metrics import registry as metrics
+
+
+class NameCache:
+    """
+    Bounded LRU map of name -> id for one of the venue/author/keyword tables. Ids inserted in the
+    current transaction are tracked, and dropped again if the transaction is rolled back.
+    """
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.ids = OrderedDict()
+        self.uncommitted = set()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, name):
+        id = self.ids.get(name)
+        if id is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.ids.move_to_end(name)
+        return id
+
+    def put(self, name, id, committed=True):
+        self.ids[name] = id
+        self.ids.move_to_end(name)
+        if not committed:
+            self.uncommitted.add(name)
+        while len(self.ids) > self.maxsize:
+            evicted, _ = self.ids.popitem(last=False)
+            self.uncommitted.discard(evicted)
+
+    def commit(self):
+        self.uncommitted = set()
+
+    def rollback(self):
+        for name in self.uncommitted:
+            self.ids.pop(name, None)
+        self.uncommitted = set()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"size": len(self.ids),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total > 0 else 0.0}
+
+
+class BatchWriter:
+    """
+    Buffers scraped articles and their citation chains, and writes them to the database in
+    batches: one bulk IN lookup per venue/author/keyword table, multi-row INSERTs, and a single
+    commit per batch.
+
+    Article ids are reserved from articles_id_seq before an article is buffered, so the scraper
+    can build citation chains for its citing articles before the article is written.
+
+    Nothing is flushed while an item is being added: the scraper calls flush_if_full() between items,
+    so a commit never holds half of an item, and can discard() what it buffered for an item that failed.
+    """
+    def __init__(self, db_session, batch_size=100, name_cache_size=100000):
+        self.db_session = db_session
+        self.batch_size = batch_size
+        self.articles = []
+        self.chains = []
+        self.pending_ids = dict()
+        self.reserved_ids = []
+        # Called with a dict of buffered id -> stored id when articles turn out to be in the database already
+        self.remap_listeners = []
+        self.name_caches = {"venues": NameCache(name_cache_size),
+                            "authors": NameCache(name_cache_size),
+                            "keywords": NameCache(name_cache_size)}
+        event.listen(db_session, "after_commit", self._commit_name_caches)
+        event.listen(db_session, "after_rollback", self._rollback_name_caches)
+
+    def _commit_name_caches(self, session):
+        for name_cache in self.name_caches.values():
+            name_cache.commit()
+
+    def _rollback_name_caches(self, session):
+        for name_cache in self.name_caches.values():
+            name_cache.rollback()
+
+    def warm_name_caches(self):
+        """
+        Fill the name caches with the venues, authors and keywords attached to the most articles
+        """
+        association_tables = {"venues": (db.Article.__table__, "venue_id"),
+                              "authors": (db.author_article_association, "author_id"),
+                              "keywords": (db.keyword_article_association, "keyword_id")}
+        for table in (db.Venue.__table__, db.Author.__table__, db.Keyword.__table__):
+            name_cache = self.name_caches[table.name]
+            name_column = table.c["keyword" if table.name == "keywords" else "name"]
+            association, id_column = association_tables[table.name]
+            usage = func.count(association.c[id_column])
+            rows = self.db_session.execute(table.select()
+                                           .with_only_columns([name_column, table.c.id])
+                                           .select_from(table.outerjoin(association,
+                                                                        association.c[id_column] == table.c.id))
+                                           .group_by(table.c.id)
+                                           .order_by(usage.desc())
+                                           .limit(name_cache.maxsize))
+            # Insert least used first, so the most used names are the last to be evicted
+            for (name, id) in reversed(rows.fetchall()):
+                name_cache.put(name, id)
+            logging.info("Warmed " + table.name + " name cache with " + str(len(name_cache)) + " entries")
+
+    def name_cache_stats(self):
+        return {table_name: name_cache.stats() for (table_name, name_cache) in self.name_caches.items()}
+
+    def __len__(self):
+        return len(self.articles) + len(self.chains)
+
+    def reserve_article_id(self):
+        """
+        :return: A new article id, for an article that may be added with add_article
+        """
+        if not self.reserved_ids:
+            sql_statement = text("select nextval('articles_id_seq') from generate_series(1, :n)")
+            self.reserved_ids = [row[0] for row in self.db_session.execute(sql_statement, {"n": self.batch_size})]
+        return self.reserved_ids.pop(0)
+
+    def lookup_article_id(self, handle):
+        """
+        Find the id of an article, whether it is buffered or already in the database
+        :param handle: A RePEc handle
+        :return: The article's id, or None if it hasn't been scraped
+        """
+        if handle in self.pending_ids:
+            return self.pending_ids[handle]
+        existing_entry = self.db_session.query(db.Article.id).filter_by(handle=handle).scalar()
+        return existing_entry
+
+    def add_article(self, extracted_article, article_id=None):
+        """
+        Buffer an article returned by scraper.get_repec_data
+        :param article_id: An id from reserve_article_id; one is reserved if not given
+        :return: The id the article will be written with
+        """
+        article_id = self.reserve_article_id() if article_id is None else article_id
+        self.articles.append((article_id, extracted_article))
+        self.pending_ids[extracted_article["handle"]] = article_id
+        return article_id
+
+    def add_citation_chain(self, entry_id, citation_chain_list):
+        self.chains.append((entry_id, citation_chain_list))
+
+    def mark(self):
+        """
+        :return: A position in the buffers, to discard() back to
+        """
+        return len(self.articles), len(self.chains)
+
+    def discard(self, mark):
+        """
+        Drop everything buffered since mark(), e.g. for an item that failed half-way
+        """
+        n_articles, n_chains = mark
+        for (_, article) in self.articles[n_articles:]:
+            self.pending_ids.pop(article["handle"], None)
+        del self.articles[n_articles:]
+        del self.chains[n_chains:]
+
+    def flush_if_full(self):
+        """
+        Flush if a full batch is buffered; call between items only
+        """
+        if len(self.articles) >= self.batch_size or len(self.chains) >= self.batch_size:
+            self.flush()
+
+    def _resolve_names(self, table, name_column, names):
+        """
+        Map names to ids in a venue/author/keyword table, inserting the names that don't exist yet
+        :return: A dict of name -> id
+        """
+        name_cache = self.name_caches[table.name]
+        ids = dict()
+        for name in names:
+            id = name_cache.get(name)
+            if id is not None:
+                ids[name] = id
+        unknown = [name for name in names if name not in ids]
+        if not unknown:
+            return ids
+
+        column = table.c[name_column]
+        rows = self.db_session.execute(table.select().with_only_columns([column, table.c.id])
+                                       .where(column.in_(unknown)))
+        for (name, id) in rows:
+            ids[name] = id
+            name_cache.put(name, id)
+        missing = [{name_column: name} for name in unknown if name not in ids]
+        if missing:
+            inserted = self.db_session.execute(insert(table).values(missing).returning(column, table.c.id))
+            for (name, id) in inserted:
+                ids[name] = id
+                name_cache.put(name, id, committed=False)
+        return ids
+
+    def _remap(self, reserved_ids):
+        """
+        :param reserved_ids: A dict of handle -> reserved id, for buffered articles already in the database
+        """
+        stored_ids = dict(self.db_session.query(db.Article.handle, db.Article.id)
+                          .filter(db.Article.handle.in_(list(reserved_ids))))
+        remap = {reserved_ids[handle]: stored_ids[handle] for handle in reserved_ids}
+        logging.warning("Articles already written by another worker: " + str(sorted(reserved_ids)))
+        self.articles = [(remap.get(article_id, article_id), article) for (article_id, article) in self.articles]
+        self.chains = [(remap.get(entry_id, entry_id), [remap.get(id, id) for id in citation_chain_list])
+                       for (entry_id, citation_chain_list) in self.chains]
+        for listener in self.remap_listeners:
+            listener(remap)
+
+    def flush(self):
+        """
+        Write every buffered article and citation chain, and commit once
+        """
+        if len(self) == 0:
+            return
+        with metrics.timer("db_write_seconds", operation="batch"):
+            self._write()
+        metrics.inc("articles_written", len(self.articles))
+        metrics.inc("citation_chains_written", len(self.chains))
+        logging.info("Committed " + str(len(self.articles)) + " articles and " + str(len(self.chains)) +
+                     " citation chains to database")
+
+        self.articles = []
+        self.chains = []
+        self.pending_ids = dict()
+
+    def _write(self):
+        extracted_articles = [extracted_article for (_, extracted_article) in self.articles]
+
+        venue_ids = self._resolve_names(db.Venue.__table__, "name",
+                                        {article["venue"] for article in extracted_articles if "venue" in article})
+        author_ids = self._resolve_names(db.Author.__table__, "name",
+                                         {author for article in extracted_articles for author in article["authors"]})
+        keyword_ids = self._resolve_names(db.Keyword.__table__, "keyword",
+                                          {keyword for article in extracted_articles for keyword in article["keywords"]})
+
+        article_rows = []
+        author_rows = []
+        keyword_rows = []
+        for (article_id, article) in self.articles:
+            article_rows.append({"id": article_id,
+                                 "handle": article["handle"],
+                                 "title": article["title"],
+                                 "year": article["year"],
+                                 "venue_id": venue_ids.get(article.get("venue")),
+                                 "abstract": article["abstract"],
+                                 "url": article["url"]})
+            # dict.fromkeys drops repeated names while keeping their order
+            author_rows += [{"author_id": author_ids[author], "article_id": article_id}
+                            for author in dict.fromkeys(article["authors"])]
+            keyword_rows += [{"keyword_id": keyword_ids[keyword], "article_id": article_id}
+                             for keyword in dict.fromkeys(article["keywords"])]
+
+        if article_rows:
+            # Another worker may have written some of the articles since they were looked up (e.g. after its
+            # lease on the handle ran out); their stored ids are used instead of the reserved ones
+            article_table = db.Article.__table__
+            inserted = {id for (id,) in self.db_session.execute(insert(article_table).values(article_rows)
+                                                                .on_conflict_do_nothing(index_elements=["handle"])
+                                                                .returning(article_table.c.id))}
+            if len(inserted) < len(article_rows):
+                self._remap({row["handle"]: row["id"] for row in article_rows if row["id"] not in inserted})
+                author_rows = [row for row in author_rows if row["article_id"] in inserted]
+                keyword_rows = [row for row in keyword_rows if row["article_id"] in inserted]
+        if author_rows:
+            self.db_session.execute(insert(db.author_article_association).values(author_rows))
+        if keyword_rows:
+            self.db_session.execute(insert(db.keyword_article_association).values(keyword_rows))
+        if self.chains:
+            chain_rows = [{"id_of_citing": entry_id, "citation_chain": build_ltree(citation_chain_list)}
+                          for (entry_id, citation_chain_list) in self.chains]
+            chain_table = db.CitationChain.__table__
+            inserted = self.db_session.execute(insert(chain_table).values(chain_rows)
+                                               .on_conflict_do_nothing(index_elements=["citation_chain"])
+                                               .returning(chain_table.c.citation_chain))
+            # Only chains that weren't already stored count towards the citation statistics
+            stats.record_chains(self.db_session, [parse_ltree(chain) for (chain,) in inserted],
+                                {article_id: article["year"] for (article_id, article) in self.articles})
+            edges = {db.citation_edge_from_chain(citation_chain_list) for (_, citation_chain_list) in self.chains}
+            edge_rows = [{"citing_id": citing_id, "cited_id": cited_id}
+                         for (citing_id, cited_id) in sorted(filter(None, edges))]
+            if edge_rows:
+                self.db_session.execute(insert(db.CitationEdge.__table__).values(edge_rows)
+                                        .on_conflict_do_nothing())
+        self.db_session.commit()
+
+
+def build_ltree(citation_list):
+    return ".".join(list(map(str, citation_list)))
+
+
+def parse_ltree(citation_chain):
+    return [int(id) for id in str(citation_chain).split(".")]